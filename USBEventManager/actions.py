@@ -1,185 +1,639 @@
 import os
+import time
 import ctypes
 import logging
+import functools
+import threading
 import subprocess
-from helpers import Helpers
-from usb_helpers import USBTools
+import metrics
+from collections import namedtuple
+from concurrent import futures
+from context import runtime
+from config_cache import compile_config
+from handlers import HandlerPool
+from command_runner import AsyncCommandRunner
 
-usb = USBTools()
-helpers = Helpers()
+usb = runtime.usb
+helpers = runtime.helpers
 
 logger = logging.getLogger(__name__)
 
+# Actions are run in phases, in this order. Every action in a phase is started at the same time,
+# the next phase starts once they've all finished or the deadline for the phase has passed.
+#   containment == stop the device and the console from being used.
+#   destruction == delete data and run custom commands.
+#   power == reboot or shutdown.
+ACTION_PHASES: tuple = ("containment", "destruction", "power")
+
+# {action: (phase, (actions in the same phase that have to finish first))}
+# Actions that aren't listed here run in the destruction phase.
+ACTION_SPECS: dict = {
+    "disable_device": ("containment", ()),
+    "disable_ports": ("containment", ()),
+    "screen_lock": ("containment", ()),
+    "clear_memory": ("destruction", ()),
+    "clear_swap": ("destruction", ()),
+    "custom_commands": ("destruction", ()),
+    "delete": ("destruction", ()),
+    "secure_delete": ("destruction", ()),
+    "melt": ("destruction", ("custom_commands", "delete", "secure_delete")),
+    "filesystem_sync": (
+        "destruction",
+        ("clear_swap", "custom_commands", "delete", "secure_delete", "melt"),
+    ),
+    "safe_reboot": ("power", ()),
+    "safe_shutdown": ("power", ()),
+    "force_reboot": ("power", ()),
+    "force_shutdown": ("power", ()),
+}
+
+# Seconds each phase may run before we move on to the next one. 0 == wait until it's done.
+DEFAULT_PHASE_DEADLINES: dict = {"containment": 5, "destruction": 120, "power": 30}
+
+# Actions that are passed their detail from the config, a list of commands or paths. Every other
+# action is just enabled.
+ACTIONS_WITH_DETAILS: tuple = ("custom_commands", "delete", "secure_delete")
+
+# Actions that do the same thing whichever device triggered them. When several events trigger one
+# at the same time it runs once, see ActionGate. disable_device and custom_commands are run for
+# every event.
+IDEMPOTENT_ACTIONS: tuple = (
+    "clear_memory",
+    "clear_swap",
+    "delete",
+    "disable_ports",
+    "filesystem_sync",
+    "force_reboot",
+    "force_shutdown",
+    "melt",
+    "safe_reboot",
+    "safe_shutdown",
+    "screen_lock",
+    "secure_delete",
+)
+
+# Seconds after an idempotent action has run during which it isn't run again. Overridden, per
+# action, by "action_cooldowns" in the config.
+DEFAULT_ACTION_COOLDOWNS: dict = {"screen_lock": 2, "filesystem_sync": 5}
+
+# The actions to run for a rule and event, bound to an Actions instance. See Actions._bind_plans().
+#   actions == (action, ...) in the order they're listed in the config.
+#   calls == {action: callable taking the EventContext}
+#   gates == {action: ActionGate key}, idempotent actions only.
+ActionPlan = namedtuple("ActionPlan", ["rule", "event_type", "actions", "calls", "gates"])
+
+# The event an action is handling, passed to every action. Nothing about an event is kept on
+# Actions so events handled at the same time can't see each other's details.
+#   location == "<bus>-<port>.<port>..." of the device, None if the event source didn't know it.
+#   rule == The device_specific device ID that matched, or "default". None until it's matched.
+#   dispatched == time.monotonic() when the event was handed to a dispatch thread.
+EventContext = namedtuple(
+    "EventContext",
+    ["device", "event_type", "location", "rule", "dispatched"],
+    defaults=(None, None, None, None),
+)
+NO_EVENT = EventContext(device="", event_type="")
+
+
+def _with_detail(method, detail, event):
+    """ Call an action with its detail from the config, see Actions._bind_plans() """
+    return method(event, detail)
+
+
+class ActionExecutor(object):
+    """ Run actions phase by phase, concurrently within a phase, on a thread pool """
+
+    def __init__(self, deadlines: dict = None, concurrent_runs: int = 1):
+        self.set_deadlines(deadlines)
+        # Enough threads for every action of every run that can happen at the same time. An action
+        # that's still running after its phase deadline keeps its thread, see _submit().
+        self._max_workers: int = len(ACTION_SPECS) * max(concurrent_runs, 1)
+        self._pool = futures.ThreadPoolExecutor(
+            max_workers=self._max_workers, thread_name_prefix="action"
+        )
+        self._busy: int = 0
+        self._lock = threading.Lock()
+
+    def set_deadlines(self, deadlines: dict = None):
+        _deadlines: dict = dict(DEFAULT_PHASE_DEADLINES)
+        _deadlines.update(deadlines or {})
+        self._deadlines = _deadlines
+
+    @staticmethod
+    def phase(action: str) -> str:
+        return ACTION_SPECS.get(action, ("destruction", ()))[0]
+
+    @staticmethod
+    def dependencies(action: str) -> tuple:
+        return ACTION_SPECS.get(action, ("destruction", ()))[1]
+
+    def run(self, actions: list, call, before_phase=None) -> dict:
+        """Run call(action) for each action. Returns {action: (status, duration in seconds)}
+        where status is "done", "failed", "timeout" or "skipped". before_phase(phase) is called
+        before each phase that has actions to run.
+        """
+        _results: dict = {}
+        for _phase in ACTION_PHASES:
+            _phase_actions = [a for a in actions if self.phase(a) == _phase]
+            if _phase_actions:
+                if before_phase is not None:
+                    before_phase(_phase)
+                _results.update(self._run_phase(_phase, _phase_actions, call))
+        return _results
+
+    def _run_phase(self, phase: str, actions: list, call) -> dict:
+        _results: dict = {}
+        _deadline = self._deadlines.get(phase, 0)
+        _start = time.monotonic()
+        _waiting: list = list(actions)
+        _running: dict = {}
+        _started: dict = {}
+        logger.debug("Starting the %s phase: %s", phase, actions)
+
+        while _waiting or _running:
+            # Start everything whose dependencies, if they're queued, have finished.
+            for _action in list(_waiting):
+                _deps = [d for d in self.dependencies(_action) if d in actions]
+                if all(d in _results for d in _deps):
+                    _waiting.remove(_action)
+                    _started[_action] = time.monotonic()
+                    _running[self._submit(call, _action)] = _action
+            _timeout = None
+            if _deadline:
+                _timeout = _deadline - (time.monotonic() - _start)
+                if _timeout <= 0:
+                    break
+            _finished, _ = futures.wait(
+                _running, timeout=_timeout, return_when=futures.FIRST_COMPLETED
+            )
+            if not _finished:
+                break
+            for _future in _finished:
+                _action = _running.pop(_future)
+                _duration = time.monotonic() - _started[_action]
+                try:
+                    _future.result()
+                    _results[_action] = ("done", _duration)
+                    logger.debug("%s finished in %.3f sec.", _action, _duration)
+                except SystemExit:
+                    # Custom command failures can be configured to stop USBEventManager.
+                    raise
+                except Exception as e:
+                    _results[_action] = ("failed", _duration)
+                    logger.error("Action %s failed: %s", _action, e)
+
+        if _running or _waiting:
+            logger.warning(
+                "The %s phase deadline of %s sec. passed. Moving on without waiting for: %s",
+                phase,
+                _deadline,
+                list(_running.values()) + _waiting,
+            )
+            for _action in _running.values():
+                _results[_action] = ("timeout", time.monotonic() - _started[_action])
+            for _action in _waiting:
+                _results[_action] = ("skipped", 0.0)
+        return _results
+
+    def _submit(self, call, action: str) -> futures.Future:
+        """Run call(action) on the pool, or on a thread of its own when every pool thread is busy,
+        e.g. with actions that passed their deadline. An action never queues behind another.
+        """
+        with self._lock:
+            _pooled = self._busy < self._max_workers
+            if _pooled:
+                self._busy += 1
+        if _pooled:
+            _future = self._pool.submit(call, action)
+            _future.add_done_callback(self._release)
+            return _future
+        logger.debug("Every action thread is busy, starting a new one for %s.", action)
+        _future = futures.Future()
+
+        def _run():
+            if not _future.set_running_or_notify_cancel():
+                return
+            try:
+                _future.set_result(call(action))
+            except BaseException as e:
+                _future.set_exception(e)
+
+        threading.Thread(target=_run, name=f"action-{action}", daemon=True).start()
+        return _future
+
+    def _release(self, future: futures.Future) -> None:
+        with self._lock:
+            self._busy -= 1
+
+    def stop(self) -> None:
+        """ Stop the pool, actions that are still running are left to finish """
+        self._pool.shutdown(wait=False)
+
+
+class ActionGate(object):
+    """Run each idempotent action at most once at a time. A trigger that arrives while the action
+    is running is covered by that run and returns straight away, "folded", it never waits for the
+    run to finish. A trigger within the action's cooldown of its last successful run doesn't run
+    it, "cooldown".
+    """
+
+    def __init__(self, cooldowns: dict = None):
+        self._lock = threading.Lock()
+        # Keys of the runs in progress.
+        self._running: set = set()
+        # {key: time.monotonic() the last successful run finished}
+        self._finished: dict = {}
+        self.set_cooldowns(cooldowns)
+
+    def set_cooldowns(self, cooldowns: dict = None):
+        _cooldowns: dict = dict(DEFAULT_ACTION_COOLDOWNS)
+        _cooldowns.update(cooldowns or {})
+        self._cooldowns = _cooldowns
+
+    def run(self, key: tuple, call) -> str:
+        """Run call() unless it's running or cooling down. key == (action, detail). Returns
+        "done", "folded" or "cooldown", raises whatever the run raised.
+        """
+        with self._lock:
+            if key in self._running:
+                return "folded"
+            _finished = self._finished.get(key)
+            if _finished is not None and time.monotonic() - _finished < self._cooldowns.get(
+                key[0], 0
+            ):
+                return "cooldown"
+            self._running.add(key)
+        try:
+            call()
+        except BaseException:
+            with self._lock:
+                self._running.discard(key)
+            raise
+        with self._lock:
+            self._running.discard(key)
+            self._finished[key] = time.monotonic()
+        return "done"
+
 
 class Actions(object):
-    def __init__(self, app_config, ignore_custom_command_failure=None):
+    def __init__(self, app_config, ignore_custom_command_failure=None, journal=None):
         self.app_config = app_config
+        # An EventJournal, see journal.py. None when there isn't one, e.g. for automatic_start.
+        self.journal = journal
 
-        self.device: str = ""
-        self.event_type: str = ""
-        self.queued_actions: dict = {}
         self.platform = helpers.platform
         self.no_action = self.app_config["no_action"]
         self.platform_specific_default_actions: dict = self.app_config[
             "platform_specific_default_actions"
         ]
+        # The action plans for this platform are compiled once, with the config, see
+        # config_cache.py. Here they're bound to our methods.
+        if self.app_config is helpers.config:
+            _compiled: dict = helpers.compiled
+        else:
+            _compiled: dict = compile_config(config=self.app_config, platform=self.platform)
+        self.plans: tuple = self._bind_plans(_compiled)
+        # Events handled at the same time. With one they're handled in the order they happened.
+        _dispatch_workers: int = max(int(self.app_config.get("dispatch_workers", 1)), 1)
+        self.executor = ActionExecutor(
+            deadlines=self.app_config.get("action_phase_deadlines"),
+            concurrent_runs=_dispatch_workers,
+        )
+        self.gate = ActionGate(cooldowns=self.app_config.get("action_cooldowns"))
+        self.handlers = HandlerPool(
+            handlers=self.app_config.get("persistent_handlers"),
+            timeout=self.app_config["custom_command_timeout"],
+        )
+        self.runner = AsyncCommandRunner()
+        # Events are handed to these threads so the monitor keeps watching the bus while
+        # actions run.
+        self._dispatcher = futures.ThreadPoolExecutor(
+            max_workers=_dispatch_workers, thread_name_prefix="dispatch"
+        )
+        self._dispatched: list = []
+        self._ignore_custom_command_failure_override = bool(ignore_custom_command_failure)
         if not ignore_custom_command_failure:
             self.ignore_custom_command_failure = self.app_config["ignore_custom_command_failure"]
         else:
             self.ignore_custom_command_failure = ignore_custom_command_failure
 
+    def _bind_plans(self, compiled: dict) -> tuple:
+        """(device_specific_matcher, {(rule, event type): ActionPlan}) from a compiled config.
+        Each action is bound to its method, and its detail, now rather than for every event.
+        """
+        _plans: dict = {}
+        for (_rule, _event_type), _actions in compiled["action_plans"].items():
+            _calls: dict = {}
+            _gates: dict = {}
+            for _action, _detail in _actions:
+                _method = getattr(self, "_" + str(_action), None)
+                if _action not in ACTION_SPECS or _method is None:
+                    logger.warning('Ignoring unknown action "%s" for %s.', _action, _rule)
+                    continue
+                if _action in ACTIONS_WITH_DETAILS:
+                    _method = functools.partial(_with_detail, _method, _detail)
+                _calls[_action] = _method
+                if _action in IDEMPOTENT_ACTIONS:
+                    # The same action with different paths isn't the same action.
+                    _gates[_action] = (
+                        _action,
+                        repr(_detail) if _action in ACTIONS_WITH_DETAILS else None,
+                    )
+            _plans[(_rule, _event_type)] = ActionPlan(
+                _rule, _event_type, tuple(_calls), _calls, _gates
+            )
+        return compiled["device_specific_matcher"], _plans
+
+    def reload_config(self, compiled: dict):
+        """Use the action tables from a changed config. They're swapped in a single assignment so
+        an event being handled on the dispatch thread sees either the old or the new tables.
+        """
+        _config: dict = compiled["config"]
+        for _key in ("persistent_handlers", "dispatch_workers"):
+            if _config.get(_key) != self.app_config.get(_key):
+                logger.warning("Changes to %s take effect after a restart.", _key)
+        self.plans = self._bind_plans(compiled)
+        self.app_config = _config
+        self.no_action = _config["no_action"]
+        self.platform_specific_default_actions = _config["platform_specific_default_actions"]
+        self.executor.set_deadlines(_config.get("action_phase_deadlines"))
+        self.gate.set_cooldowns(_config.get("action_cooldowns"))
+        if not self._ignore_custom_command_failure_override:
+            self.ignore_custom_command_failure = _config["ignore_custom_command_failure"]
+
     # Processors
-    def trigger_actions(self, device: str, event_type=None):
+    def trigger_actions(self, device: str, event_type=None, location=None) -> dict:
         """ Trigger the appropriate actions for a given event """
+        return self.run_actions(EventContext(device, event_type, location))
+
+    def run_actions(self, event: EventContext) -> dict:
+        """Run the actions for an event. Everything about the event is in `event`, so this can
+        run for several events at the same time.
+        """
+        _device_specific_matcher, _plans = self.plans
+
+        # The device specific rule for the device, or the default actions.
+        _rule = _device_specific_matcher.match(event.device) or "default"
+        event = event._replace(rule=_rule)
+        _plan: ActionPlan = _plans.get((_rule, event.event_type)) or ActionPlan(
+            _rule, event.event_type, (), {}, {}
+        )
+        logger.debug("Queued actions: %s", _plan.actions)
+
+        # Recorded before anything runs, synced before the power phase. Syncing it now would
+        # hold up containment.
+        self._record(event, "actions", sync=False, rule=_rule, actions=list(_plan.actions))
+
+        if event.dispatched is not None:
+            metrics.DISPATCH_LATENCY_SECONDS.observe(time.monotonic() - event.dispatched)
+        # Idempotent actions go through the gate, {action: "done" | "folded" | "cooldown"}
+        _gated: dict = {}
+
+        def _call(action):
+            _key = _plan.gates.get(action)
+            if _key is None:
+                return _plan.calls[action](event)
+            _gated[action] = self.gate.run(_key, lambda: _plan.calls[action](event))
+            if _gated[action] == "folded":
+                logger.info(
+                    "%s is already running, not running it again for %s.", action, event.device
+                )
+            elif _gated[action] == "cooldown":
+                logger.info(
+                    "%s is cooling down, not running it again for %s.", action, event.device
+                )
 
-        _actions: dict = {}
-        _device_specific = self.app_config["device_specific"]
-        self.device = device
-        self.event_type = event_type
-
-        d = helpers.usb_device_id_match(_device_specific, device)
-        if d:
-            actions = _device_specific.get(d, False)
-        elif self.platform_specific_default_actions.get(self.platform, False):
-            actions = self.platform_specific_default_actions.get(self.platform)
-            logger.debug("Using actions for the %s platform.", self.platform)
-        else:
-            logger.debug("No specialized platform found, using default actions.")
-            actions = self.app_config["default_actions"]
-
-        # Filter the actions list for enabled actions.
-        for action, state in actions.items():
-            if state:
-                self.queued_actions[action] = state
-        logger.debug("Queued actions: %s", self.queued_actions)
+        def _before_phase(phase):
+            if phase == "power" and self.journal:
+                # The power phase may be a shutdown, the record has to be on disk first.
+                self.journal.sync()
+
+        # Execute the actions, phase by phase.
+        _results: dict = self.executor.run(
+            actions=list(_plan.actions), call=_call, before_phase=_before_phase
+        )
+        for _action, _status in _gated.items():
+            if _status != "done" and _results.get(_action, ("",))[0] == "done":
+                _results[_action] = (_status, _results[_action][1])
+        self._record(
+            event,
+            "result",
+            results={
+                a: {"status": _status, "duration": round(_duration, 3)}
+                for a, (_status, _duration) in _results.items()
+            },
+        )
+        for _action, (_status, _duration) in _results.items():
+            metrics.ACTIONS.inc(_action, _status)
+            metrics.ACTION_SECONDS.observe(_duration, _action)
+        return _results
+
+    def _record(self, event: EventContext, kind: str, **fields):
+        """ Add a record about an event to the journal """
+        if self.journal:
+            self.journal.record(
+                kind,
+                event_type=event.event_type,
+                device=event.device,
+                location=event.location,
+                **fields,
+            )
 
-        # Execute each action.
-        for action, detail in self.queued_actions.items():
-            action = "_" + str(action)
-            getattr(Actions, action)(self)
+    def dispatch(self, device: str, event_type=None, location=None):
+        """ Run the actions for an event on a dispatch thread """
+        _event = EventContext(device, event_type, location, dispatched=time.monotonic())
+        self._dispatched.append(self._dispatcher.submit(self.run_actions, _event))
+
+    def check_dispatched(self):
+        """Collect finished dispatches. Re-raises SystemExit, e.g. a failed custom command
+        with ignore_custom_command_failure false, on the calling thread.
+        """
+        _running: list = []
+        for _future in self._dispatched:
+            if not _future.done():
+                _running.append(_future)
+                continue
+            try:
+                _future.result()
+            except SystemExit:
+                raise
+            except Exception as e:
+                logger.error("Triggering actions failed: %s", e)
+        self._dispatched = _running
+
+    def start_handlers(self):
+        """ Start the persistent custom command handlers """
+        self.handlers.start()
+
+    def stop(self):
+        """Stop handling events. Events that haven't been dispatched yet are dropped, actions
+        that are running are left to finish. Stops the persistent handlers.
+        """
+        for _future in self._dispatched:
+            _future.cancel()
+        self._dispatcher.shutdown(wait=False)
+        self.executor.stop()
+        self.runner.stop()
+        self.handlers.stop()
+
+    def _event_env(self, event: EventContext = None) -> dict:
+        """ The event details passed to custom commands """
+        if event is None:
+            # Commands that aren't run for an event, e.g. by automatic_start.
+            event = NO_EVENT
+        _env: dict = {
+            "USBEVENTMANAGER_EVENT_TYPE": event.event_type,
+            "USBEVENTMANAGER_DEVICE_ID": event.device,
+            "USBEVENTMANAGER_PLATFORM": self.platform,
+        }
+        if event.location:
+            _env["USBEVENTMANAGER_DEVICE_LOCATION"] = event.location
+            _known = usb.registry.at(event.location)
+            if _known is not None and _known.serial:
+                _env["USBEVENTMANAGER_DEVICE_SERIAL"] = _known.serial
+        return _env
+
+    def run_handler(self, cmd: str, event: EventContext = None, desc="") -> [bool, str]:
+        """ Send the event to a persistent handler """
+        _started = time.monotonic()
+        _status, _output = self.handlers.send(cmd=cmd, env=self._event_env(event))
+        metrics.COMMANDS.inc("ok" if _status == 0 else "failed")
+        metrics.COMMAND_SECONDS.observe(time.monotonic() - _started)
+        if _status == 0:
+            logger.debug("Handler succeeded.")
+            if _output:
+                logger.debug("OUTPUT: %s", _output)
+                return _output
+            return True
+        logger.error("%s: handler returned a non-zero status: %s", desc, _status)
+        if _output:
+            logger.error("OUTPUT: %s\n", _output)
+        if self.ignore_custom_command_failure:
+            return True
+        else:
+            helpers.exiter(1)
 
-    def run_subprocess(self, cmds, desc="") -> [bool, str]:
+    def run_subprocess(self, cmds, event: EventContext = None, desc="") -> [bool, str]:
         """ Run custom commands """
         _cmds = cmds
         _desc = desc
 
-        def _platform_switcher(cmds):
-            """ Used to pick the right subprocess command for the current platform """
-            _cmds = cmds
-            if _cmd := _cmds.get(self.platform, False):
-                return _cmd
+        if type(cmds) == dict:
+            if _cmd := self.platform_command(cmds):
+                return self.finish_command(self.start_command(_cmd, event))
             else:
-                return False
+                logger.warning("%s not supported on %s.", _desc, self.platform)
+        elif type(cmds) in (list, tuple):
+            # Run each command in order, return the result of the last one.
+            _result = None
+            for _cmd in _cmds:
+                _result = self.finish_command(self.start_command(_cmd, event))
+            return _result
+        else:
+            _cmd = cmds
+            return self.finish_command(self.start_command(_cmd, event))
 
-        def _on_error(result):
-            """ Manage an error result from subprocess """
-            _result = result
-            logger.error(
-                "Command returned a non-zero exit code: %s", _result.returncode
-            )
-            if _result.stdout:
-                logger.error("STDOUT: %s\n", _result.stdout)
-            if _result.stderr:
-                logger.error("STDERR: %s\n", _result.stderr)
+    def platform_command(self, cmds: dict):
+        """ Used to pick the right subprocess command for the current platform """
+        if _cmd := cmds.get(self.platform, False):
+            return _cmd
+        else:
+            return False
+
+    def start_command(self, cmd: str, event: EventContext = None):
+        """ Start a command on the command runner, returns a future for finish_command() """
+        _timeout = self.app_config["custom_command_timeout"]
+        return self.runner.submit(cmd, env=self._event_env(event), timeout=_timeout)
+
+    def finish_command(self, future) -> [bool, str]:
+        """ Wait for a command started by start_command() and manage the result """
+        try:
+            _result = future.result()
+        except subprocess.TimeoutExpired as e:
+            logger.error("Command timed out. Timeout: %s sec.", e.timeout)
             if self.ignore_custom_command_failure:
                 return True
             else:
                 helpers.exiter(1)
-
-        def _on_success(result):
-            """ Manage an successful result from subprocess """
-            _result = result
+        if _result.returncode == 0:
+            # Output has already been streamed to the log.
             logger.debug("Command succeeded.")
             if _result.stdout:
-                logger.debug("STDOUT: %s", _result.stdout)
                 return _result.stdout
             else:
                 return True
-
-        def _run_cmd(cmd):
-            _cmd = cmd
-            _result = None
-            _env = {
-                "USBEVENTMANAGER_EVENT_TYPE": self.event_type,
-                "USBEVENTMANAGER_DEVICE_ID": self.device,
-                "USBEVENTMANAGER_PLATFORM": self.platform,
-            }
-            if self.app_config["custom_command_timeout"] != 0:
-                _timeout = self.app_config["custom_command_timeout"]
-                try:
-                    _result = subprocess.run(
-                        _cmd,
-                        capture_output=True,
-                        text=True,
-                        shell=True,
-                        timeout=_timeout,
-                        env=_env,
-                    )
-                except subprocess.TimeoutExpired:
-                    logger.error("Command timed out. Timeout: %s sec.", _timeout)
-                    if self.app_config["ignore_custom_command_failure"]:
-                        return True
-                    else:
-                        helpers.exiter(1)
-            else:
-                _result = subprocess.run(
-                    _cmd, capture_output=True, text=True, shell=True, env=_env
-                )
-            if _result.returncode == 0:
-                _result = _on_success(_result)
-            else:
-                _result = _on_error(_result)
-            return _result
-
-        if type(cmds) == dict:
-            if _cmd := _platform_switcher(cmds):
-                return _run_cmd(_cmd)
-            else:
-                logger.warning("%s not supported on %s.", _desc, self.platform)
+        logger.error("Command returned a non-zero exit code: %s", _result.returncode)
+        if _result.stdout:
+            logger.error("STDOUT: %s\n", _result.stdout)
+        if self.ignore_custom_command_failure:
+            return True
         else:
-            _cmd = cmds
-            return _run_cmd(_cmd)
+            helpers.exiter(1)
 
     # Built-in actions go here
-    def _clear_memory(self):
+    def _clear_memory(self, event: EventContext):
         # TODO: This.
         logger.warning("Memory clear is pending implementation.")
         return True
         _desc = "Clear Memory"
-        logger.info("Running: " + _desc)
+        logger.info("Running: %s", _desc)
         if self.no_action:
             logger.info("     Skipping...")
 
-    def _clear_swap(self):
+    def _clear_swap(self, event: EventContext):
         _desc = "Clear Swap"
-        logger.info("Running: " + _desc)
+        logger.info("Running: %s", _desc)
         # TODO: Find a way to do this on Darwin and Windows.;
         if self.no_action:
             logger.info("     Skipping...")
             return True
         if self.platform == "Linux":
             _c = "swapoff - a && swapon - a"
-            self.run_subprocess(cmds=_c, desc=_desc)
+            self.run_subprocess(cmds=_c, event=event, desc=_desc)
         if self.platform in ["Darwin", "Windows"]:
             logger.warning("Clearing swap isn't supported on %s.", self.platform)
 
-    def _custom_commands(self):
+    def _custom_commands(self, event: EventContext, cmds: list):
         _desc = "User Specified Custom Commands"
-        logger.info("Running: " + _desc)
-        _cmds = self.queued_actions["custom_commands"]
+        logger.info("Running: %s", _desc)
+        _cmds = cmds
+        _running: list = []
+        _handler_cmds: list = []
+        _sequences: list = []
+        # Start every command at once then collect the results.
         for _cmd in _cmds:
+            if type(_cmd) == dict:
+                # {platform: command}
+                _cmd = self.platform_command(_cmd)
+                if not _cmd:
+                    logger.warning("%s not supported on %s.", _desc, self.platform)
+                    continue
             logger.info('Running command "%s"', _cmd)
             if self.no_action:
                 logger.debug("     Skipping...")
+            elif type(_cmd) in (list, tuple):
+                # Commands that have to run one after another.
+                _sequences.append(_cmd)
+            elif self.handlers.is_handler(_cmd):
+                _handler_cmds.append(_cmd)
             else:
-                return self.run_subprocess(cmds=_cmd, desc=_desc)
+                _running.append(self.start_command(_cmd, event))
+        # Handlers reply quickly, run them while the commands are running.
+        _results: list = [
+            self.run_handler(cmd=_cmd, event=event, desc=_desc) for _cmd in _handler_cmds
+        ]
+        _results.extend(
+            self.run_subprocess(cmds=_cmd, event=event, desc=_desc) for _cmd in _sequences
+        )
+        _results.extend(self.finish_command(_future) for _future in _running)
+        return _results
 
-    def _delete(self):
+    def _delete(self, event: EventContext, paths: list):
         _desc = "Filesystem delete"
         logger.info("Running: %s", _desc)
         from pathlib import Path
 
-        _paths = self.queued_actions["delete"]
+        _paths = paths
 
         def _directory_delete(dir):
             """ Delete a directory"""
@@ -224,27 +678,27 @@ class Actions(object):
             else:
                 logger.warning('Path "%s" doesn\'t exist.', str(_path))
 
-    def _disable_device(self):
+    def _disable_device(self, event: EventContext):
         _desc = "Disable USB device"
-        if self.event_type == "ADDED":
+        if event.event_type == "ADDED":
             logger.info("Running: %s", _desc)
             if self.no_action:
                 logger.info("     Skipping...")
                 return True
-            usb.unbind(self.device)
+            usb.unbind(event.device, event.location)
 
-    def _disable_ports(self):
+    def _disable_ports(self, event: EventContext):
         # TODO: This.
         logger.warning("Disabling USB ports is pending implementation.")
         return True
         _desc = "Disabling USB port."
-        logger.info("Running: " + _desc)
+        logger.info("Running: %s", _desc)
         if self.no_action:
             logger.info("     Skipping...")
 
-    def _filesystem_sync(self):
+    def _filesystem_sync(self, event: EventContext):
         _desc = "Filesystem Sync"
-        logger.info("Running: " + _desc)
+        logger.info("Running: %s", _desc)
         if self.no_action:
             logger.info("     Skipping...")
             return True
@@ -255,11 +709,11 @@ class Actions(object):
                 "Darwin": "sync",
                 "Windows": "sync",  # Requires https://docs.microsoft.com/en-us/sysinternals/downloads/sync
             }
-            self.run_subprocess(cmds=_cmds, desc=_desc)
+            self.run_subprocess(cmds=_cmds, event=event, desc=_desc)
 
-    def _force_reboot(self):
+    def _force_reboot(self, event: EventContext):
         _desc = "Forced Reboot"
-        logger.info("Running: " + _desc)
+        logger.info("Running: %s", _desc)
         if self.no_action:
             logger.info("     Skipping...")
             return True
@@ -268,9 +722,9 @@ class Actions(object):
             "Darwin": "/usr/sbin/reboot -n -q",
             "Windows": "shutdown /r /f /t 0",
         }
-        self.run_subprocess(cmds=_cmds, desc=_desc)
+        self.run_subprocess(cmds=_cmds, event=event, desc=_desc)
 
-    def _force_shutdown(self):
+    def _force_shutdown(self, event: EventContext):
         logger.info("Performing forced shutdown...")
         _desc = "Forced Shutdown"
         if self.no_action:
@@ -281,9 +735,9 @@ class Actions(object):
             "Darwin": "/usr/sbin/halt -n -q",
             "Windows": "shutdown /f /t 0",
         }
-        self.run_subprocess(cmds=_cmds, desc=_desc)
+        self.run_subprocess(cmds=_cmds, event=event, desc=_desc)
 
-    def _melt(self):
+    def _melt(self, event: EventContext):
         # TODO: This
         logger.warning("Melting pending implementation.")
         return True
@@ -292,9 +746,9 @@ class Actions(object):
             logger.info("     Skipping...")
         pass
 
-    def _safe_reboot(self):
+    def _safe_reboot(self, event: EventContext):
         _desc = "Safe Reboot"
-        logger.info("Running: " + _desc)
+        logger.info("Running: %s", _desc)
         if self.no_action:
             logger.info("     Skipping...")
             return True
@@ -303,11 +757,11 @@ class Actions(object):
             "Darwin": "/usr/sbin/shutdown -r now",
             "Windows": "shutdown /r /t 0",
         }
-        self.run_subprocess(cmds=_cmds, desc=_desc)
+        self.run_subprocess(cmds=_cmds, event=event, desc=_desc)
 
-    def _safe_shutdown(self):
+    def _safe_shutdown(self, event: EventContext):
         _desc = "Safe Shutdown"
-        logger.info("Running: " + _desc)
+        logger.info("Running: %s", _desc)
         if self.no_action:
             logger.info("     Skipping...")
             return True
@@ -316,23 +770,23 @@ class Actions(object):
             "Darwin": "/usr/sbin/shutdown now",
             "Windows": "shutdown /t 0",
         }
-        self.run_subprocess(cmds=_cmds, desc=_desc)
+        self.run_subprocess(cmds=_cmds, event=event, desc=_desc)
 
-    def _screen_lock(self):
+    def _screen_lock(self, event: EventContext):
         _desc = "Screen Lock"
-        logger.info("Running: " + _desc)
+        logger.info("Running: %s", _desc)
         if self.no_action:
             logger.info("     Skipping...")
             return True
         if self.platform == "Linux":
             user_sessions = self.run_subprocess(
-                cmds="/usr/bin/loginctl --no-legend", desc=_desc
+                cmds="/usr/bin/loginctl --no-legend", event=event, desc=_desc
             )
             for _session in user_sessions.splitlines():
                 _s = _session.split()
                 _c = "/usr/bin/loginctl lock-session " + _s[0]
                 _desc = "Locking Screen for session: " + _session
-                self.run_subprocess(cmds=_c, desc=_desc)
+                self.run_subprocess(cmds=_c, event=event, desc=_desc)
         if self.platform == "Darwin":
             _session = ctypes.CDLL(
                 "/System/Library/PrivateFrameworks/login.framework/Versions/Current/login"
@@ -341,90 +795,27 @@ class Actions(object):
         if self.platform == "Windows":
             ctypes.windll.user32.LockWorkStation()
 
-    def _secure_delete(self):
+    def _secure_delete(self, event: EventContext, paths: list):
         """ Securely delete files and folders """
-        import string
-        import random
-        from pathlib import Path
+        from secure_delete import SecureDeleter, SecureDeletePlanner
 
-        _paths = self.queued_actions["secure_delete"]
+        _paths = paths
         _passes = self.app_config["secure_delete_passes"]
+        _chunk_mb = float(self.app_config.get("secure_delete_chunk_mb", 1))
         logger.info("Securely deleting files with %s overwrite passes.", _passes)
-
-        def _rnd_str() -> str:
-            """ Create a randomish string of _str_length length"""
-            _str_length = random.randrange(1, 48)
-            _chars = string.ascii_letters + string.digits
-            _str = "".join((random.choice(_chars) for _ in range(_str_length)))
-            return _str
-
-        def _directory_delete(path):
-            """ Rename then delete a directory """
-            _path = Path(path)
-            if self.no_action:
-                logger.debug("     Skipping secure delete of %s", str(_path))
-                return True
-
-            _new_path = _path.rename(_rnd_str())
-            try:
-                _new_path.rmdir()
-                logger.debug("Deleted directory %s", _path)
-            # We don't follow symlinks when we delete files so
-            # it's possible we can't delete a dir. We ignore that error.
-            except OSError:
-                pass
-
-        def _file_delete(file, passes):
-            """ Securely delete a file """
-            # With thanks to phealy3330 @ https://stackoverflow.com/questions/17455300/python-securely-remove-file
-            _file = file
-            _passes = passes
-            if self.no_action:
-                logger.debug("     Skipping secure delete of %s", _path)
-                return True
-
-            with open(_file, "ba+", buffering=0) as f:
-                file_length = f.tell()
-            f.close()
-            with open(_file, "br+", buffering=0) as f:
-                # Overwrite the file x times.
-                for x in range(passes):
-                    f.seek(0, 0)
-                    f.write(os.urandom(file_length))
-                    logger.debug(
-                        "Secure delete pass %s of %s complete for %s", x, _passes, _file
-                    )
-                f.seek(0)
-                # Do a final overwrite of all zeros.
-                for _ in range(file_length):
-                    f.write(b"\x00")
-            # Rename the file to a randomish string
-            _new_path = _file.rename(_rnd_str())
-            # Delete the file
-            _new_path.unlink()
-            logger.debug("Secure delete complete for %s", _file)
-
-        for _path in _paths:
-            _path = Path(_path)
-            _path = _path.expanduser()
-            if _path.exists():
-                # If the path in the config file is a file we delete it directly.
-                if _path.is_file():
-                    _file_delete(file=_path, passes=_passes)
-                # If the path in the config file is a dir we iterate from the bottom up.
-                elif _path.is_dir():
-                    for _root, _dirs, _files in os.walk(_path, topdown=False):
-                        _root = Path(_root)
-                        for _file in _files:
-                            _file = Path(_file)
-                            _file_path = _root.joinpath(_file)
-                            _file_delete(file=_file_path, passes=_passes)
-                        for _dir in _dirs:
-                            _dir = Path(_dir)
-                            _dir_path = _root.joinpath(_dir)
-                            _directory_delete(path=_dir)
-                    # If the path in the config file is a dir and doesn't end in a "/" delete it.
-                    if _path[-1] != "/":
-                        _directory_delete(_path)
-            else:
-                logger.warning('Path "%s" doesn\'t exist.', str(_path))
+        _deleter = SecureDeleter(
+            passes=_passes,
+            chunk_size=int(_chunk_mb * 1024 * 1024),
+            method=self.app_config.get("secure_delete_method", "write"),
+            workers=self.app_config.get("secure_delete_workers", 4),
+            no_action=self.no_action,
+        )
+        _budget = self.app_config.get("secure_delete_time_budget", 0)
+        if _budget:
+            _planner = SecureDeletePlanner(
+                deleter=_deleter,
+                budget=_budget,
+                throughput_mb=self.app_config.get("secure_delete_throughput_mb", 100),
+            )
+            return _planner.run(paths=_paths)
+        return _deleter.delete(paths=_paths)
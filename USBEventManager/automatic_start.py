@@ -1,16 +1,21 @@
 # Creates a service to start USBEventManager automatically.
 import logging
 from pathlib import Path
-from actions import Actions
-from helpers import Helpers
+from context import runtime
 
 logger = logging.getLogger(__name__)
 
-helpers = Helpers()
-app_config = helpers.config
-platform = helpers.platform
-config_path = helpers.config_path
-actions = Actions(app_config=app_config, ignore_custom_command_failure=False)
+helpers = runtime.helpers
+_actions = None
+
+
+def actions():
+	""" The Actions used to run service commands, created the first time it's needed """
+	global _actions
+	if _actions is None:
+		from actions import Actions
+		_actions = Actions(app_config=runtime.config, ignore_custom_command_failure=False)
+	return _actions
 
 
 class SystemD(object):
@@ -26,7 +31,7 @@ class SystemD(object):
 		""" Disable the service if it exists """
 		logger.debug("Disabling %s.", self.service_name)
 		_disable = "systemctl disable " + self.service_name
-		actions.run_subprocess([_disable])
+		actions().run_subprocess([_disable])
 		logger.info("%s disabled.", self.service_name)
 		if self._check_service():
 			logger.info("%s service is still running.", self.service_name)
@@ -39,18 +44,18 @@ class SystemD(object):
 		_stop = "systemctl stop " + self.service_name
 
 		self.disable()
-		actions.run_subprocess([_stop])
+		actions().run_subprocess([_stop])
 		self.service_path.unlink(missing_ok=True)
 		lib_systemd = Path("/usr/lib/systemd/system/")
 		lib_systemd = lib_systemd.joinpath(self.service_name)
 		lib_systemd.unlink(missing_ok=True)
-		actions.run_subprocess([self.reload_daemon, _reset_failed])
+		actions().run_subprocess([self.reload_daemon, _reset_failed])
 		logger.info("Automatic start disabled")
 
 	def _check_service(self):
 		""" Return true if the service is active """
 		_is_active = "systemctl is-active " + self.service_name
-		status = actions.run_subprocess([_is_active])
+		status = actions().run_subprocess([_is_active])
 		if status == "active":
 			return True
 		else:
@@ -83,12 +88,12 @@ class SystemD(object):
 		_enable = "systemctl enable " + self.service_name
 		_chmod = "chmod " + str(self.service_mode) + " " + str(self.service_path)
 		_exists = "systemctl list-unit-files | grep " + self.service_name
-		_service = actions.run_subprocess([_exists])
+		_service = actions().run_subprocess([_exists])
 		if _service:
 			self.remove()
 		self._make_systemd_service_file()
 		# Activate the service
-		actions.run_subprocess([_chmod, self.reload_daemon, _enable, _start])
+		actions().run_subprocess([_chmod, self.reload_daemon, _enable, _start])
 		if self._check_service():
 			logger.info("Automatic start enabled, %s is running.", self.service_name)
 			return True
@@ -110,7 +115,7 @@ class LaunchD(object):
 	def _is_active(self):
 		""" Return true if the service is active """
 		_is_active = "launchctl list | grep " + self._service_name
-		_status = actions.run_subprocess([_is_active])
+		_status = actions().run_subprocess([_is_active])
 		if _status:
 			return True
 		else:
@@ -153,18 +158,18 @@ class LaunchD(object):
 		""" Disable the service without changing its current state """
 		if self._is_active():
 			_disable = "launchctl load -w " + self._service_path
-			actions.run_subprocess([_disable])
+			actions().run_subprocess([_disable])
 			logging.info("Automatic start disabled, %s is still running.", self._service_name)
 		else:
 			_disable = "launchctl unload -w " + self._service_path
-			actions.run_subprocess([_disable])
+			actions().run_subprocess([_disable])
 			logging.info("Automatic start disabled, %s is not running.", self._service_name)
 
 	def remove(self):
 		if self._service_path.is_file():
 			_unload = "launchctl unload " + self._service_path
 			_remove = "launchctl remove" + self._service_name
-			actions.run_subprocess([_unload, _remove])
+			actions().run_subprocess([_unload, _remove])
 			self._service_path.unlink(missing_ok=True)
 			logger.info("%s removed.", self._service_name)
 			return True
@@ -177,7 +182,7 @@ class LaunchD(object):
 		if self._service_path.is_file():
 			self.remove()
 		self._make_plist_file()
-		actions.run_subprocess([_load, _start])
+		actions().run_subprocess([_load, _start])
 		# Check to make sure it's running
 		if self._is_active():
 			logger.info("Automatic start enabled, %s is running.", self._service_name)
@@ -204,7 +209,7 @@ class WindowsService(object):
 			f"New-Service -Name \"{self.service_name}\" -BinaryPathName \"{self.executable_path} monitor\" "
 			f"-DisplayName \"{self.service_name}\" -Description \"{self.description}\" "
 			f"-Credential $credentials -StartupType \"Automatic\"")
-		actions.run_subprocess([_service])
+		actions().run_subprocess([_service])
 
 	def _is_running(self):
 		# TODO
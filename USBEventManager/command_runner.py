@@ -0,0 +1,129 @@
+# Runs custom commands on an asyncio event loop with its own thread. Output is streamed into the
+# log line by line as it's written instead of being buffered until the command exits, and
+# commands that time out are sent SIGTERM then, if they don't exit, SIGKILL.
+import os
+import time
+import signal
+import asyncio
+import logging
+import threading
+import subprocess
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between SIGTERM and SIGKILL for a command that timed out.
+KILL_GRACE: float = 5
+# Most stdout we keep for the return value, everything is still logged.
+MAX_CAPTURED_OUTPUT: int = 1024 * 1024
+
+
+class AsyncCommandRunner(object):
+    """ Run shell commands concurrently on a background asyncio event loop """
+
+    def __init__(self, kill_grace: float = KILL_GRACE):
+        self._kill_grace: float = kill_grace
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """ Start the event loop thread the first time a command is run """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="command-runner", daemon=True
+                ).start()
+        return self._loop
+
+    def stop(self) -> None:
+        """ Stop the event loop, commands that are still running are left to finish on their own """
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+
+    def submit(self, cmd: str, env: dict, timeout=None):
+        """Start a command and return a concurrent.futures.Future for its
+        subprocess.CompletedProcess. The future raises subprocess.TimeoutExpired on timeout.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self._run(cmd, env, timeout), self._get_loop()
+        )
+
+    def run(self, cmd: str, env: dict, timeout=None) -> subprocess.CompletedProcess:
+        """ Run a command and wait for it """
+        return self.submit(cmd, env, timeout).result()
+
+    async def _run(self, cmd: str, env: dict, timeout) -> subprocess.CompletedProcess:
+        _started = time.monotonic()
+        _kwargs: dict = {}
+        if os.name == "posix":
+            # A new session so a timeout can signal everything the shell started.
+            _kwargs["start_new_session"] = True
+        _process = await asyncio.create_subprocess_shell(
+            cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            **_kwargs,
+        )
+        _stdout: list = []
+        _readers = asyncio.gather(
+            self._stream(_process.stdout, cmd, logging.DEBUG, _stdout),
+            self._stream(_process.stderr, cmd, logging.WARNING, None),
+        )
+        try:
+            await asyncio.wait_for(_process.wait(), timeout=timeout or None)
+        except asyncio.TimeoutError:
+            await self._terminate(_process)
+            await _readers
+            metrics.COMMANDS.inc("timeout")
+            metrics.COMMAND_SECONDS.observe(time.monotonic() - _started)
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        await _readers
+        metrics.COMMANDS.inc("ok" if _process.returncode == 0 else "failed")
+        metrics.COMMAND_SECONDS.observe(time.monotonic() - _started)
+        return subprocess.CompletedProcess(
+            args=cmd, returncode=_process.returncode, stdout="".join(_stdout), stderr=""
+        )
+
+    @staticmethod
+    async def _stream(stream, cmd: str, level: int, captured):
+        """ Log each line from a stream as it arrives, optionally keeping a copy """
+        _captured_size = 0
+        while True:
+            _line = await stream.readline()
+            if not _line:
+                break
+            _line = _line.decode(errors="replace")
+            logger.log(level, "%s: %s", cmd, _line.rstrip("\n"))
+            if captured is not None and _captured_size < MAX_CAPTURED_OUTPUT:
+                captured.append(_line)
+                _captured_size += len(_line)
+
+    async def _terminate(self, process) -> None:
+        """ SIGTERM then, after the grace period, SIGKILL """
+        self._signal(process, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), timeout=self._kill_grace)
+            return
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Command didn't exit %s sec. after SIGTERM, sending SIGKILL.",
+                self._kill_grace,
+            )
+        self._signal(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+        await process.wait()
+
+    @staticmethod
+    def _signal(process, sig) -> None:
+        try:
+            if os.name == "posix":
+                os.killpg(process.pid, sig)
+            elif sig == signal.SIGTERM:
+                process.terminate()
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,177 @@
+# A compiled copy of the config file, stored next to it, so a warm start doesn't have to parse YAML.
+#
+# The cache holds the config as plain Python objects plus everything we'd otherwise work out at
+# startup - aggregated white/blacklists, DeviceMatchers and the action plans for this platform.
+# It's used when the config file's SHA256 matches the one recorded in the cache. The mtime and
+# size aren't enough, a same size edit within one timestamp tick, or a copy made with "cp -p",
+# keeps them. Otherwise the YAML is parsed and the cache rebuilt.
+import os
+import pickle
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from helpers import Helpers, DeviceMatcher
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the layout of the compiled config changes.
+CACHE_VERSION = 4
+# Events that have action plans.
+EVENT_TYPES: tuple = ("ADDED", "REMOVED")
+
+
+def compile_config(config, platform: str) -> dict:
+    """ Resolve everything in the config that doesn't change while we're running """
+    _config: dict = plain(config)
+    check_config(_config)
+    _whitelist: dict = Helpers.aggregate_list_dupes(_config.get("whitelist"))
+    _removal_blacklist: dict = Helpers.aggregate_list_dupes(
+        _config.get("removal_blacklist")
+    )
+    _device_specific: dict = _config.get("device_specific") or {}
+    _platform_actions: dict = _config.get("platform_specific_default_actions") or {}
+    if _platform_actions.get(platform, False):
+        _actions = _platform_actions[platform]
+    else:
+        _actions = _config.get("default_actions") or {}
+    _default_actions: dict = {a: d for a, d in _actions.items() if d}
+    return {
+        "platform": platform,
+        "config": _config,
+        "whitelist": _whitelist,
+        "removal_blacklist": _removal_blacklist,
+        "whitelist_matcher": DeviceMatcher(_whitelist),
+        "removal_blacklist_matcher": DeviceMatcher(_removal_blacklist),
+        "device_specific_matcher": DeviceMatcher(_device_specific),
+        # Only the enabled actions, {action: detail}
+        "default_actions": _default_actions,
+        "action_plans": compile_action_plans(_device_specific, _default_actions),
+    }
+
+
+def check_config(config: dict) -> None:
+    """ Replace values that would only fail once an action runs with their defaults, and say so """
+    _chunk_mb = config.get("secure_delete_chunk_mb", 1)
+    try:
+        if isinstance(_chunk_mb, bool) or not float(_chunk_mb) > 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        logger.warning('Invalid secure_delete_chunk_mb "%s", using 1.', _chunk_mb)
+        config["secure_delete_chunk_mb"] = 1
+    _debounce = config.get("debounce")
+    if _debounce is not None and not isinstance(_debounce, dict):
+        logger.warning(
+            'Invalid debounce "%s", it must map device IDs to seconds. Ignoring it.', _debounce
+        )
+        config["debounce"] = {}
+
+
+def compile_action_plans(device_specific: dict, default_actions: dict) -> dict:
+    """The enabled actions, and their details, for every rule and event.
+    {(rule, event type): ((action, detail), ...)} where rule is a device_specific device ID or
+    "default". Device specific rules without an entry for an event run nothing.
+    """
+    _plans: dict = {}
+    _default: tuple = tuple(default_actions.items())
+    for _event_type in EVENT_TYPES:
+        _plans[("default", _event_type)] = _default
+    for _device, _events in device_specific.items():
+        for _event_type in EVENT_TYPES:
+            _actions: dict = (_events or {}).get(_event_type) or {}
+            _plans[(_device, _event_type)] = tuple((a, d) for a, d in _actions.items() if d)
+    return _plans
+
+
+def plain(data):
+    """ Convert ruamel.yaml's round trip types to plain dicts and lists """
+    if isinstance(data, dict):
+        return {k: plain(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [plain(v) for v in data]
+    if isinstance(data, bool) or data is None:
+        return data
+    if isinstance(data, int):
+        return int(data)
+    if isinstance(data, float):
+        return float(data)
+    if isinstance(data, str):
+        return str(data)
+    return data
+
+
+class ConfigCache(object):
+    """ The compiled config cache for a config file """
+
+    def __init__(self, config_path: Path):
+        self.config_path: Path = Path(config_path)
+        self.cache_path: Path = self.config_path.with_name(
+            self.config_path.name + ".cache"
+        )
+
+    def fingerprint(self) -> str:
+        """ Digest of the config file, take it before parsing so edits during a parse aren't missed """
+        return self._digest()
+
+    def _digest(self) -> str:
+        with open(self.config_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def _trusted(self) -> bool:
+        """Only load a cache owned by the config file's owner, or root, that nobody else can
+        write to. Unpickling a file someone else controls would run their code.
+        """
+        try:
+            _cache = os.stat(self.cache_path)
+            _config = os.stat(self.config_path)
+        except OSError:
+            return False
+        if not hasattr(os, "getuid"):
+            return True
+        if _cache.st_uid not in (0, _config.st_uid):
+            return False
+        return not _cache.st_mode & 0o022
+
+    def load(self, platform: str) -> [dict, None]:
+        """ Return the compiled config if the cache matches the config file, otherwise None """
+        if not self.cache_path.is_file() or not self._trusted():
+            return None
+        try:
+            with open(self.cache_path, "rb") as f:
+                _cache: dict = pickle.load(f)
+        except Exception as e:
+            logger.debug("Ignoring unreadable config cache %s: %s", self.cache_path, e)
+            return None
+        if _cache.get("version") != CACHE_VERSION:
+            return None
+        if _cache["compiled"].get("platform") != platform:
+            return None
+        # Hashing a file this size costs next to nothing.
+        if _cache.get("digest") != self._digest():
+            logger.debug("%s has changed, rebuilding the cache.", self.config_path)
+            return None
+        logger.debug("Loaded the compiled config from %s.", self.cache_path)
+        return _cache["compiled"]
+
+    def save(self, compiled: dict, fingerprint: str) -> None:
+        """ Write the cache atomically. Failing to write it isn't an error, we'll parse the YAML next time """
+        _cache = {
+            "version": CACHE_VERSION,
+            "digest": fingerprint,
+            "compiled": compiled,
+        }
+        try:
+            _fd, _tmp_path = tempfile.mkstemp(
+                dir=self.cache_path.parent, prefix=self.cache_path.name + "."
+            )
+            try:
+                with os.fdopen(_fd, "wb") as f:
+                    pickle.dump(_cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(_tmp_path, self.cache_path)
+            except BaseException:
+                os.unlink(_tmp_path)
+                raise
+        except OSError as e:
+            logger.debug("Unable to write the config cache %s: %s", self.cache_path, e)
+            return
+        logger.debug("Wrote the compiled config to %s.", self.cache_path)
@@ -0,0 +1,117 @@
+# Watches the config file so a running monitor picks up changes, e.g. from learn or remove,
+# without a restart.
+#
+# On Linux we use inotify, via ctypes, on the directory holding the config file. Watching the
+# directory rather than the file means we still see the change when the file is replaced by
+# a rename, which is how editors and atomic writers save. Everywhere else, or if inotify
+# isn't available, we compare os.stat() results each time we're asked.
+#
+# Nothing here blocks, the monitor asks changed() between events.
+import os
+import sys
+import ctypes
+import struct
+import logging
+import ctypes.util
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class ConfigWatcher(object):
+    """ Stat polling watcher, the fallback """
+
+    def __init__(self, path: Path):
+        self.path: Path = Path(path)
+        self._stat = self._get_stat()
+
+    def _get_stat(self):
+        try:
+            _stat = os.stat(self.path)
+        except OSError:
+            return None
+        return _stat.st_mtime_ns, _stat.st_size, _stat.st_ino
+
+    def changed(self) -> bool:
+        """ True if the config file has changed since the last call """
+        _stat = self._get_stat()
+        if _stat == self._stat:
+            return False
+        self._stat = _stat
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyConfigWatcher(ConfigWatcher):
+    """ inotify watcher for Linux """
+
+    _MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ATTRIB
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self._fd = None
+        self._name: bytes = os.fsencode(self.path.name)
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if _fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        _wd = _libc.inotify_add_watch(
+            _fd, os.fsencode(str(self.path.parent)), ctypes.c_uint32(self._MASK)
+        )
+        if _wd < 0:
+            _errno = ctypes.get_errno()
+            os.close(_fd)
+            raise OSError(_errno, f"inotify_add_watch failed for {self.path.parent}")
+        self._fd = _fd
+
+    def changed(self) -> bool:
+        """ True if there's been an event for the config file since the last call """
+        _changed = False
+        while True:
+            try:
+                _buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not _buffer:
+                break
+            _offset = 0
+            while _offset < len(_buffer):
+                _wd, _mask, _cookie, _length = _EVENT_HEADER.unpack_from(_buffer, _offset)
+                _offset += _EVENT_HEADER.size
+                _name = _buffer[_offset : _offset + _length].rstrip(b"\0")
+                _offset += _length
+                if _mask & IN_Q_OVERFLOW or _name == self._name:
+                    _changed = True
+        if not _changed:
+            return False
+        # inotify also reports metadata only changes, only report a change to the contents.
+        return super().changed()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def get_config_watcher(path: Path) -> ConfigWatcher:
+    """ Return the best watcher for this platform """
+    if sys.platform.startswith("linux"):
+        try:
+            _watcher = InotifyConfigWatcher(path)
+            logger.debug("Watching %s with inotify.", path)
+            return _watcher
+        except (OSError, AttributeError, TypeError) as e:
+            logger.debug("inotify isn't available, polling %s: %s", path, e)
+    return ConfigWatcher(path)
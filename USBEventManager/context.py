@@ -0,0 +1,42 @@
+# The runtime context shared by every module. There is one per process, the objects in it are
+# created the first time they're used. The config file is parsed once, when something first
+# reads runtime.config (or helpers.config), no matter how many modules use it.
+import threading
+
+
+class RuntimeContext(object):
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._helpers = None
+        self._usb = None
+
+    @property
+    def helpers(self):
+        """ The shared Helpers, creating it doesn't load the config file """
+        if self._helpers is None:
+            with self._lock:
+                if self._helpers is None:
+                    from helpers import Helpers
+
+                    self._helpers = Helpers()
+        return self._helpers
+
+    @property
+    def usb(self):
+        """ The shared USBTools, so every module sees the same descriptor cache """
+        if self._usb is None:
+            with self._lock:
+                if self._usb is None:
+                    from usb_helpers import USBTools
+
+                    self._usb = USBTools()
+        return self._usb
+
+    @property
+    def config(self):
+        """ The parsed config file """
+        with self._lock:
+            return self.helpers.config
+
+
+runtime = RuntimeContext()
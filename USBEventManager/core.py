@@ -1,11 +1,18 @@
+import json
 import time
 import logging
-from actions import Actions
-from helpers import Helpers
-from usb_helpers import USBTools
-
-usb = USBTools()
-helpers = Helpers()
+import metrics
+import event_sources
+from actions import Actions, ActionExecutor, ACTION_PHASES, ACTION_SPECS, ACTIONS_WITH_DETAILS
+from context import runtime
+from helpers import DeviceMatcher
+from debounce import EventDebouncer
+from config_watcher import get_config_watcher
+from journal import EventJournal, JournalReader, format_record
+from usb_helpers import DeviceSnapshot, DeviceNameResolver
+
+usb = runtime.usb
+helpers = runtime.helpers
 
 logger = logging.getLogger(__name__)
 
@@ -20,9 +27,19 @@ class USBEventManager(object):
 
         # Configuration details
         self._default_actions: dict = self._app_config["default_actions"]
-        self._check_interval: int = int(self._app_config["check_interval"])
+        # The poll interval backs off from check_interval_min to check_interval while the bus is idle.
+        self._check_interval: float = float(self._app_config["check_interval"])
+        self._check_interval_min: float = float(
+            self._app_config.get("check_interval_min", self._check_interval)
+        )
+        self._event_source_name: str = self._app_config.get("event_source", "auto")
+        self._async_device_names: bool = self._app_config.get(
+            "async_device_names", True
+        )
         self._allow_unknown_removal: bool = self._app_config["allow_unknown_removal"]
-        self._devices_with_specific_actions: dict = self._app_config["device_specific"]
+        self._devices_with_specific_actions: dict = (
+            self._app_config["device_specific"] or {}
+        )
         self._allow_unknown_devices_at_start: bool = self._app_config[
             "allow_unknown_devices_at_start"
         ]
@@ -31,13 +48,25 @@ class USBEventManager(object):
         self._get_lists()
 
         self._actions = None
-        self._startup_devices: dict = {}
-        self._session_allowed_devices: dict = {}
+        self._event_source = None
+        self._device_name_resolver = None
+        # Event driven sources return at least this often even when the bus is idle.
+        self._idle_timeout: float = 1.0
+        self._startup_devices: DeviceSnapshot = DeviceSnapshot({})
         self._current_attached_devices: dict = {}
+        # {location: "xxxx:xxxx"} of the devices counted in _current_attached_devices.
+        self._counted_locations: dict = {}
         self._unknown_devices_at_startup: dict = {}
         self._removal_blacklisted_devices: list = []
         self._session_allowed_attached_devices: dict = {}
         self._session_removal_blacklisted_devices: list = []
+        # Unknown devices attached at startup that have since been removed.
+        self._revoked_startup_devices: set = set()
+        self._config_watcher = None
+        self._journal = None
+        self._metrics_exporters: list = []
+        self._debouncer = None
+        self._watch_config: bool = self._app_config.get("watch_config", True)
 
         logger.debug("USBEventManager configuration: %s", self._app_config)
 
@@ -46,12 +75,9 @@ class USBEventManager(object):
 
     def _get_lists(self):
         """ Load the white and black lists from the configuration file """
-        self._default_whitelist: dict = helpers.aggregate_list_dupes(
-            self._app_config["whitelist"]
-        )
-        self._removal_blacklist: dict = helpers.aggregate_list_dupes(
-            self._app_config["removal_blacklist"]
-        )
+        # Copies, these are changed during the session.
+        self._default_whitelist: dict = dict(helpers.compiled["whitelist"])
+        self._removal_blacklist: dict = dict(helpers.compiled["removal_blacklist"])
         self._platform_specific_default_actions: dict = self._app_config[
             "platform_specific_default_actions"
         ]
@@ -67,7 +93,7 @@ class USBEventManager(object):
         _update = False
         _first_loop = True
         try:
-            _startup_attached_devices: dict = usb.devices
+            _startup_attached_devices: DeviceSnapshot = usb.devices
             while True:
                 if _first_loop:
                     # Add all devices currently attached to the system to the default whitelist.
@@ -93,7 +119,7 @@ class USBEventManager(object):
                     print(" ")
                     print("Attach a USB device to add it to the default whitelist.")
                     print("Ctrl-C to quit...")
-                _attached_devices: dict = usb.devices
+                _attached_devices: DeviceSnapshot = usb.devices
                 for device in _attached_devices.keys():
                     if device not in self._default_whitelist:
                         self._default_whitelist[device] = 1
@@ -159,8 +185,29 @@ class USBEventManager(object):
                 self._devices_with_specific_actions
             )
         )
+        self._print_action_plans()
         return True
 
+    @staticmethod
+    def _print_action_plans():
+        """ Print the compiled action plans, what will actually run on this platform, in order """
+        print(f"Action plans for {helpers.platform}: ")
+        for (_rule, _event_type), _actions in helpers.compiled["action_plans"].items():
+            print(f"     {_rule}, {_event_type}")
+            if not _actions:
+                print("          <none>")
+                continue
+            for _phase in ACTION_PHASES:
+                for _action, _detail in _actions:
+                    if ActionExecutor.phase(_action) != _phase:
+                        continue
+                    if _action not in ACTION_SPECS:
+                        print(f"          {_phase}: {_action} (unknown action, ignored)")
+                        continue
+                    print(f"          {_phase}: {_action}")
+                    if _action in ACTIONS_WITH_DETAILS:
+                        print(f"               {_detail}")
+
     def list_devices(self):
         """ Print a list of all devices in the config file. """
         print(helpers.pretty_default_whitelist(self._default_whitelist))
@@ -179,6 +226,9 @@ class USBEventManager(object):
             helpers.exiter(1)
 
         _device_ids = device_ids
+        _dw_updates = False
+        _bl_updates = False
+        _ds_updates = False
         for _dev in _device_ids:
             logger.info('Removing device "%s" from configuration.', _dev)
             _dw_update = False
@@ -205,36 +255,67 @@ class USBEventManager(object):
                     self._devices_with_specific_actions.pop(_dev, None)
                     logger.info("     Removed from device specific options.")
                 _ds_update = True
-            if _dw_update:
-                _dw: dict = {
-                    "whitelist": helpers.disaggregate_dict_dupes(
-                        self._default_whitelist
-                    )
-                }
-                helpers.update_config(data=_dw)
-                print("New default whitelist: ")
-                print(
-                    "     " + helpers.pretty_default_whitelist(self._default_whitelist)
-                )
-            if _bl_update:
-                _bl: dict = {"removal_blacklist": self._removal_blacklist}
-                helpers.update_config(data=_bl)
-                print("New removal blacklist: ")
-                print(
-                    "     " + helpers.pretty_removal_blacklist(self._removal_blacklist)
-                )
-            if _ds_update:
-                _ds: dict = {"device_specific": self._devices_with_specific_actions}
-                helpers.update_config(data=_ds)
-                print("New specific actions: ")
-                print(
-                    "     "
-                    + helpers.pretty_devices_with_specific_actions(
-                        self._devices_with_specific_actions
-                    )
-                )
             if not _dw_update and not _bl_update and not _ds_update:
                 logger.info("     Device %s not found in config.", _dev)
+            _dw_updates = _dw_updates or _dw_update
+            _bl_updates = _bl_updates or _bl_update
+            _ds_updates = _ds_updates or _ds_update
+
+        # Every change is written to the config file at once.
+        _updates: dict = {}
+        if _dw_updates:
+            _updates["whitelist"] = helpers.disaggregate_dict_dupes(self._default_whitelist)
+            print("New default whitelist: ")
+            print("     " + helpers.pretty_default_whitelist(self._default_whitelist))
+        if _bl_updates:
+            _updates["removal_blacklist"] = helpers.disaggregate_dict_dupes(
+                self._removal_blacklist
+            )
+            print("New removal blacklist: ")
+            print("     " + helpers.pretty_removal_blacklist(self._removal_blacklist))
+        if _ds_updates:
+            _updates["device_specific"] = self._devices_with_specific_actions
+            print("New specific actions: ")
+            print(
+                "     "
+                + helpers.pretty_devices_with_specific_actions(
+                    self._devices_with_specific_actions
+                )
+            )
+        if _updates and not self._no_actions:
+            helpers.update_config(data=_updates)
+        helpers.exiter(0)
+
+    def replay_journal(self, since=None, until=None, device=None):
+        """ Print the event journal, oldest record first. since and until are epoch seconds """
+        _reader = JournalReader(directory=helpers.log_dir)
+        if not _reader.files():
+            print(f"No event journal in {helpers.log_dir}.")
+            helpers.exiter(1)
+        for _record in _reader.records(since=since, until=until, device=device):
+            print(format_record(_record))
+        helpers.exiter(0)
+
+    def query_journal(
+        self, since=None, until=None, device=None, event_type=None, kind=None, count=False
+    ):
+        """ Print the matching journal records as JSON lines, or just how many there are """
+        _reader = JournalReader(directory=helpers.log_dir)
+        if not _reader.files():
+            print(f"No event journal in {helpers.log_dir}.")
+            helpers.exiter(1)
+        _records = _reader.records(
+            since=since,
+            until=until,
+            device=device,
+            event_type=event_type,
+            kind=kind,
+        )
+        if count:
+            print(sum(1 for _ in _records))
+        else:
+            for _record in _records:
+                print(json.dumps(_record))
         helpers.exiter(0)
 
     def _setup_monitor_mode(self):
@@ -243,7 +324,21 @@ class USBEventManager(object):
             logger.error("Monitor mode requires root/Administrator permissions.")
             helpers.exiter(1)
 
-        self._actions = Actions(app_config=self._app_config)
+        # The journal is opened first so the first event is recorded.
+        if self._app_config.get("journal", True):
+            self._journal = EventJournal(
+                directory=helpers.log_dir,
+                fsync=self._app_config.get("journal_fsync", "always"),
+                retention=self._app_config.get("log_retention", 10),
+                max_bytes=int(
+                    float(self._app_config.get("journal_max_mb", 10)) * 1024 * 1024
+                ),
+            )
+            if not self._journal.open():
+                self._journal = None
+        self._actions = Actions(app_config=self._app_config, journal=self._journal)
+        # Persistent handlers are started now so their startup cost isn't paid per event.
+        self._actions.start_handlers()
 
         # Here we build session specific lists of devices #
         # _startup_devices == USB devices attached when USBEventManager is started
@@ -254,39 +349,64 @@ class USBEventManager(object):
         # _session_removal_blacklisted_devices == devices that are already attached or can be attached without
         #     triggering actions but will on removal.
 
-        self._startup_devices: dict = usb.devices
+        self._startup_devices: DeviceSnapshot = usb.devices
         logger.debug("USB devices attached at startup: %s", self._startup_devices)
 
+        (
+            self._session_allowed_attached_devices,
+            self._unknown_devices_at_startup,
+            self._session_removal_blacklisted_devices,
+        ) = self._build_session_lists(
+            whitelist=self._default_whitelist,
+            removal_blacklist=self._removal_blacklist,
+            devices_with_specific_actions=self._devices_with_specific_actions,
+            allow_unknown_removal=self._allow_unknown_removal,
+        )
+
+    def _build_session_lists(
+        self,
+        whitelist: dict,
+        removal_blacklist: dict,
+        devices_with_specific_actions: dict,
+        allow_unknown_removal: bool,
+        unknown_devices_at_startup: dict = None,
+    ) -> tuple:
+        """Build the session lists from the config lists and the devices attached at startup.
+        Returns (session_allowed_attached_devices, unknown_devices_at_startup,
+        session_removal_blacklisted_devices). unknown_devices_at_startup is worked out when
+        we start, pass it in to keep it when the config is reloaded.
+        """
         # Build the _session_allowed_attached_devices whitelist
         # Add the default whitelist
-        self._session_allowed_attached_devices = self._default_whitelist
+        _session_allowed_attached_devices: dict = dict(whitelist)
         # Add the removal blacklist.
-        for device in self._removal_blacklist:
-            if device not in self._session_allowed_attached_devices:
-                self._session_allowed_attached_devices[device] = 1
+        for device in removal_blacklist:
+            if device not in _session_allowed_attached_devices:
+                _session_allowed_attached_devices[device] = 1
         # Add devices with specific actions
-        for device in self._devices_with_specific_actions:
-            if device not in self._session_allowed_attached_devices:
-                self._session_allowed_attached_devices[device] = 1
+        for device in devices_with_specific_actions:
+            if device not in _session_allowed_attached_devices:
+                _session_allowed_attached_devices[device] = 1
 
         # Devices attached at startup that are not on any whitelists or where the count
         # of attached devices with the same ID is greater that allowed via the whitelist.
-        for device, attached_cnt in self._startup_devices.items():
-            if not helpers.usb_device_id_match(
-                config_devices=self._session_allowed_attached_devices, device=device
-            ):
-                self._unknown_devices_at_startup[device] = attached_cnt
-            if helpers.usb_device_id_match(
-                config_devices=self._session_allowed_attached_devices, device=device
-            ):
-                if attached_cnt > self._session_allowed_attached_devices[device]:
-                    self._unknown_devices_at_startup[device] = (
-                        attached_cnt - self._session_allowed_attached_devices[device]
-                    )
-        logger.debug(
-            "Devices attached at startup that don't match a whitelist: %s",
-            self._unknown_devices_at_startup,
-        )
+        if unknown_devices_at_startup is None:
+            unknown_devices_at_startup = {}
+            _session_allowed_matcher = DeviceMatcher(_session_allowed_attached_devices)
+            for device, attached_cnt in self._startup_devices.items():
+                _match = _session_allowed_matcher.match(device)
+                if not _match:
+                    unknown_devices_at_startup[device] = attached_cnt
+                else:
+                    # Compare against the count for the config entry that matched, the
+                    # device ID itself isn't a key when it matched a wildcard.
+                    _allowed_cnt = _session_allowed_attached_devices[_match]
+                    if attached_cnt > _allowed_cnt:
+                        unknown_devices_at_startup[device] = attached_cnt - _allowed_cnt
+            logger.debug(
+                "Devices attached at startup that don't match a whitelist: %s",
+                unknown_devices_at_startup,
+            )
 
         # Add all devices attached at startup to the session allowed devices list
         # unless configured ("allow_unknown_removal" in the config) otherwise.
@@ -296,14 +416,15 @@ class USBEventManager(object):
                 "Whitelisting all devices attached at startup."
             )
             for _device, _attached_cnt in self._startup_devices.items():
-                _allowed_cnt = self._session_allowed_attached_devices.get(
-                    _device, False
-                )
+                # Unknown devices that were removed, with allow_unknown_removal, stay removed.
+                if _device in self._revoked_startup_devices:
+                    continue
+                _allowed_cnt = _session_allowed_attached_devices.get(_device, False)
                 if _allowed_cnt:
                     if _attached_cnt > _allowed_cnt:
-                        self._session_allowed_attached_devices[_device] = _attached_cnt
+                        _session_allowed_attached_devices[_device] = _attached_cnt
                 else:
-                    self._session_allowed_attached_devices[_device] = _attached_cnt
+                    _session_allowed_attached_devices[_device] = _attached_cnt
         else:
             logger.debug(
                 "The allow_unknown_devices_at_start option is false."
@@ -311,162 +432,369 @@ class USBEventManager(object):
             )
         logger.debug(
             "All devices whitelisted for attachment this session: %s",
-            self._session_allowed_attached_devices,
+            _session_allowed_attached_devices,
         )
 
         # Build the complete removal blacklist
         # Add the explicit removal blacklist
-        for k in self._removal_blacklist.keys():
-            self._session_removal_blacklisted_devices.append(k)
+        _session_removal_blacklisted_devices: list = list(removal_blacklist.keys())
         # If configured ("allow_unknown_removal" in the config) add unknown devices attached at startup
-        if not self._allow_unknown_removal:
-            for k in self._unknown_devices_at_startup:
-                self._session_removal_blacklisted_devices.append(k)
+        if not allow_unknown_removal:
+            for k in unknown_devices_at_startup:
+                _session_removal_blacklisted_devices.append(k)
         logger.debug(
             "Devices blacklisted for detach: %s",
-            self._session_removal_blacklisted_devices,
+            _session_removal_blacklisted_devices,
         )
+        return (
+            _session_allowed_attached_devices,
+            unknown_devices_at_startup,
+            _session_removal_blacklisted_devices,
+        )
+
+    def _reload_config(self):
+        """Swap in the lists and action tables from a changed config file. Called between
+        events, the event source stays open so nothing is missed while we reload.
+        """
+        logger.info("%s has changed, reloading it.", self._config_path)
+        _compiled: dict = helpers.reload_config()
+        if _compiled is None:
+            metrics.CONFIG_RELOADS.inc("failed")
+            return
+        _config: dict = _compiled["config"]
+        try:
+            _allow_unknown_removal: bool = _config["allow_unknown_removal"]
+            _devices_with_specific_actions: dict = _config["device_specific"] or {}
+            _default_whitelist: dict = dict(_compiled["whitelist"])
+            _removal_blacklist: dict = dict(_compiled["removal_blacklist"])
+            _session_lists: tuple = self._build_session_lists(
+                whitelist=_default_whitelist,
+                removal_blacklist=_removal_blacklist,
+                devices_with_specific_actions=_devices_with_specific_actions,
+                allow_unknown_removal=_allow_unknown_removal,
+                unknown_devices_at_startup=self._unknown_devices_at_startup,
+            )
+            _debounce_windows: dict = EventDebouncer.parse_windows(_config.get("debounce"))
+            self._actions.reload_config(_compiled)
+        except (KeyError, TypeError, AttributeError) as e:
+            logger.error("Invalid config, keeping the current one: %s", e)
+            metrics.CONFIG_RELOADS.inc("failed")
+            return
+
+        # Everything's been built, swap it in.
+        self._app_config = _config
+        self._debouncer.set_windows(_debounce_windows)
+        self._allow_unknown_removal = _allow_unknown_removal
+        self._devices_with_specific_actions = _devices_with_specific_actions
+        self._default_whitelist = _default_whitelist
+        self._removal_blacklist = _removal_blacklist
+        self._default_actions = _config["default_actions"]
+        self._platform_specific_default_actions = _config[
+            "platform_specific_default_actions"
+        ]
+        (
+            self._session_allowed_attached_devices,
+            self._unknown_devices_at_startup,
+            self._session_removal_blacklisted_devices,
+        ) = _session_lists
+        metrics.CONFIG_RELOADS.inc("ok")
+        logger.info("Reloaded %s.", self._config_path)
 
     def monitor(self):
         """ Monitor for changes in attached devices  """
         logger.info("Monitoring...")
 
+        # Open the event source before we enumerate the startup devices so nothing
+        # attached in between is missed.
+        self._event_source = event_sources.get_event_source(
+            name=self._event_source_name,
+            interval=self._check_interval,
+            min_interval=self._check_interval_min,
+        )
         self._setup_monitor_mode()
-        _old_attached_devices: dict = {}
+        self._event_source.seed(self._startup_devices)
+        if self._journal:
+            self._journal.record(
+                "start",
+                event_source=self._event_source.name,
+                devices=self._startup_devices.total,
+                no_actions=self._no_actions,
+            )
+        if self._async_device_names:
+            self._device_name_resolver = DeviceNameResolver(usb_tools=usb)
+        if self._watch_config:
+            self._config_watcher = get_config_watcher(path=self._config_path)
+        self._debouncer = EventDebouncer(
+            windows=self._app_config.get("debounce"), on_coalesced=self._log_coalesced
+        )
+        metrics.ATTACHED_DEVICES.set_function(lambda: len(usb.registry))
+        self._metrics_exporters = metrics.start_exporters(
+            textfile=self._app_config.get("metrics_textfile"),
+            socket_path=self._app_config.get("metrics_socket"),
+            interval=self._app_config.get("metrics_interval", 15),
+        )
+
+        # Devices attached at startup are checked against the lists like any other added device.
+        _startup_events: list = []
+        for _device in usb.registry:
+            _startup_events.append(
+                event_sources.USBEvent("ADDED", _device.device_id, _device.location)
+            )
         try:
             print("Ctrl-C to quit...")
+            self._handle_events(events=_startup_events)
             while True:
-                _delta: dict = {}
-                self._current_attached_devices: dict = usb.devices
-                logger.debug(
-                    "%s devices attached: %s",
-                    sum(self._current_attached_devices.values()),
-                    self._current_attached_devices,
+                _events: list = self._event_source.poll(
+                    timeout=self._debouncer.timeout(self._idle_timeout)
                 )
-
-                _old_device_cnt = sum(_old_attached_devices.values())
-                _current_device_cnt = sum(self._current_attached_devices.values())
-                if _current_device_cnt > _old_device_cnt:
-                    self._event = "ADDED"
-                if _current_device_cnt < _old_device_cnt:
-                    self._event = "REMOVED"
-
-                if self._event:
-                    if self._event == "ADDED":
-                        for (
-                            _device,
-                            _attached_device_cnt,
-                        ) in self._current_attached_devices.items():
-                            _delta = {}
-                            for x in range(0, _attached_device_cnt):
-                                if _device not in _old_attached_devices:
-                                    _desc = usb.friendly_device_desc(_device)
-                                    logger.info(
-                                        "New device added: %s, %s", _device, _desc
-                                    )
-                                    _delta[_device] = _attached_device_cnt
-                                    self._check_lists(
-                                        devices=_delta, event_type=self._event
-                                    )
-                                if _device in _old_attached_devices:
-                                    if (
-                                        _attached_device_cnt
-                                        < _old_attached_devices[_device]
-                                    ):
-                                        _desc = usb.friendly_device_desc(_device)
-                                        logger.info(
-                                            "Additional instance of %s, %s added.",
-                                            _device,
-                                            _desc,
-                                        )
-                                        _delta[_device] = _attached_device_cnt
-                                        self._check_lists(
-                                            devices=_delta, event_type=self._event
-                                        )
-                    if self._event == "REMOVED":
-                        for _device in _old_attached_devices.keys():
-                            if _device not in self._current_attached_devices:
-                                logger.info("Device %s removed", _device)
-                                _devices = {_device: 1}
-                                self._check_lists(
-                                    devices=_devices, event_type=self._event
-                                )
-                time.sleep(self._check_interval)
-                self._event = False
-                _old_attached_devices = dict(self._current_attached_devices)
+                # Events for devices with a debounce window are held until it closes.
+                if _events:
+                    _events = self._debouncer.add(_events)
+                _events.extend(self._debouncer.due())
+                if _events:
+                    self._handle_events(events=_events)
+                self._actions.check_dispatched()
+                if self._config_watcher and self._config_watcher.changed():
+                    self._reload_config()
         except KeyboardInterrupt:
             helpers.exiter(0)
+        finally:
+            # Also when a custom command failure stops us, see Actions.check_dispatched().
+            self._stop_monitoring()
+
+    def _stop_monitoring(self):
+        """ Close everything monitor() started """
+        self._event_source.close()
+        self._actions.stop()
+        if self._journal:
+            self._journal.record("stop")
+            self._journal.close()
+        if self._config_watcher:
+            self._config_watcher.close()
+        for _exporter in self._metrics_exporters:
+            _exporter.close()
+
+    def _handle_events(self, events: list):
+        """ Update the attached device counts from a list of USBEvents then check the lists for the whole batch. """
+        _started = time.monotonic()
+        _checks: list = []
+        for _event in events:
+            _device = _event.device
+            # Event driven sources don't enumerate the bus, keep the device registry up to date.
+            usb.track(_event.event_type, _device, _event.location)
+            if _event.event_type == "ADDED":
+                if _event.location:
+                    if self._counted_locations.get(_event.location) == _device:
+                        # Attached while monitoring started, the startup scan saw it and the
+                        # event source reported it too.
+                        logger.debug(
+                            "Device %s at %s is already counted.", _device, _event.location
+                        )
+                        continue
+                    self._counted_locations[_event.location] = _device
+                _attached_device_cnt = self._current_attached_devices.get(_device, 0) + 1
+                self._current_attached_devices[_device] = _attached_device_cnt
+                if self._device_name_resolver:
+                    # The lists are checked first, the name is logged once it's been read.
+                    self._log_added(_device, _attached_device_cnt, location=_event.location)
+                    self._device_name_resolver.submit(
+                        _device, _event.location, self._log_device_name
+                    )
+                else:
+                    _desc = usb.friendly_device_desc(_device, _event.location)
+                    self._log_added(
+                        _device, _attached_device_cnt, desc=_desc, location=_event.location
+                    )
+                _checks.append((_event, _attached_device_cnt))
+            if _event.event_type == "REMOVED":
+                if self._counted_locations.get(_event.location) == _device:
+                    del self._counted_locations[_event.location]
+                _attached_device_cnt = self._current_attached_devices.get(_device, 0) - 1
+                if _attached_device_cnt > 0:
+                    self._current_attached_devices[_device] = _attached_device_cnt
+                else:
+                    self._current_attached_devices.pop(_device, None)
+                # Without a location we can't tell instances apart, keep the cached
+                # name until the last instance is gone.
+                if _event.location or _attached_device_cnt <= 0:
+                    usb.forget_device(_device, _event.location)
+                if _event.location:
+                    logger.info("Device %s removed from %s", _device, _event.location)
+                else:
+                    logger.info("Device %s removed", _device)
+                _checks.append((_event, max(_attached_device_cnt, 0)))
+        if _checks:
+            self._check_lists(events=_checks)
+        metrics.EVENT_BATCH_SECONDS.observe(time.monotonic() - _started)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "%s devices attached: %s",
+                sum(self._current_attached_devices.values()),
+                self._current_attached_devices,
+            )
 
-    def _check_lists(self, devices: dict, event_type: bool):
-        """ Check added or removed devices against the device lists and trigger actions if required. """
-        logger.debug("Checking lists for: %s", devices)
-        _devices = devices
+    @staticmethod
+    def _log_added(device: str, attached_cnt: int, desc=None, location=None):
+        """ Log an added device, with its name and location if we have them """
+        if location:
+            device = f"{device} at {location}"
+        if desc is None:
+            if attached_cnt == 1:
+                logger.info("New device added: %s", device)
+            else:
+                logger.info("Additional instance of %s added.", device)
+        else:
+            if attached_cnt == 1:
+                logger.info("New device added: %s, %s", device, desc)
+            else:
+                logger.info("Additional instance of %s, %s added.", device, desc)
+
+    def _log_coalesced(self, first, second):
+        """ Called by the EventDebouncer when two events for a device cancel out """
+        _device = first.device
+        if first.location:
+            _device = f"{_device} at {first.location}"
+        logger.info(
+            "Device %s %s then %s within its debounce window, ignoring both.",
+            _device,
+            first.event_type.lower(),
+            second.event_type.lower(),
+        )
+        metrics.EVENTS_COALESCED.inc()
+        if self._journal:
+            self._journal.record(
+                "coalesced",
+                device=first.device,
+                location=first.location,
+                events=[first.event_type, second.event_type],
+            )
+
+    @staticmethod
+    def _log_device_name(device: str, location, name: str):
+        """ Called by the DeviceNameResolver once a device name has been read """
+        if location:
+            logger.info("Device %s at %s is %s", device, location, name)
+        else:
+            logger.info("Device %s is %s", device, name)
+
+    def _check_lists(self, events: list):
+        """Check added or removed devices against the device lists and trigger actions if required.
+        events is a list of (USBEvent, count of that device attached after the event).
+        """
+        logger.debug("Checking lists for: %s", events)
+        for _usb_event, _connected_cnt in events:
+            self._event = _usb_event.event_type
+            self._check_event(
+                device=_usb_event.device,
+                event_type=self._event,
+                connected_cnt=_connected_cnt,
+                location=_usb_event.location,
+            )
+        self._event = False
+
+    def _check_event(self, device: str, event_type: str, connected_cnt: int, location=None):
+        """ Check a single added or removed device against the device lists """
+        _dev = device
+        _connected_cnt = connected_cnt
         _event = event_type
         if _event == "ADDED":
-            for _dev, _connected_cnt in devices.items():
-                if _dev not in self._session_allowed_attached_devices:
-                    logger.info(
-                        "Device %s not whitelisted. Triggering %s actions.",
-                        _dev,
-                        _event,
-                    )
-                    self._actions.trigger_actions(_dev, _event)
-                elif _dev in self._session_allowed_attached_devices:
-                    _allowed_ct = self._session_allowed_attached_devices.get(
-                        _dev, False
-                    )
-                    if _allowed_ct:
-                        if _allowed_ct < _connected_cnt:
-                            logger.info(
-                                "%s instances of device %s allowed, %s found. "
-                                "Triggering actions.",
-                                _allowed_ct,
-                                _dev,
-                                _connected_cnt,
-                            )
-                            self._actions.trigger_actions(_dev, _event)
-                        else:
-                            logger.info('Device "%s" whitelisted for attachment.', _dev)
-                    else:
+            if _dev not in self._session_allowed_attached_devices:
+                logger.info(
+                    "Device %s not whitelisted. Triggering %s actions.",
+                    _dev,
+                    _event,
+                )
+                self._record_event(_dev, _event, location, "not whitelisted", True)
+                self._actions.dispatch(_dev, _event, location)
+            elif _dev in self._session_allowed_attached_devices:
+                _allowed_ct = self._session_allowed_attached_devices.get(_dev, False)
+                if _allowed_ct:
+                    if _allowed_ct < _connected_cnt:
                         logger.info(
-                            'Device "%s" whitelisted for attachment. No action required.',
+                            "%s instances of device %s allowed, %s found. "
+                            "Triggering actions.",
+                            _allowed_ct,
+                            _dev,
+                            _connected_cnt,
+                        )
+                        self._record_event(
                             _dev,
+                            _event,
+                            location,
+                            f"{_allowed_ct} allowed, {_connected_cnt} attached",
+                            True,
                         )
+                        self._actions.dispatch(_dev, _event, location)
+                    else:
+                        logger.info('Device "%s" whitelisted for attachment.', _dev)
+                        self._record_event(_dev, _event, location, "whitelisted", False)
+                else:
+                    logger.info(
+                        'Device "%s" whitelisted for attachment. No action required.',
+                        _dev,
+                    )
+                    self._record_event(_dev, _event, location, "whitelisted", False)
         if _event == "REMOVED":
-            for _dev in devices.keys():
-                if _dev in self._removal_blacklist:
+            if _dev in self._removal_blacklist:
+                logger.info(
+                    "Device %s explicitly blacklisted for removal. Triggering %s actions.",
+                    _dev,
+                    _event,
+                )
+                self._record_event(_dev, _event, location, "removal blacklist", True)
+                self._actions.dispatch(_dev, _event, location)
+            # If the removed device was attached at startup and not otherwise whitelisted
+            # remove it from the list of devices that can be attached. This prevents the device
+            # from being re-attached without triggering an action.
+            if _dev in self._unknown_devices_at_startup.keys():
+                if self._allow_unknown_removal:
+                    self._session_allowed_attached_devices.pop(_dev, None)
+                    self._revoked_startup_devices.add(_dev)
                     logger.info(
-                        "Device %s explicitly blacklisted for removal. Triggering %s actions.",
+                        "Non-whitelisted device %s was attached at startup. Removal of these "
+                        "devices is allowed.",
                         _dev,
-                        _event,
                     )
-                    self._actions.trigger_actions(_dev, _event)
-                # If the removed device was attached at startup and not otherwise whitelisted
-                # remove it from the list of devices that can be attached. This prevents the device
-                # from being re-attached without triggering an action.
-                if _dev in self._unknown_devices_at_startup.keys():
-                    if self._allow_unknown_removal:
-                        self._session_allowed_attached_devices.pop(_dev, None)
-                        logger.info(
-                            "Non-whitelisted device %s was attached at startup. Removal of these "
-                            "devices is allowed.",
-                            _dev,
-                        )
-                    else:
-                        logger.info(
-                            "Non-whitelisted device %s was attached at startup. Removal of these "
-                            "devices is not allowed. Triggering %s actions.",
-                            _dev,
-                            _event,
-                        )
-                        self._actions.trigger_actions(_dev, _event)
-                elif _dev not in self._session_allowed_devices:
+                    self._record_event(
+                        _dev, _event, location, "unknown at startup, removal allowed", False
+                    )
+                else:
                     logger.info(
-                        "Device %s is not whitelisted for removal. Triggering %s actions.",
+                        "Non-whitelisted device %s was attached at startup. Removal of these "
+                        "devices is not allowed. Triggering %s actions.",
                         _dev,
                         _event,
                     )
-                    self._actions.trigger_actions(_dev, _event)
+                    self._record_event(_dev, _event, location, "unknown at startup", True)
+                    self._actions.dispatch(_dev, _event, location)
+            elif _dev not in self._session_allowed_attached_devices:
+                logger.info(
+                    "Device %s is not whitelisted for removal. Triggering %s actions.",
+                    _dev,
+                    _event,
+                )
+                self._record_event(_dev, _event, location, "not whitelisted", True)
+                self._actions.dispatch(_dev, _event, location)
+            elif _dev not in self._removal_blacklist:
+                # Whitelisted devices can be removed, the removal_blacklist is for devices that
+                # mustn't be.
+                logger.info('Device "%s" whitelisted for removal. No action required.', _dev)
+                self._record_event(_dev, _event, location, "whitelisted", False)
+
+    def _record_event(
+        self, device: str, event_type: str, location, rule: str, triggered: bool
+    ):
+        """ Record why an event did, or didn't, trigger actions in the journal and the metrics """
+        metrics.EVENTS.inc(event_type, "true" if triggered else "false")
+        if self._journal:
+            self._journal.record(
+                "event",
+                event_type=event_type,
+                device=device,
+                location=location,
+                rule=rule,
+                triggered=triggered,
+            )
 
     @staticmethod
     def automatic_start(task: str):
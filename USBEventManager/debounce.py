@@ -0,0 +1,100 @@
+# Debouncing for devices that flap, e.g. a USB-C hub that drops off the bus and comes straight
+# back. Events for devices with a settle window are held until the window, timed from the first
+# held event, has passed. An add and a remove of the same device at the same location that
+# cancel out within the window are dropped instead of being checked against the lists. Whatever
+# is left when the window closes is handed on in the order it happened.
+#
+# Devices without a window, or with a window of 0, aren't held at all.
+import time
+import logging
+from helpers import DeviceMatcher
+
+logger = logging.getLogger(__name__)
+
+
+class EventDebouncer(object):
+    """ Hold and coalesce USBEvents per device and location """
+
+    def __init__(self, windows: dict = None, on_coalesced=None):
+        """windows == {"xxxx:xxxx": seconds}, wildcards as in the device lists.
+        on_coalesced(first, second) is called with each pair of events that cancelled out.
+        """
+        self._on_coalesced = on_coalesced
+        # {(device, location): (deadline, [USBEvent, ...])}
+        self._held: dict = {}
+        self.set_windows(windows)
+
+    @staticmethod
+    def parse_windows(windows: dict = None) -> dict:
+        """{"xxxx:xxxx": seconds} from the config, skipping invalid windows. Raises TypeError if
+        windows isn't a mapping.
+        """
+        if windows is None:
+            return {}
+        if not isinstance(windows, dict):
+            raise TypeError(f"debounce must be a mapping of device IDs to seconds, not {windows!r}")
+        _windows: dict = {}
+        for _device, _seconds in windows.items():
+            try:
+                _windows[_device] = max(float(_seconds or 0), 0.0)
+            except (TypeError, ValueError):
+                logger.warning('Ignoring invalid debounce window "%s" for %s.', _seconds, _device)
+        return _windows
+
+    def set_windows(self, windows: dict = None) -> None:
+        """ Use new settle windows. Events already held keep their deadlines. """
+        _windows: dict = self.parse_windows(windows)
+        # Swapped together, the matcher never sees a window that isn't there.
+        self._windows, self._matcher = _windows, DeviceMatcher(_windows)
+
+    def window(self, device: str) -> float:
+        """ The settle window for a device, 0 if its events aren't held """
+        _match = self._matcher.match(device)
+        if not _match:
+            return 0.0
+        return self._windows[_match]
+
+    def add(self, events: list) -> list:
+        """ Take new events, returns the ones that are ready to be handled now """
+        _ready: list = []
+        _now = time.monotonic()
+        for _event in events:
+            _key = (_event.device, _event.location)
+            _held = self._held.get(_key)
+            if _held is None:
+                _window = self.window(_event.device)
+                if not _window:
+                    _ready.append(_event)
+                    continue
+                self._held[_key] = (_now + _window, [_event])
+                continue
+            _deadline, _events = _held
+            if _events and _events[-1].event_type != _event.event_type:
+                # Added then removed, or removed then added again. Nothing has changed.
+                _first = _events.pop()
+                if self._on_coalesced:
+                    self._on_coalesced(_first, _event)
+            else:
+                _events.append(_event)
+        return _ready
+
+    def due(self) -> list:
+        """ Events whose settle window has closed, oldest window first """
+        if not self._held:
+            return []
+        _now = time.monotonic()
+        _closed = sorted(
+            (_key for _key, (_deadline, _) in self._held.items() if _deadline <= _now),
+            key=lambda k: self._held[k][0],
+        )
+        _ready: list = []
+        for _key in _closed:
+            _ready.extend(self._held.pop(_key)[1])
+        return _ready
+
+    def timeout(self, idle_timeout: float) -> float:
+        """ How long the event source can block before a window closes """
+        if not self._held:
+            return idle_timeout
+        _next = min(_deadline for _deadline, _ in self._held.values())
+        return max(min(_next - time.monotonic(), idle_timeout), 0.0)
@@ -0,0 +1,451 @@
+# Event sources feed USB add/remove events to the monitor.
+#
+# Three backends are available -
+#   * "udev"   - Linux only. Listens to kernel uevents on a netlink socket. No extra libraries required.
+#   * "libusb" - Registers a libusb hotplug callback. Requires libusb-1.0 with hotplug support.
+#   * "poll"   - Enumerates the bus every `check_interval_min` to `check_interval` seconds, polling faster
+#                after a change. Works everywhere, used as the fallback.
+# The event driven backends block in the kernel while the bus is idle so their idle cost is close to zero
+# and events are delivered as soon as the kernel or libusb sees them.
+import os
+import time
+import errno
+import ctypes
+import select
+import socket
+import logging
+import metrics
+import ctypes.util
+from collections import namedtuple
+from context import runtime
+from usb_helpers import DeviceSnapshot
+
+usb = runtime.usb
+helpers = runtime.helpers
+
+logger = logging.getLogger(__name__)
+
+# A single device being added or removed.
+#   event_type == "ADDED" | "REMOVED"
+#   device == "xxxx:xxxx"
+#   location == "<bus>-<port>.<port>...", e.g. "1-1.2", or "usb<bus>" for root hubs. None if the
+#               backend doesn't know it.
+USBEvent = namedtuple("USBEvent", ["event_type", "device", "location"], defaults=(None,))
+
+
+class EventSource(object):
+    """ Base class for USB event sources """
+
+    name: str = "base"
+
+    def open(self) -> bool:
+        """ Start listening for events, returns False if the backend isn't usable on this system """
+        return True
+
+    def seed(self, devices: DeviceSnapshot) -> None:
+        """ Tell the source which devices are attached when monitoring starts """
+        pass
+
+    def poll(self, timeout: float) -> list:
+        """ Block for up to `timeout` seconds and return a list of USBEvents """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """ Stop listening for events """
+        pass
+
+
+class AdaptiveInterval(object):
+    """Poll interval that drops to `minimum` when the bus changes and backs off to `maximum`
+    while it's idle. Changes keep it at the minimum for HOLD seconds, a flapping hub or a
+    device that enumerates in stages is followed closely.
+    """
+
+    # Growth of the interval per idle poll once the hold period is over.
+    BACKOFF: float = 1.5
+    # Seconds to stay at the minimum interval after a change.
+    HOLD: float = 2.0
+
+    def __init__(self, minimum: float, maximum: float):
+        if minimum <= 0 or minimum > maximum:
+            logger.warning(
+                "Invalid poll interval bounds, min: %s max: %s. Using %s sec.",
+                minimum,
+                maximum,
+                maximum,
+            )
+            minimum = maximum
+        self.minimum: float = minimum
+        self.maximum: float = maximum
+        self.interval: float = minimum
+        self._last_change: float = time.monotonic()
+
+    def update(self, changed: bool) -> float:
+        """ Record the result of a poll, returns the interval until the next one """
+        _now = time.monotonic()
+        if changed:
+            self._last_change = _now
+            self.interval = self.minimum
+        elif _now - self._last_change >= self.HOLD:
+            self.interval = min(self.interval * self.BACKOFF, self.maximum)
+        return self.interval
+
+
+class PollingEventSource(EventSource):
+    """Enumerate the bus at an adaptive interval and compare the result to the device registry,
+    see USBTools.scan(). The registry already holds the devices attached at startup.
+    """
+
+    name = "poll"
+
+    def __init__(self, interval: float, min_interval: float = None):
+        self._interval = AdaptiveInterval(
+            minimum=min_interval if min_interval is not None else interval,
+            maximum=interval,
+        )
+        self._next_poll: float = time.monotonic()
+
+    def poll(self, timeout: float) -> list:
+        _events: list = []
+        # Return after `timeout` even when the next enumeration is further away so the
+        # monitor loop keeps running.
+        _wait = self._next_poll - time.monotonic()
+        if _wait > timeout:
+            time.sleep(timeout)
+            return _events
+        if _wait > 0:
+            time.sleep(_wait)
+        _started = time.monotonic()
+        _current_attached_devices, _added, _removed = usb.scan()
+        metrics.POLL_SECONDS.observe(time.monotonic() - _started)
+        logger.debug(
+            "%s devices attached: %s",
+            _current_attached_devices.total,
+            _current_attached_devices,
+        )
+
+        # Every device added or removed is its own event, identified by its location. Comparing
+        # totals would miss an add and a remove in the same interval, e.g. a keyboard swapped for
+        # a keystroke injector.
+        for _device in _removed:
+            _events.append(USBEvent("REMOVED", _device.device_id, _device.location))
+        for _device in _added:
+            _events.append(USBEvent("ADDED", _device.device_id, _device.location))
+        # Intervals are measured from the start of an enumeration, not the end.
+        self._next_poll = _started + self._interval.update(changed=bool(_events))
+        return _events
+
+
+class UdevEventSource(EventSource):
+    """ Listen for kernel uevents on a netlink socket (Linux only) """
+
+    name = "udev"
+
+    # From linux/netlink.h
+    _NETLINK_KOBJECT_UEVENT = 15
+    # Multicast group 1 receives events directly from the kernel. Group 2 is used by udevd
+    # for re-broadcasts which have a different, libudev specific, framing.
+    _KERNEL_GROUP = 1
+    _RECEIVE_BUFFER = 1024 * 1024
+
+    def __init__(self):
+        self._sock = None
+
+    def open(self) -> bool:
+        if not hasattr(socket, "AF_NETLINK"):
+            logger.debug("Netlink sockets aren't supported on this platform.")
+            return False
+        try:
+            self._sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, self._NETLINK_KOBJECT_UEVENT
+            )
+            # A big receive buffer so we don't drop events during a hotplug storm.
+            self._sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self._RECEIVE_BUFFER
+            )
+            self._sock.bind((0, self._KERNEL_GROUP))
+        except OSError as e:
+            logger.debug("Unable to open a uevent netlink socket: %s", e)
+            self.close()
+            return False
+        return True
+
+    def poll(self, timeout: float) -> list:
+        _events: list = []
+        _readable, _, _ = select.select([self._sock], [], [], timeout)
+        # Drain everything that is queued so one call returns a whole burst.
+        while _readable:
+            try:
+                _data = self._sock.recv(self._RECEIVE_BUFFER)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # The receive buffer overflowed during a hotplug storm and the kernel dropped
+                # events. Enumerate the bus instead.
+                logger.warning(
+                    "Missed USB events, the uevent buffer overflowed. Rescanning the bus."
+                )
+                return self._resync()
+            _event = self._parse_uevent(_data)
+            if _event:
+                _events.append(_event)
+            _readable, _, _ = select.select([self._sock], [], [], 0)
+        return _events
+
+    def _resync(self) -> list:
+        """ Returns USBEvents for everything that changed since the registry was last updated """
+        # Whatever is still queued happened before the scan, the scan will report it.
+        while select.select([self._sock], [], [], 0)[0]:
+            try:
+                self._sock.recv(self._RECEIVE_BUFFER)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+        _, _added, _removed = usb.scan()
+        _events: list = [USBEvent("REMOVED", d.device_id, d.location) for d in _removed]
+        _events.extend(USBEvent("ADDED", d.device_id, d.location) for d in _added)
+        return _events
+
+    @staticmethod
+    def _parse_uevent(data: bytes) -> [USBEvent, None]:
+        """ Convert a raw kernel uevent to a USBEvent, ignore anything that isn't a USB device """
+        # A uevent is "<action>@<devpath>\0KEY=VALUE\0KEY=VALUE\0..."
+        _fields: dict = {}
+        for _field in data.split(b"\0")[1:]:
+            _key, _sep, _value = _field.partition(b"=")
+            if _sep:
+                _fields[_key] = _value
+        if _fields.get(b"SUBSYSTEM") != b"usb":
+            return None
+        # Interfaces (DEVTYPE=usb_interface) are reported too, we only want the device.
+        if _fields.get(b"DEVTYPE") != b"usb_device":
+            return None
+        _action = _fields.get(b"ACTION")
+        if _action == b"add":
+            _event_type = "ADDED"
+        elif _action == b"remove":
+            _event_type = "REMOVED"
+        else:
+            return None
+        # PRODUCT is "<vid>/<pid>/<bcdDevice>" in unpadded hex.
+        try:
+            _vid, _pid, _ = _fields[b"PRODUCT"].split(b"/")
+            _device = f"{int(_vid, 16):04x}:{int(_pid, 16):04x}"
+        except (KeyError, ValueError):
+            logger.debug("Ignoring malformed uevent: %s", data)
+            return None
+        _location = os.path.basename(_fields.get(b"DEVPATH", b"").decode())
+        return USBEvent(_event_type, _device, _location or None)
+
+    def close(self) -> None:
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+
+class _LibUSBDeviceDescriptor(ctypes.Structure):
+    """ struct libusb_device_descriptor """
+
+    _fields_ = [
+        ("bLength", ctypes.c_uint8),
+        ("bDescriptorType", ctypes.c_uint8),
+        ("bcdUSB", ctypes.c_uint16),
+        ("bDeviceClass", ctypes.c_uint8),
+        ("bDeviceSubClass", ctypes.c_uint8),
+        ("bDeviceProtocol", ctypes.c_uint8),
+        ("bMaxPacketSize0", ctypes.c_uint8),
+        ("idVendor", ctypes.c_uint16),
+        ("idProduct", ctypes.c_uint16),
+        ("bcdDevice", ctypes.c_uint16),
+        ("iManufacturer", ctypes.c_uint8),
+        ("iProduct", ctypes.c_uint8),
+        ("iSerialNumber", ctypes.c_uint8),
+        ("bNumConfigurations", ctypes.c_uint8),
+    ]
+
+
+class _Timeval(ctypes.Structure):
+    """ struct timeval """
+
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long)]
+
+
+# int (*libusb_hotplug_callback_fn)(libusb_context *ctx, libusb_device *device,
+#                                   libusb_hotplug_event event, void *user_data)
+_HOTPLUG_CALLBACK = ctypes.CFUNCTYPE(
+    ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p
+)
+
+
+class LibUSBHotplugEventSource(EventSource):
+    """ Receive events from a libusb hotplug callback """
+
+    name = "libusb"
+
+    # From libusb.h
+    _CAP_HAS_HOTPLUG = 0x0001
+    _EVENT_DEVICE_ARRIVED = 0x01
+    _EVENT_DEVICE_LEFT = 0x02
+    _HOTPLUG_MATCH_ANY = -1
+    _MAX_PORT_DEPTH = 7
+
+    def __init__(self):
+        self._lib = None
+        self._ctx = ctypes.c_void_p()
+        self._handle = ctypes.c_int()
+        self._pending: list = []
+        # Keep a reference to the callback, if it's garbage collected libusb will call into freed memory.
+        self._callback = _HOTPLUG_CALLBACK(self._on_hotplug)
+
+    def open(self) -> bool:
+        _path = ctypes.util.find_library("usb-1.0") or ctypes.util.find_library(
+            "libusb-1.0"
+        )
+        if not _path:
+            logger.debug("Unable to find libusb-1.0.")
+            return False
+        try:
+            self._lib = ctypes.CDLL(_path)
+        except OSError as e:
+            logger.debug("Unable to load %s: %s", _path, e)
+            return False
+        self._declare_functions()
+        if self._lib.libusb_init(ctypes.byref(self._ctx)) != 0:
+            logger.debug("libusb_init failed.")
+            self._lib = None
+            return False
+        if not self._lib.libusb_has_capability(self._CAP_HAS_HOTPLUG):
+            logger.debug("This build of libusb doesn't support hotplug.")
+            self.close()
+            return False
+        _result = self._lib.libusb_hotplug_register_callback(
+            self._ctx,
+            self._EVENT_DEVICE_ARRIVED | self._EVENT_DEVICE_LEFT,
+            0,
+            self._HOTPLUG_MATCH_ANY,
+            self._HOTPLUG_MATCH_ANY,
+            self._HOTPLUG_MATCH_ANY,
+            self._callback,
+            None,
+            ctypes.byref(self._handle),
+        )
+        if _result != 0:
+            logger.debug("libusb_hotplug_register_callback failed: %s", _result)
+            self.close()
+            return False
+        return True
+
+    def _declare_functions(self) -> None:
+        """ Declare the libusb signatures we use, pointers are truncated without them """
+        _lib = self._lib
+        _lib.libusb_init.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
+        _lib.libusb_exit.argtypes = [ctypes.c_void_p]
+        _lib.libusb_has_capability.argtypes = [ctypes.c_uint32]
+        _lib.libusb_hotplug_register_callback.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            _HOTPLUG_CALLBACK,
+            ctypes.c_void_p,
+            ctypes.POINTER(ctypes.c_int),
+        ]
+        _lib.libusb_hotplug_deregister_callback.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_int,
+        ]
+        _lib.libusb_handle_events_timeout_completed.argtypes = [
+            ctypes.c_void_p,
+            ctypes.POINTER(_Timeval),
+            ctypes.POINTER(ctypes.c_int),
+        ]
+        _lib.libusb_get_device_descriptor.argtypes = [
+            ctypes.c_void_p,
+            ctypes.POINTER(_LibUSBDeviceDescriptor),
+        ]
+        _lib.libusb_get_bus_number.argtypes = [ctypes.c_void_p]
+        _lib.libusb_get_bus_number.restype = ctypes.c_uint8
+        _lib.libusb_get_port_numbers.argtypes = [
+            ctypes.c_void_p,
+            ctypes.POINTER(ctypes.c_uint8),
+            ctypes.c_int,
+        ]
+
+    def _on_hotplug(self, ctx, dev, event, user_data) -> int:
+        """ Called by libusb, must not block. Queues the event for poll() """
+        _descriptor = _LibUSBDeviceDescriptor()
+        if self._lib.libusb_get_device_descriptor(dev, ctypes.byref(_descriptor)) != 0:
+            return 0
+        _device = f"{_descriptor.idVendor:04x}:{_descriptor.idProduct:04x}"
+        _ports = (ctypes.c_uint8 * self._MAX_PORT_DEPTH)()
+        _port_cnt = self._lib.libusb_get_port_numbers(
+            dev, _ports, self._MAX_PORT_DEPTH
+        )
+        # Same format as USBTools.pyusb_location()
+        _bus = self._lib.libusb_get_bus_number(dev)
+        if _port_cnt > 0:
+            _location = f"{_bus}-" + ".".join(str(p) for p in _ports[:_port_cnt])
+        else:
+            _location = f"usb{_bus}"
+        if event == self._EVENT_DEVICE_ARRIVED:
+            self._pending.append(USBEvent("ADDED", _device, _location))
+        elif event == self._EVENT_DEVICE_LEFT:
+            self._pending.append(USBEvent("REMOVED", _device, _location))
+        # Returning 0 keeps the callback registered.
+        return 0
+
+    def poll(self, timeout: float) -> list:
+        _seconds = int(timeout)
+        _timeout = _Timeval(_seconds, int((timeout - _seconds) * 1000000))
+        # Callbacks are run from inside libusb_handle_events_*, on this thread.
+        self._lib.libusb_handle_events_timeout_completed(
+            self._ctx, ctypes.byref(_timeout), None
+        )
+        _events = self._pending
+        self._pending = []
+        return _events
+
+    def close(self) -> None:
+        if self._lib:
+            if self._handle.value:
+                self._lib.libusb_hotplug_deregister_callback(self._ctx, self._handle)
+            self._lib.libusb_exit(self._ctx)
+            self._lib = None
+
+
+def get_event_source(name: str, interval: float, min_interval: float = None) -> EventSource:
+    """ Return an opened event source. "auto" picks the best backend available on this platform """
+    _sources: dict = {
+        "udev": UdevEventSource,
+        "libusb": LibUSBHotplugEventSource,
+    }
+    if name == "auto":
+        if helpers.platform == "Linux":
+            _candidates = ["udev", "libusb"]
+        else:
+            _candidates = ["libusb"]
+    elif name in _sources:
+        _candidates = [name]
+    else:
+        if name != "poll":
+            logger.warning('Unknown event source "%s", falling back to polling.', name)
+        _candidates = []
+
+    for _candidate in _candidates:
+        _source = _sources[_candidate]()
+        if _source.open():
+            logger.info("Using the %s event source.", _source.name)
+            return _source
+        logger.warning(
+            "The %s event source isn't available on this system.", _candidate
+        )
+    logger.info(
+        "Using the poll event source, interval: %s to %s sec.",
+        min_interval if min_interval is not None else interval,
+        interval,
+    )
+    _source = PollingEventSource(interval=interval, min_interval=min_interval)
+    _source.open()
+    return _source
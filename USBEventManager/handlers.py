@@ -0,0 +1,161 @@
+# Persistent handlers are long running custom commands that are started once, when monitoring
+# starts, then receive every event over their stdin. This avoids starting a shell and the
+# command's interpreter for every event.
+#
+# Protocol, one JSON object per line -
+#   USBEventManager -> handler: {"USBEVENTMANAGER_EVENT_TYPE": "ADDED", "USBEVENTMANAGER_DEVICE_ID": "xxxx:xxxx",
+#                                "USBEVENTMANAGER_PLATFORM": "Linux"}
+#   handler -> USBEventManager: {"status": 0, "output": "anything"}
+# A non-zero status is treated like a custom command returning a non-zero exit code.
+# See errata/custom_command_examples/handler.py.
+import json
+import queue
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+# custom_commands entries starting with this are sent to the persistent handler with that name.
+HANDLER_PREFIX = "handler:"
+
+
+class PersistentHandler(object):
+    """ A single long running handler process """
+
+    def __init__(self, name: str, cmd: str, timeout=0):
+        self.name: str = name
+        self.cmd: str = cmd
+        self.timeout = timeout or None
+        self._process = None
+        self._replies: queue.Queue = queue.Queue()
+        # One event at a time per handler, replies are matched to requests by order.
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """ Start the handler process """
+        logger.debug('Starting persistent handler "%s": %s', self.name, self.cmd)
+        try:
+            self._process = subprocess.Popen(
+                self.cmd,
+                shell=True,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                bufsize=1,
+            )
+        except OSError as e:
+            logger.error('Unable to start persistent handler "%s": %s', self.name, e)
+            self._process = None
+            return False
+        # Replies are read on a thread, select() doesn't work with pipes on Windows.
+        self._replies = queue.Queue()
+        threading.Thread(
+            target=self._read_replies,
+            args=(self._process, self._replies),
+            name=f"handler-{self.name}",
+            daemon=True,
+        ).start()
+        return True
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def send(self, env: dict) -> [int, str]:
+        """ Send an event to the handler and wait for its reply. Returns (status, output) """
+        with self._lock:
+            if not self.running:
+                if self._process is not None:
+                    logger.warning(
+                        'Persistent handler "%s" exited with %s, restarting it.',
+                        self.name,
+                        self._process.returncode,
+                    )
+                if not self.start():
+                    return 1, ""
+            try:
+                self._process.stdin.write(json.dumps(env) + "\n")
+                self._process.stdin.flush()
+            except OSError as e:
+                logger.error('Unable to send to persistent handler "%s": %s', self.name, e)
+                self.stop()
+                return 1, ""
+            try:
+                _reply = self._replies.get(timeout=self.timeout)
+            except queue.Empty:
+                logger.error(
+                    'Persistent handler "%s" timed out. Timeout: %s sec.',
+                    self.name,
+                    self.timeout,
+                )
+                # We can't match up late replies with requests, start over.
+                self.stop()
+                return 1, ""
+            if _reply is None:
+                logger.error('Persistent handler "%s" exited.', self.name)
+                return 1, ""
+            return self._parse_reply(_reply)
+
+    def _parse_reply(self, reply: str) -> [int, str]:
+        try:
+            _reply = json.loads(reply)
+            return int(_reply.get("status", 0)), str(_reply.get("output", ""))
+        except (ValueError, TypeError, AttributeError):
+            logger.error(
+                'Persistent handler "%s" sent an invalid reply: %s', self.name, reply
+            )
+            return 1, reply
+
+    @staticmethod
+    def _read_replies(process, replies: queue.Queue):
+        """ Queue each line from the handler's stdout, then None when it exits """
+        for _line in process.stdout:
+            replies.put(_line.rstrip("\n"))
+        replies.put(None)
+
+    def stop(self):
+        """ Stop the handler process """
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process = None
+
+
+class HandlerPool(object):
+    """ The persistent handlers from the config file, {name: command} """
+
+    def __init__(self, handlers: dict, timeout=0):
+        self._handlers: dict = {}
+        for _name, _cmd in (handlers or {}).items():
+            self._handlers[_name] = PersistentHandler(
+                name=_name, cmd=_cmd, timeout=timeout
+            )
+
+    @staticmethod
+    def is_handler(cmd) -> bool:
+        return isinstance(cmd, str) and cmd.startswith(HANDLER_PREFIX)
+
+    def start(self):
+        """ Start every handler, this is where we pay the startup cost """
+        for _handler in self._handlers.values():
+            if _handler.start():
+                logger.info('Persistent handler "%s" started.', _handler.name)
+
+    def send(self, cmd: str, env: dict) -> [int, str]:
+        """ Send an event to the handler named by a "handler:<name>" custom command """
+        _name = cmd[len(HANDLER_PREFIX) :]
+        _handler = self._handlers.get(_name)
+        if _handler is None:
+            logger.error('Persistent handler "%s" isn\'t configured.', _name)
+            return 1, ""
+        return _handler.send(env)
+
+    def stop(self):
+        for _handler in self._handlers.values():
+            _handler.stop()
@@ -6,60 +6,154 @@ import logging
 import platform
 from pathlib import Path
 
-# We use ruamel.yaml so we can update the config file while maintaining
-# the comments, https://yaml.readthedocs.io/en/latest/index.html.
-# https://github.com/yaml/pyyaml/issues/90
-from ruamel.yaml import YAML
-
 logger = logging.getLogger(__name__)
 
 
 class Helpers(object):
     def __init__(self):
 
-        _config_file: Path = Path("usbeventmanager.yml")
-        _config_file_parent = Path("/etc")
+        self._config_file: Path = Path("usbeventmanager.yml")
+        self._config_file_parent = Path("/etc")
         self.app_path: Path = Path("~/.usbeventmanager/")
         self.app_path: Path = self.app_path.expanduser()
-        self.config_file_path: Path = _config_file_parent.joinpath(_config_file)
+        self.config_file_path: Path = self._config_file_parent.joinpath(
+            self._config_file
+        )
+        # The config file is loaded the first time it's used, see the config property.
+        self.app_config = None
+        self._compiled = None
+        self._platform = None
+
+    def _load_config(self):
+        """ Load the config file, copying the default one into place if it's missing """
         # Copy the config file to the appropriate path
         if not self.config_file_path.is_file():
             import shutil
 
-            logger.info("Copying %s to %s.", _config_file, self.app_path)
-            _config_file_parent.mkdir(exist_ok=True)
-            shutil.copy(_config_file, self.config_file_path)
-        self.app_config = self._load_yaml_file(path=self.config_file_path)
+            logger.info("Copying %s to %s.", self._config_file, self.app_path)
+            self._config_file_parent.mkdir(exist_ok=True)
+            shutil.copy(self._config_file, self.config_file_path)
+
+        self._compiled = self._compile_config()
+        return self._compiled["config"]
+
+    def _compile_config(self) -> dict:
+        """ Return the compiled config, from the cache if the config file hasn't changed since it was built """
+        from config_cache import ConfigCache, compile_config
+
+        _cache = ConfigCache(config_path=self.config_file_path)
+        _compiled = _cache.load(platform=self.platform)
+        if _compiled is None:
+            _fingerprint = _cache.fingerprint()
+            _config = self._load_yaml_file(path=self.config_file_path)
+            _compiled = compile_config(config=_config, platform=self.platform)
+            _cache.save(compiled=_compiled, fingerprint=_fingerprint)
+        return _compiled
+
+    def reload_config(self) -> [dict, None]:
+        """Re-read the config file after it's changed and return the new compiled config.
+        Returns None, keeping the current config, if the file is missing or can't be parsed.
+        """
+        if not self.config_file_path.is_file():
+            logger.error("%s is missing, keeping the current config.", self.config_file_path)
+            return None
+        try:
+            _compiled = self._compile_config()
+        except Exception as e:
+            logger.error(
+                "Unable to load %s, keeping the current config: %s",
+                self.config_file_path,
+                e,
+            )
+            return None
+        self._compiled = _compiled
+        self.app_config = _compiled["config"]
+        return _compiled
 
     @staticmethod
     def exiter(code):
         """ Exit tasks """
         sys.exit(code)
 
-    def update_config(self, data) -> None:
-        """ Update the configuration """
+    def update_config(self, data: dict) -> None:
+        """Update the configuration. data is {key: new value} for any number of top level keys,
+        all of them are applied in one parse/dump and written atomically.
+        """
         logger.debug("Updating the configuration.")
         _data = data
         logger.debug("Update is: %s", _data)
-        _key = next(iter(_data))
         _config = self._load_yaml_file(path=self.config_file_path)
-
-        # We need to do some work to maintain the comments.
-        # https://stackoverflow.com/questions/57582926/preserving-following-comments-when-removing-last-dict-key-with-ruamel-yaml
-        _comment_index = len(_config[_key])
-        _comment_index = _comment_index - 1
-        _comment_to_be_saved = copy.deepcopy(_config[_key].ca)
-        _comment_to_be_saved = _comment_to_be_saved.items[_comment_index]
-        _config[_key].clear()
-        for i in _data[_key]:
-            _config[_key].append(i)
-        _comment_index = len(_config[_key])
-        _comment_index = _comment_index - 1
-        _config[_key].ca.items[_comment_index] = _comment_to_be_saved
+        for _key, _value in _data.items():
+            # We need to do some work to maintain the comments. ruamel.yaml attaches the comment
+            # lines that follow a block to the block's last item, move them to the new last item.
+            # https://stackoverflow.com/questions/57582926/preserving-following-comments-when-removing-last-dict-key-with-ruamel-yaml
+            _comment = self._pop_trailing_comment(_config.get(_key))
+            if not _value:
+                # Written as an empty key, like the unused options in the default config.
+                _config[_key] = None
+                if _comment is not None:
+                    _config.ca.items[_key] = [None, None, _comment, None]
+                continue
+            if isinstance(_config.get(_key), (list, dict)):
+                self._replace_in_place(_config[_key], _value)
+            else:
+                _config[_key] = _value
+            if _comment is not None:
+                self._set_trailing_comment(_config[_key], _comment)
         self._dump_yaml_to_file(path=self.config_file_path, data=_config)
 
+    @staticmethod
+    def _replace_in_place(node, value) -> None:
+        """ Replace the contents of a list or mapping, unchanged mapping entries keep their comments """
+        if isinstance(node, list):
+            node.clear()
+            node.extend(value)
+            return
+        for _k in [k for k in node if k not in value]:
+            del node[_k]
+        for _k, _v in value.items():
+            if _k not in node or node[_k] != _v:
+                node[_k] = _v
+
+    @staticmethod
+    def _last_item(node) -> tuple:
+        """ (container, key) for the innermost last item of a list or mapping from the config file """
+        _container, _key = None, None
+        while isinstance(node, (list, dict)) and len(node) and hasattr(node, "ca"):
+            _container = node
+            _key = len(node) - 1 if isinstance(node, list) else list(node)[-1]
+            node = node[_key]
+        return _container, _key
+
+    def _pop_trailing_comment(self, node):
+        """ Detach and return the comment that follows a block, or None """
+        _container, _key = self._last_item(node)
+        if _container is None:
+            return None
+        _entry = _container.ca.items.pop(_key, None) or []
+        # Sequence items keep it in slot 0, mapping values in slot 2.
+        for _comment in _entry[0:1] + _entry[2:3]:
+            if _comment is not None:
+                return _comment
+        return None
+
+    def _set_trailing_comment(self, node, comment) -> None:
+        _container, _key = self._last_item(node)
+        if _container is None:
+            return
+        if isinstance(_container, list):
+            _container.ca.items[_key] = [comment, None, None, None]
+        else:
+            _container.ca.items[_key] = [None, None, comment, None]
+
     def _load_yaml_file(self, path: Path):
         """ Load a YAML file """
+        # We use ruamel.yaml so we can update the config file while maintaining
+        # the comments, https://yaml.readthedocs.io/en/latest/index.html.
+        # https://github.com/yaml/pyyaml/issues/90
+        # Imported here, it's slow to import and not needed when the config cache is used.
+        from ruamel.yaml import YAML
+
         yaml = YAML()
         _path: Path = Path(path)
         yaml.typ = "safe"
@@ -76,34 +170,45 @@ class Helpers(object):
 
     @staticmethod
     def _dump_yaml_to_file(path: Path, data: dict) -> None:
+        from ruamel.yaml import YAML
+
         yaml = YAML()
         yaml.indent(mapping=3, offset=2)
         _data = data
         _path: Path = Path(path)
         logger.debug("Dumping %s to disk.", str(_path))
-        with open(_path, "w") as f:
-            yaml.dump(data, f)
+        # Write a temp file next to the config and rename it into place, a crash part way
+        # through leaves either the old or the new config, never half of one.
+        import tempfile
+
+        _fd, _tmp_path = tempfile.mkstemp(dir=_path.parent, prefix=_path.name + ".")
+        try:
+            with os.fdopen(_fd, "w") as f:
+                yaml.dump(_data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            if _path.exists():
+                _stat = os.stat(_path)
+                os.chmod(_tmp_path, _stat.st_mode & 0o7777)
+                if hasattr(os, "chown") and Helpers._check_root():
+                    os.chown(_tmp_path, _stat.st_uid, _stat.st_gid)
+            os.replace(_tmp_path, _path)
+        except BaseException:
+            os.unlink(_tmp_path)
+            raise
+        # Make the rename itself durable.
+        if hasattr(os, "O_DIRECTORY"):
+            _dir_fd = os.open(_path.parent, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(_dir_fd)
+            finally:
+                os.close(_dir_fd)
 
     @staticmethod
     def usb_device_id_match(config_devices: dict, device: str) -> [str, bool]:
         """ Match USB devices to device ID strings in the config file and return the value from the config file. """
-        _dev_id = device
-        _config_devices = config_devices
-        for _cfg_devid in _config_devices.keys():
-            # If the device ID in the config file == the actual device id or
-            # if the device ID in the config file is `*:*` return the match.
-            if _cfg_devid == _dev_id or _cfg_devid == "*:*":
-                return _cfg_devid
-            # Split the devices IDs from the config file and actual device.
-            _cfg_vid, _cfg_pid = _cfg_devid.split(":")
-            _dev_vid, _dev_pid = _dev_id.split(":")
-            # Match the manufacturer ID
-            if _cfg_vid == "*" and _cfg_pid == _dev_pid:
-                return _cfg_devid
-            # Match the product ID
-            if _cfg_pid == "*" and _cfg_vid == _dev_vid:
-                return _cfg_devid
-        return False
+        # One off lookups, callers that match repeatedly should keep a DeviceMatcher.
+        return DeviceMatcher(config_devices).match(device)
 
     @staticmethod
     def aggregate_list_dupes(lst: list) -> dict:
@@ -207,12 +312,30 @@ class Helpers(object):
 
     @property
     def platform(self) -> str:
-        return self._get_platform()
+        # The platform can't change while we're running.
+        if self._platform is None:
+            self._platform = self._get_platform()
+        return self._platform
 
     @property
     def config(self):
+        if self.app_config is None:
+            self.app_config = self._load_config()
         return self.app_config
 
+    @property
+    def compiled(self) -> dict:
+        """ The config with the lists aggregated, matchers built and actions resolved, see config_cache.py """
+        if self._compiled is None:
+            self.app_config = self._load_config()
+        return self._compiled
+
+    @property
+    def log_dir(self) -> Path:
+        """ log_path from the config file, relative to app_path """
+        _log_path = str(self.config.get("log_path") or "logs")
+        return self.app_path.joinpath(_log_path.lstrip("/\\"))
+
     @property
     def config_path(self) -> Path:
         return self.config_file_path
@@ -220,3 +343,56 @@ class Helpers(object):
     @property
     def is_root(self) -> bool:
         return self._check_root()
+
+
+class DeviceMatcher(object):
+    """Precompiled lookup table for matching USB device IDs against device IDs from the config file.
+
+    Device IDs from the config file are split once into four tables -
+      * exact IDs, e.g. "xxxx:xxxx"
+      * vendor wildcards, e.g. "xxxx:*", keyed by the vendor ID
+      * product wildcards, e.g. "*:xxxx", keyed by the product ID
+      * "*:*"
+    A lookup is at most four hash lookups regardless of the size of the config. When more than one
+    config entry matches the one listed first in the config file wins, the same as reading the list
+    from the top down.
+    """
+
+    def __init__(self, config_devices):
+        self._exact: dict = {}
+        self._vendor: dict = {}
+        self._product: dict = {}
+        self._any = None
+
+        # Each table maps to (position in the config, config device ID).
+        for _index, _cfg_devid in enumerate(config_devices or {}):
+            _entry = (_index, _cfg_devid)
+            if _cfg_devid == "*:*":
+                if self._any is None:
+                    self._any = _entry
+                continue
+            try:
+                _cfg_vid, _cfg_pid = _cfg_devid.split(":")
+            except ValueError:
+                logger.warning('Ignoring invalid device ID "%s".', _cfg_devid)
+                continue
+            self._exact.setdefault(_cfg_devid, _entry)
+            if _cfg_vid == "*":
+                self._product.setdefault(_cfg_pid, _entry)
+            elif _cfg_pid == "*":
+                self._vendor.setdefault(_cfg_vid, _entry)
+
+    def match(self, device: str) -> [str, bool]:
+        """ Return the config device ID that matches the device or False """
+        _dev_vid, _, _dev_pid = device.partition(":")
+        _best = self._exact.get(device)
+        for _entry in (
+            self._vendor.get(_dev_vid),
+            self._product.get(_dev_pid),
+            self._any,
+        ):
+            if _entry is not None and (_best is None or _entry[0] < _best[0]):
+                _best = _entry
+        if _best is None:
+            return False
+        return _best[1]
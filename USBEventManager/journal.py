@@ -0,0 +1,260 @@
+# The event journal, an append-only record of every event and what we did about it. It's meant
+# to survive the shutdown or reboot USBEventManager itself triggers, so it's written with
+# O_APPEND to a file opened when monitoring starts and, by default, fsynced after every record.
+#
+# One JSON object per line -
+#   {"ts": 1700000000.123, "pid": 1234, "kind": "event", ...}
+# kind == "start"   - Monitoring started.
+#         "event"   - A device was added or removed. "rule" is why the lists did, or didn't,
+#                     trigger actions.
+#         "actions" - Actions queued for an event. "rule" is the device_specific entry that
+#                     matched, or "default". Written before any action runs, and synced before
+#                     the power phase.
+#         "result"  - {action: {"status": status, "duration": sec.}}, status is done, failed,
+#                     timeout, skipped, folded (covered by a run already in progress for
+#                     another event) or cooldown (ran within its action_cooldowns, not run again).
+#         "coalesced" - An add and a remove that cancelled out within the device's debounce
+#                     window, "events" in the order they happened. Neither was checked.
+#         "stop"    - Monitoring stopped.
+# The journal is rotated when it's larger than journal_max_mb, log_retention old journals are kept.
+import os
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_NAME = "events.jsonl"
+# Every kind of record, see above.
+RECORD_KINDS = ("start", "event", "actions", "result", "coalesced", "stop")
+# always  - fsync every record.
+# actions - Only fsync "actions" and "result" records.
+# never   - Leave it to the OS.
+# Either way "actions" records aren't synced when they're written, that would hold up containment.
+# They're synced just before the power phase, see sync().
+FSYNC_POLICIES = ("always", "actions", "never")
+
+
+class EventJournal(object):
+    """ Append JSON lines records to the journal """
+
+    def __init__(
+        self,
+        directory: Path,
+        fsync: str = "always",
+        retention: int = 10,
+        max_bytes: int = 10 * 1024 * 1024,
+    ):
+        self.path: Path = Path(directory).joinpath(JOURNAL_NAME)
+        if fsync not in FSYNC_POLICIES:
+            logger.warning('Unknown journal_fsync "%s", using "always".', fsync)
+            fsync = "always"
+        self._fsync: str = fsync
+        self._retention: int = max(int(retention), 0)
+        self._max_bytes: int = max_bytes
+        self._fd = None
+        self._size: int = 0
+        self._pid: int = os.getpid()
+        # The monitor and dispatch threads both write.
+        self._lock = threading.Lock()
+
+    def open(self) -> bool:
+        """ Open the journal for appending, returns False if it can't be opened """
+        try:
+            self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            self._open()
+        except OSError as e:
+            logger.error("Unable to open the event journal %s: %s", self.path, e)
+            return False
+        if self._size >= self._max_bytes:
+            self._rotate()
+        logger.debug("Writing the event journal to %s.", self.path)
+        return True
+
+    def _open(self):
+        _flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_CLOEXEC", 0)
+        self._fd = os.open(self.path, _flags, 0o600)
+        self._size = os.fstat(self._fd).st_size
+
+    def record(self, kind: str, sync: bool = None, **fields) -> None:
+        """Append a record, journal problems are logged but never stop an event being handled.
+        sync == False to leave syncing it to a later sync(), None to follow the fsync policy.
+        """
+        if self._fd is None:
+            return
+        _record: dict = {"ts": round(time.time(), 6), "pid": self._pid, "kind": kind}
+        _record.update(fields)
+        _line = (json.dumps(_record, default=str, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            try:
+                # A single write() with O_APPEND, records aren't interleaved or torn by a writer
+                # that's killed part way through a record.
+                _written = os.write(self._fd, _line)
+                while _written < len(_line):
+                    _written += os.write(self._fd, _line[_written:])
+                self._size += len(_line)
+                if sync is not False and (
+                    self._fsync == "always"
+                    or (self._fsync == "actions" and kind in ("actions", "result"))
+                ):
+                    self._sync()
+                if self._size >= self._max_bytes:
+                    self._rotate()
+            except OSError as e:
+                logger.error("Unable to write to the event journal: %s", e)
+
+    def sync(self) -> None:
+        """ Flush the records written so far to disk, unless the fsync policy is never """
+        if self._fsync == "never":
+            return
+        with self._lock:
+            if self._fd is None:
+                return
+            try:
+                self._sync()
+            except OSError as e:
+                logger.error("Unable to sync the event journal: %s", e)
+
+    def _sync(self):
+        getattr(os, "fdatasync", os.fsync)(self._fd)
+
+    def _rotate(self):
+        """ events.jsonl -> events.jsonl.1 -> ... -> events.jsonl.<retention> """
+        os.close(self._fd)
+        self._fd = None
+        try:
+            for _i in range(self._retention, 0, -1):
+                _older = self.path.with_name(f"{JOURNAL_NAME}.{_i}")
+                _newer = (
+                    self.path.with_name(f"{JOURNAL_NAME}.{_i - 1}") if _i > 1 else self.path
+                )
+                if _newer.exists():
+                    os.replace(_newer, _older)
+            if not self._retention:
+                self.path.unlink()
+        finally:
+            self._open()
+        logger.debug("Rotated the event journal.")
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+class JournalReader(object):
+    """ Read the journal, and the rotated journals, back oldest record first """
+
+    def __init__(self, directory: Path):
+        self.path: Path = Path(directory).joinpath(JOURNAL_NAME)
+
+    def files(self) -> list:
+        """ The journal files, oldest first """
+        _rotated: list = []
+        for _file in self.path.parent.glob(f"{JOURNAL_NAME}.*"):
+            _suffix = _file.name[len(JOURNAL_NAME) + 1 :]
+            if _suffix.isdigit():
+                _rotated.append((int(_suffix), _file))
+        _files = [f for _, f in sorted(_rotated, reverse=True)]
+        if self.path.exists():
+            _files.append(self.path)
+        return _files
+
+    @staticmethod
+    def _last_ts(file: Path) -> float:
+        """ Timestamp of the last record in a file, read from the end of the file """
+        with open(file, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            _end = f.tell()
+            f.seek(max(_end - 64 * 1024, 0))
+            for _line in reversed(f.read().splitlines()):
+                try:
+                    return float(json.loads(_line)["ts"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return 0.0
+
+    def records(
+        self,
+        since: float = None,
+        until: float = None,
+        device: str = None,
+        event_type: str = None,
+        kind: str = None,
+    ):
+        """ Yield the records that match every filter given """
+        # Cheap substring checks before a line is parsed, most lines don't match a device.
+        _device = f'"device":"{device}"'.encode() if device else None
+        _kind = f'"kind":"{kind}"'.encode() if kind else None
+        for _file in self.files():
+            if since is not None and self._last_ts(_file) < since:
+                # Everything in this file is older than we're interested in.
+                continue
+            with open(_file, "rb") as f:
+                for _line in f:
+                    if _device and _device not in _line:
+                        continue
+                    if _kind and _kind not in _line:
+                        continue
+                    try:
+                        _record: dict = json.loads(_line)
+                    except ValueError:
+                        # A record torn by a crash, skip it.
+                        continue
+                    _ts = _record.get("ts", 0)
+                    if since is not None and _ts < since:
+                        continue
+                    if until is not None and _ts > until:
+                        return
+                    if event_type and _record.get("event_type") != event_type:
+                        continue
+                    yield _record
+
+
+def format_record(record: dict) -> str:
+    """ A journal record as one line of text """
+    _ts = record.get("ts", 0)
+    _when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(_ts))
+    _when += f".{int(_ts % 1 * 1000):03d}"
+    _kind = record.get("kind", "")
+    _device = record.get("device", "")
+    if record.get("location"):
+        _device = f"{_device} at {record['location']}"
+    if _kind == "event":
+        _action = "triggered actions" if record.get("triggered") else "no action"
+        return f"{_when} {record.get('event_type')} {_device}: {record.get('rule')}, {_action}"
+    if _kind == "actions":
+        _actions = ", ".join(record.get("actions") or []) or "none"
+        return (
+            f"{_when} {record.get('event_type')} {_device}: rule {record.get('rule')}, "
+            f"queued {_actions}"
+        )
+    if _kind == "result":
+        _results = ", ".join(
+            f"{a} {r.get('status')} ({r.get('duration')} sec.)"
+            for a, r in (record.get("results") or {}).items()
+        )
+        return f"{_when} {record.get('event_type')} {_device}: {_results or 'nothing ran'}"
+    if _kind == "coalesced":
+        _events = " then ".join(e.lower() for e in record.get("events") or [])
+        return f"{_when} {_device}: {_events} within the debounce window, ignored"
+    _details = " ".join(
+        f"{k}={v}" for k, v in record.items() if k not in ("ts", "pid", "kind")
+    )
+    return f"{_when} {_kind} (pid {record.get('pid')}) {_details}".rstrip()
+
+
+def parse_time(value: str) -> [float, None]:
+    """Seconds since the epoch, or an ISO 8601 date/time such as "2021-01-31 13:00", in local time.
+    Raises ValueError for anything else.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
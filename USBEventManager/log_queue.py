@@ -0,0 +1,94 @@
+# Logging goes through a bounded queue to a listener thread that does the formatting and the
+# writing. A slow terminal, journald back-pressure or a remote syslog then slows down the
+# listener, never the thread that's disabling a device or shutting the system down.
+#
+# When the queue fills up records are dropped instead of waiting for space, DEBUG records first.
+# They're only queued while the queue is less than DEBUG_SHARE full, everything else until it's
+# full. The number of records dropped is logged once there's room again.
+import copy
+import queue
+import atexit
+import logging
+import logging.handlers
+
+QUEUE_SIZE: int = 10000
+# DEBUG records are dropped once the queue is this full.
+DEBUG_SHARE: float = 0.5
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """ A QueueHandler that never blocks and leaves the formatting to the listener """
+
+    def __init__(self, log_queue: queue.Queue, debug_share: float = DEBUG_SHARE):
+        super().__init__(log_queue)
+        self._debug_limit: int = int(log_queue.maxsize * debug_share)
+        self.dropped: int = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Unlike QueueHandler.prepare() the message isn't formatted here, on the logging
+        thread. Containers in the args are copied, they may change before the listener gets
+        to them, which is much cheaper than formatting them.
+        """
+        if isinstance(record.args, tuple):
+            record.args = tuple(_copy_arg(a) for a in record.args)
+        elif isinstance(record.args, dict):
+            record.args = copy.copy(record.args)
+        if record.exc_info:
+            # Tracebacks hold references to frames, keep the text instead.
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # handle() normally holds the lock already, it's a RLock. Take it anyway so the count and
+        # its reset are never interleaved, whoever calls us.
+        with self.lock:
+            if record.levelno <= logging.DEBUG and self.queue.qsize() >= self._debug_limit:
+                self.dropped += 1
+                return
+            try:
+                if self.dropped:
+                    _dropped = logging.makeLogRecord(
+                        {
+                            "name": __name__,
+                            "levelno": logging.WARNING,
+                            "levelname": "WARNING",
+                            "msg": "Logging fell behind, %s log records were dropped.",
+                            "args": (self.dropped,),
+                        }
+                    )
+                    self.queue.put_nowait(_dropped)
+                    self.dropped = 0
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+def _copy_arg(arg):
+    """ A shallow copy of containers, e.g. DeviceSnapshot, other args are used as they are """
+    if isinstance(arg, (dict, list, set)) or hasattr(arg, "__copy__"):
+        return copy.copy(arg)
+    return arg
+
+
+def _stop_listener(listener: logging.handlers.QueueListener):
+    try:
+        listener.stop()
+    except queue.Full:
+        # Nothing's draining the queue, don't hang on the way out.
+        pass
+
+
+def setup_logging(level: int, handlers: list, queue_size: int = QUEUE_SIZE):
+    """Log through a bounded queue to `handlers` on a listener thread. Returns the listener,
+    it's stopped, and the queue flushed, when we exit.
+    """
+    _queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    _root = logging.getLogger()
+    _root.setLevel(level)
+    _root.addHandler(BoundedQueueHandler(_queue))
+    _listener = logging.handlers.QueueListener(
+        _queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(_stop_listener, _listener)
+    return _listener
@@ -0,0 +1,368 @@
+# Metrics for the monitor, exported in the Prometheus text format -
+#   * to a file for node_exporter's textfile collector, "metrics_textfile", rewritten every
+#     "metrics_interval" seconds.
+#   * on a Unix socket, "metrics_socket". Every connection gets the current metrics, e.g.
+#     curl --unix-socket /run/usbeventmanager.sock http://localhost/metrics
+#
+# Instruments are plain counters and fixed bucket histograms guarded by a lock, updating one is
+# a dict lookup and a couple of additions. Nothing is formatted until the metrics are exported,
+# on the exporter's thread.
+import os
+import time
+import socket
+import logging
+import tempfile
+import threading
+from bisect import bisect_left
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Seconds.
+POLL_BUCKETS: tuple = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+LATENCY_BUCKETS: tuple = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0)
+DURATION_BUCKETS: tuple = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0)
+
+
+class _LabelledMetric(object):
+    """ Values kept per combination of label values """
+
+    kind: str = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name: str = name
+        self.help: str = help
+        self.labels: tuple = labels
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+
+class Counter(_LabelledMetric):
+    """ A counter per combination of label values """
+
+    kind: str = "counter"
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> list:
+        """ [(name suffix, {label: value}, value)] """
+        with self._lock:
+            _values = list(self._values.items())
+        return [("", dict(zip(self.labels, k)), v) for k, v in _values]
+
+
+class Histogram(_LabelledMetric):
+    """ A histogram with fixed buckets per combination of label values """
+
+    kind: str = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple, labels: tuple = ()):
+        super().__init__(name=name, help=help, labels=labels)
+        self.buckets: tuple = tuple(buckets)
+
+    def observe(self, value: float, *label_values) -> None:
+        _bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            _counts = self._values.get(label_values)
+            if _counts is None:
+                # A count per bucket, +Inf, then the sum.
+                _counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            _counts[_bucket] += 1
+            _counts[-1] += value
+
+    def samples(self) -> list:
+        _samples: list = []
+        with self._lock:
+            _values = [(k, list(v)) for k, v in self._values.items()]
+        for _label_values, _counts in _values:
+            _labels: dict = dict(zip(self.labels, _label_values))
+            _cumulative = 0
+            for _le, _count in zip(self.buckets + ("+Inf",), _counts):
+                _cumulative += _count
+                _samples.append(("_bucket", dict(_labels, le=str(_le)), _cumulative))
+            _samples.append(("_count", _labels, _cumulative))
+            _samples.append(("_sum", _labels, _counts[-1]))
+        return _samples
+
+
+class Gauge(object):
+    """ A value read from a function when the metrics are exported """
+
+    kind: str = "gauge"
+
+    def __init__(self, name: str, help: str):
+        self.name: str = name
+        self.help: str = help
+        self.function = None
+
+    def set_function(self, function) -> None:
+        self.function = function
+
+    def samples(self) -> list:
+        if self.function is None:
+            return []
+        try:
+            return [("", {}, self.function())]
+        except Exception as e:
+            logger.debug("Unable to read %s: %s", self.name, e)
+            return []
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics: list = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """ Every metric in the Prometheus text format """
+        _lines: list = []
+        for _metric in self._metrics:
+            _samples = _metric.samples()
+            _lines.append(f"# HELP {_metric.name} {_metric.help}")
+            _lines.append(f"# TYPE {_metric.name} {_metric.kind}")
+            for _suffix, _labels, _value in _samples:
+                _name = _metric.name + _suffix
+                if _labels:
+                    _name += (
+                        "{"
+                        + ",".join(
+                            f'{k}="{_escape(v)}"' for k, v in sorted(_labels.items())
+                        )
+                        + "}"
+                    )
+                _lines.append(f"{_name} {_format_value(_value)}")
+        return "\n".join(_lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+registry = Registry()
+
+POLL_SECONDS = registry.add(
+    Histogram(
+        "usbeventmanager_poll_duration_seconds",
+        "Time taken to enumerate the bus, poll event source only.",
+        buckets=POLL_BUCKETS,
+    )
+)
+EVENTS = registry.add(
+    Counter(
+        "usbeventmanager_events_total",
+        "Devices added or removed, and whether the lists triggered actions.",
+        labels=("event_type", "triggered"),
+    )
+)
+EVENTS_COALESCED = registry.add(
+    Counter(
+        "usbeventmanager_events_coalesced_total",
+        "Pairs of events that cancelled out within a debounce window.",
+    )
+)
+EVENT_BATCH_SECONDS = registry.add(
+    Histogram(
+        "usbeventmanager_event_handling_seconds",
+        "Time taken to check a batch of events against the lists.",
+        buckets=POLL_BUCKETS,
+    )
+)
+DISPATCH_LATENCY_SECONDS = registry.add(
+    Histogram(
+        "usbeventmanager_event_to_actions_seconds",
+        "Time from an event being dispatched to its actions starting.",
+        buckets=LATENCY_BUCKETS,
+    )
+)
+ACTIONS = registry.add(
+    Counter(
+        "usbeventmanager_actions_total",
+        "Actions triggered, by status: done, failed, timeout, skipped, folded or cooldown.",
+        labels=("action", "status"),
+    )
+)
+ACTION_SECONDS = registry.add(
+    Histogram(
+        "usbeventmanager_action_duration_seconds",
+        "Time taken by each action.",
+        buckets=DURATION_BUCKETS,
+        labels=("action",),
+    )
+)
+COMMANDS = registry.add(
+    Counter(
+        "usbeventmanager_commands_total",
+        "Commands run by actions, by result: ok, failed or timeout.",
+        labels=("result",),
+    )
+)
+COMMAND_SECONDS = registry.add(
+    Histogram(
+        "usbeventmanager_command_duration_seconds",
+        "Time taken by each command run by an action.",
+        buckets=DURATION_BUCKETS,
+    )
+)
+CONFIG_RELOADS = registry.add(
+    Counter(
+        "usbeventmanager_config_reloads_total",
+        "Config file reloads, by result: ok or failed.",
+        labels=("result",),
+    )
+)
+ATTACHED_DEVICES = registry.add(
+    Gauge("usbeventmanager_attached_devices", "USB devices currently attached.")
+)
+START_TIME = registry.add(
+    Gauge(
+        "usbeventmanager_start_time_seconds", "When monitoring started, seconds since the epoch."
+    )
+)
+
+
+class TextfileExporter(object):
+    """ Rewrite a file for node_exporter's textfile collector every `interval` seconds """
+
+    def __init__(self, path: Path, interval: float = 15):
+        self.path: Path = Path(path)
+        self._interval: float = max(float(interval), 1.0)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="metrics-textfile", daemon=True)
+        self._thread.start()
+        logger.debug("Writing metrics to %s.", self.path)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            self.write()
+
+    def write(self) -> None:
+        """ Written to a temporary file then renamed, the collector never reads a partial file """
+        try:
+            _fd, _tmp = tempfile.mkstemp(
+                dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".tmp"
+            )
+            try:
+                with os.fdopen(_fd, "w") as f:
+                    f.write(registry.render())
+                os.chmod(_tmp, 0o644)
+                os.replace(_tmp, self.path)
+            except BaseException:
+                os.unlink(_tmp)
+                raise
+        except OSError as e:
+            logger.warning("Unable to write metrics to %s: %s", self.path, e)
+
+    def close(self) -> None:
+        self._stop.set()
+        # Leave the final values behind.
+        self.write()
+
+
+class SocketExporter(object):
+    """Serve the metrics on a Unix socket. Clients that send an HTTP request get an HTTP
+    response, anything else just gets the metrics.
+    """
+
+    # Seconds to wait for a client to send a request before answering without HTTP.
+    REQUEST_TIMEOUT: float = 0.2
+    # Seconds a client gets to read the response, one that stops reading is dropped so it can't
+    # hold up everyone else.
+    SEND_TIMEOUT: float = 5
+
+    def __init__(self, path: Path):
+        self.path: Path = Path(path)
+        self._sock = None
+
+    def start(self) -> bool:
+        if not hasattr(socket, "AF_UNIX"):
+            logger.warning("Unix sockets aren't supported on this platform, not serving metrics.")
+            return False
+        try:
+            if self.path.is_socket():
+                # Left behind by a previous run.
+                self.path.unlink()
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(str(self.path))
+            os.chmod(self.path, 0o660)
+            self._sock.listen(8)
+        except OSError as e:
+            logger.warning("Unable to serve metrics on %s: %s", self.path, e)
+            self.close()
+            return False
+        threading.Thread(target=self._run, name="metrics-socket", daemon=True).start()
+        logger.debug("Serving metrics on %s.", self.path)
+        return True
+
+    def _run(self) -> None:
+        while self._sock is not None:
+            try:
+                _conn, _ = self._sock.accept()
+            except OSError:
+                # Closed.
+                return
+            with _conn:
+                try:
+                    self._serve(_conn)
+                except socket.timeout:
+                    logger.debug("Metrics client stopped reading, dropped it.")
+                except OSError as e:
+                    logger.debug("Metrics client went away: %s", e)
+
+    def _serve(self, conn: socket.socket) -> None:
+        conn.settimeout(self.REQUEST_TIMEOUT)
+        try:
+            _request = conn.recv(4096)
+        except socket.timeout:
+            _request = b""
+        _body = registry.render().encode()
+        if _request[:4] in (b"GET ", b"HEAD"):
+            _header = (
+                "HTTP/1.0 200 OK\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(_body)}\r\n\r\n"
+            ).encode()
+            if _request.startswith(b"HEAD"):
+                _body = b""
+            _body = _header + _body
+        conn.settimeout(self.SEND_TIMEOUT)
+        conn.sendall(_body)
+
+    def close(self) -> None:
+        if self._sock is not None:
+            _sock, self._sock = self._sock, None
+            _sock.close()
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+
+
+def start_exporters(textfile=None, socket_path=None, interval: float = 15) -> list:
+    """ Start the exporters that are configured, returns them so they can be closed """
+    START_TIME.set_function(lambda _start=time.time(): _start)
+    _exporters: list = []
+    if textfile:
+        _exporter = TextfileExporter(path=textfile, interval=interval)
+        _exporter.start()
+        _exporters.append(_exporter)
+    if socket_path:
+        _exporter = SocketExporter(path=socket_path)
+        if _exporter.start():
+            _exporters.append(_exporter)
+    return _exporters
@@ -0,0 +1,414 @@
+# Overwrite and delete files for the secure_delete action.
+# With thanks to phealy3330 @ https://stackoverflow.com/questions/17455300/python-securely-remove-file
+import os
+import mmap
+import time
+import string
+import random
+import logging
+import threading
+from pathlib import Path
+from concurrent import futures
+
+logger = logging.getLogger(__name__)
+
+# How overwrite passes are written -
+#   write  - seek to the start of the file then write() chunk by chunk.
+#   pwrite - pwrite() each chunk at its offset, no seeking. Not available on Windows.
+#   mmap   - map the file and copy each chunk into the mapping.
+METHODS: tuple = ("write", "pwrite", "mmap")
+
+
+class SecureDeleter(object):
+    """Overwrite files with random data then zeros, rename them to a random name then delete them.
+
+    Files are written in fixed size chunks from buffers that are reused for every chunk, pass and
+    file, so memory use depends on the chunk size and number of workers, not on the size of the
+    files. Each pass is flushed to disk before the next one starts. Files are processed in
+    parallel by a pool of workers.
+    """
+
+    def __init__(
+        self,
+        passes: int,
+        chunk_size: int = 1024 * 1024,
+        method: str = "write",
+        workers: int = 4,
+        no_action: bool = False,
+    ):
+        self.passes: int = passes
+        # At least a page, smaller chunks only add system calls.
+        self.chunk_size: int = max(int(chunk_size), mmap.PAGESIZE)
+        self.workers: int = max(1, workers)
+        self.no_action: bool = no_action
+        if method not in METHODS:
+            logger.warning('Unknown secure delete method "%s", using write.', method)
+            method = "write"
+        if method == "pwrite" and not hasattr(os, "pwrite"):
+            logger.warning("pwrite isn't supported on this platform, using write.")
+            method = "write"
+        self.method: str = method
+
+        # The zero buffer is only ever read so it's shared, random buffers are per thread.
+        self._zeros = memoryview(bytes(self.chunk_size))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._bytes_written: int = 0
+
+    # Public
+    def delete(self, paths: list) -> dict:
+        """Securely delete a list of files and directories. A directory path ending in "/" has its
+        contents deleted, otherwise the directory itself is deleted too.
+        Returns {"files": count, "bytes": bytes written, "seconds": elapsed, "mb_per_sec": throughput,
+        "failed": [paths that couldn't be deleted]}
+        """
+        _files, _dirs = self.scan(paths)
+        return self.delete_scanned(_files, _dirs)
+
+    def scan(self, paths: list) -> [list, list]:
+        """ Return the files and directories (bottom up) below the given paths """
+        _files: list = []
+        _dirs: list = []
+        for _raw_path in paths:
+            _path = Path(_raw_path).expanduser()
+            if not _path.exists() and not _path.is_symlink():
+                logger.warning('Path "%s" doesn\'t exist.', str(_path))
+                continue
+            if _path.is_symlink() or _path.is_file():
+                _files.append(_path)
+            elif _path.is_dir():
+                # Walk from the bottom up so directories are empty by the time we get to them.
+                for _root, _walk_dirs, _walk_files in os.walk(_path, topdown=False):
+                    _root = Path(_root)
+                    for _file in _walk_files:
+                        _files.append(_root.joinpath(_file))
+                    for _dir in _walk_dirs:
+                        _dirs.append(_root.joinpath(_dir))
+                # If the path in the config file doesn't end in a "/" delete the directory too.
+                if not str(_raw_path).endswith(("/", os.sep)):
+                    _dirs.append(_path)
+        return _files, _dirs
+
+    def delete_scanned(self, files: list, dirs: list) -> dict:
+        """ Securely delete files found by scan(), in parallel, then remove the directories """
+        _start = time.monotonic()
+        self._bytes_written = 0
+        with futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="secure-delete"
+        ) as _pool:
+            _futures = [(_file, _pool.submit(self.delete_file, _file)) for _file in files]
+            # Whatever goes wrong with one file, carry on with the rest.
+            _failed: list = []
+            for _file, _future in _futures:
+                try:
+                    _future.result()
+                except Exception as e:
+                    logger.error("Secure delete of %s failed: %s", _file, e)
+                    _failed.append(_file)
+        for _dir in dirs:
+            self.delete_directory(_dir)
+        _stats = self._stats(files=len(files) - len(_failed), start=_start)
+        _stats["failed"] = _failed
+        return _stats
+
+    def delete_file(self, path: Path, passes: int = None) -> int:
+        """ Overwrite, rename then delete a file. Returns the number of bytes written """
+        _path = Path(path)
+        if self.no_action:
+            logger.debug("     Skipping secure delete of %s", _path)
+            return 0
+        # We don't follow symlinks, delete the link and leave the target alone.
+        if _path.is_symlink():
+            _path.unlink()
+            return 0
+        _written = self.overwrite_file(_path, passes=passes)
+        self.unlink(_path)
+        logger.debug("Secure delete complete for %s", _path)
+        return _written
+
+    def overwrite_file(self, path: Path, passes: int = None, zero_pass=True) -> int:
+        """ Overwrite a file in place with random passes then, optionally, a pass of zeros """
+        _passes = self.passes if passes is None else passes
+        _written = 0
+        _fd = os.open(path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        try:
+            _length = os.fstat(_fd).st_size
+            _map = None
+            # Empty files can't be mapped, and don't need overwriting anyway.
+            if self.method == "mmap" and _length:
+                _map = mmap.mmap(_fd, _length)
+            try:
+                for x in range(_passes):
+                    _written += self._write_pass(_fd, _map, _length, self._random_chunk)
+                    logger.debug(
+                        "Secure delete pass %s of %s complete for %s",
+                        x + 1,
+                        _passes,
+                        path,
+                    )
+                if zero_pass:
+                    _written += self._write_pass(_fd, _map, _length, self._zero_chunk)
+            finally:
+                if _map is not None:
+                    _map.close()
+        finally:
+            os.close(_fd)
+        with self._lock:
+            self._bytes_written += _written
+        return _written
+
+    def unlink(self, path: Path) -> None:
+        """ Rename a file to a random name in the same directory then delete it """
+        _new_path = path.rename(path.with_name(self._rnd_str()))
+        _new_path.unlink()
+
+    def delete_directory(self, path: Path) -> None:
+        """ Rename then delete a directory """
+        _path = Path(path)
+        if self.no_action:
+            logger.debug("     Skipping secure delete of %s", str(_path))
+            return
+        try:
+            _new_path = _path.rename(_path.with_name(self._rnd_str()))
+            _new_path.rmdir()
+            logger.debug("Deleted directory %s", _path)
+        # We don't follow symlinks when we delete files so
+        # it's possible we can't delete a dir. We ignore that error.
+        except OSError:
+            pass
+
+    # Overwriting
+    def _write_pass(self, fd: int, file_map, length: int, next_chunk) -> int:
+        """ Write one full pass over the file then flush it to disk """
+        _offset = 0
+        if self.method == "write":
+            os.lseek(fd, 0, os.SEEK_SET)
+        while _offset < length:
+            _chunk = next_chunk(min(self.chunk_size, length - _offset))
+            if file_map is not None:
+                file_map[_offset : _offset + len(_chunk)] = _chunk
+                _offset += len(_chunk)
+                continue
+            # write() and pwrite() can write less than asked for.
+            while _chunk:
+                if self.method == "pwrite":
+                    _cnt = os.pwrite(fd, _chunk, _offset)
+                else:
+                    _cnt = os.write(fd, _chunk)
+                _chunk = _chunk[_cnt:]
+                _offset += _cnt
+        if file_map is not None:
+            file_map.flush()
+        os.fsync(fd)
+        return length
+
+    def _zero_chunk(self, size: int) -> memoryview:
+        return self._zeros[:size]
+
+    def _random_chunk(self, size: int) -> memoryview:
+        """ Fill this thread's random buffer and return the first size bytes of it """
+        _buffer = getattr(self._local, "buffer", None)
+        if _buffer is None:
+            _buffer = self._local.buffer = memoryview(bytearray(self.chunk_size))
+        _chunk = _buffer[:size]
+        _urandom = self._urandom()
+        if _urandom is None:
+            _chunk[:] = os.urandom(size)
+            return _chunk
+        # Read straight into the buffer, reads can be short.
+        _filled = 0
+        while _filled < size:
+            _filled += _urandom.readinto(_chunk[_filled:])
+        return _chunk
+
+    def _urandom(self):
+        """ A per thread handle to /dev/urandom, None where it doesn't exist """
+        if not hasattr(self._local, "urandom"):
+            try:
+                self._local.urandom = open("/dev/urandom", "rb", buffering=0)
+            except OSError:
+                self._local.urandom = None
+        return self._local.urandom
+
+    # Reporting
+    def _stats(self, files: int, start: float) -> dict:
+        _seconds = time.monotonic() - start
+        _mb = self._bytes_written / (1024 * 1024)
+        _mb_per_sec = _mb / _seconds if _seconds > 0 else 0.0
+        logger.info(
+            "Securely deleted %s files, wrote %.1f MB in %.2f sec. (%.1f MB/s)",
+            files,
+            _mb,
+            _seconds,
+            _mb_per_sec,
+        )
+        return {
+            "files": files,
+            "bytes": self._bytes_written,
+            "seconds": _seconds,
+            "mb_per_sec": _mb_per_sec,
+        }
+
+    @staticmethod
+    def _rnd_str() -> str:
+        """ Create a randomish string of _str_length length"""
+        _str_length = random.randrange(1, 48)
+        _chars = string.ascii_letters + string.digits
+        _str = "".join((random.choice(_chars) for _ in range(_str_length)))
+        return _str
+
+
+class SecureDeletePlanner(object):
+    """Securely delete files within a time budget, e.g. before a forced shutdown.
+
+    Targets are scanned up front. Paths listed first in the config are treated as the highest
+    risk, within a path smaller files go first so the most files are destroyed soonest. Then -
+      1. Every file is renamed to a random name, destroying the names first.
+      2. Every file gets a single random pass. A file that can't be overwritten in the time
+         left, estimated from its size and the measured throughput, is truncated and deleted.
+      3. Any time left is spent on the remaining passes then the zero pass, one round over
+         every file at a time.
+      4. The files and then the directories are deleted.
+    """
+
+    def __init__(self, deleter: SecureDeleter, budget: float, throughput_mb: float = 100):
+        self._deleter: SecureDeleter = deleter
+        self._budget: float = budget
+        self._deadline: float = 0.0
+        self._lock = threading.Lock()
+        # Bytes per second per worker. Starts as an estimate and is replaced with what we measure.
+        self._throughput: float = throughput_mb * 1024 * 1024
+        self._measured_bytes: int = 0
+        self._measured_seconds: float = 0.0
+
+    def run(self, paths: list) -> dict:
+        """ Securely delete the paths, ending once the budget is spent """
+        _start = time.monotonic()
+        self._deadline = _start + self._budget
+        _deleter = self._deleter
+        _deleter._bytes_written = 0
+
+        # Scan each configured path separately so we keep track of its priority.
+        _targets: list = []
+        _dirs: list = []
+        for _rank, _path in enumerate(paths):
+            _path_files, _path_dirs = _deleter.scan([_path])
+            _targets.extend((_rank, _file) for _file in _path_files)
+            _dirs.extend(_path_dirs)
+        if _deleter.no_action:
+            return _deleter.delete_scanned([_file for _, _file in _targets], _dirs)
+
+        _files = self._rename_all(_targets)
+        logger.info(
+            "Secure delete planned for %s files, %.1f MB, budget %s sec.",
+            len(_files),
+            sum(_size for _, _size in _files) / (1024 * 1024),
+            self._budget,
+        )
+
+        # A single pass over everything, files we don't have time for are truncated.
+        _files, _ = self._round(_files, passes=1, zero_pass=False, truncate_late=True)
+        # Passes every remaining file got.
+        _passes_done = 1
+        for _ in range(1, _deleter.passes):
+            if not self._time_left():
+                break
+            _, _skipped = self._round(_files, passes=1, zero_pass=False)
+            if _skipped:
+                break
+            _passes_done += 1
+        if self._time_left():
+            self._round(_files, passes=0, zero_pass=True)
+
+        for _path, _ in _files:
+            try:
+                _path.unlink()
+            except OSError as e:
+                logger.error("Secure delete failed: %s", e)
+        for _dir in _dirs:
+            _deleter.delete_directory(_dir)
+        if _passes_done < _deleter.passes:
+            logger.warning(
+                "Secure delete budget of %s sec. allowed %s of %s passes.",
+                self._budget,
+                _passes_done,
+                _deleter.passes,
+            )
+        _stats = _deleter._stats(files=len(_targets), start=_start)
+        _stats["passes"] = _passes_done
+        return _stats
+
+    def _rename_all(self, targets: list) -> list:
+        """ Rename every file to a random name and return [(new path, size)] in priority order """
+        _files: list = []
+        for _rank, _file in targets:
+            try:
+                # We don't follow symlinks, delete the link and leave the target alone.
+                if _file.is_symlink():
+                    _file.unlink()
+                    continue
+                _size = _file.stat().st_size
+                _new_path = _file.rename(_file.with_name(self._deleter._rnd_str()))
+            except OSError as e:
+                logger.error("Secure delete failed: %s", e)
+                continue
+            _files.append((_rank, _size, _new_path))
+        _files.sort(key=lambda f: (f[0], f[1]))
+        return [(_path, _size) for _, _size, _path in _files]
+
+    def _round(
+        self, files: list, passes: int, zero_pass: bool, truncate_late=False
+    ) -> [list, int]:
+        """Overwrite every file that fits in the time left. Returns the files that weren't
+        truncated and the number of files skipped.
+        """
+        _truncated: set = set()
+        _skipped: list = []
+
+        def _overwrite(path: Path, size: int):
+            if not self._fits(size):
+                _skipped.append(path)
+                if truncate_late:
+                    # Out of time, destroy what we can reach quickly.
+                    os.truncate(path, 0)
+                    _truncated.add(path)
+                return
+            _start = time.monotonic()
+            self._deleter.overwrite_file(path, passes=passes, zero_pass=zero_pass)
+            # Small files are dominated by the fsync, they'd make the estimate useless.
+            if size >= self._deleter.chunk_size:
+                self._measure(size, time.monotonic() - _start)
+
+        with futures.ThreadPoolExecutor(
+            max_workers=self._deleter.workers, thread_name_prefix="secure-delete"
+        ) as _pool:
+            _futures = [_pool.submit(_overwrite, _path, _size) for _path, _size in files]
+            for _future in _futures:
+                try:
+                    _future.result()
+                except OSError as e:
+                    logger.error("Secure delete failed: %s", e)
+        if _truncated:
+            logger.warning(
+                "Secure delete budget too small to overwrite %s files, they were truncated.",
+                len(_truncated),
+            )
+            for _path in _truncated:
+                _path.unlink()
+        _files = [(_path, _size) for _path, _size in files if _path not in _truncated]
+        return _files, len(_skipped)
+
+    def _measure(self, size: int, seconds: float) -> None:
+        """ Update the throughput estimate with a measured overwrite """
+        with self._lock:
+            self._measured_bytes += size
+            self._measured_seconds += seconds
+            if self._measured_seconds > 0 and self._measured_bytes > 0:
+                self._throughput = self._measured_bytes / self._measured_seconds
+
+    def _time_left(self) -> float:
+        return max(0.0, self._deadline - time.monotonic())
+
+    def _fits(self, size: int) -> bool:
+        """ True if a pass over size bytes should finish before the deadline """
+        return size / self._throughput <= self._time_left()
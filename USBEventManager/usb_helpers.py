@@ -1,45 +1,351 @@
+import queue
 import logging
+import threading
 import usb.core
 import usb.util
-from helpers import Helpers
 
 logger = logging.getLogger(__name__)
 
-helpers = Helpers()
+
+def pack_device_id(device: str) -> int:
+    """ "xxxx:xxxx" -> (vid << 16) | pid """
+    _vid, _pid = device.split(":")
+    return (int(_vid, 16) << 16) | int(_pid, 16)
+
+
+def format_device_id(packed: int) -> str:
+    """ (vid << 16) | pid -> "xxxx:xxxx" """
+    return "%04x:%04x" % (packed >> 16, packed & 0xFFFF)
+
+
+class DeviceSnapshot(object):
+    """A read-only view of the attached USB devices, {"xxxx:xxxx": count}.
+
+    Counts are kept by packed (vid << 16) | pid integer, the "xxxx:xxxx" strings are only
+    formatted when the snapshot is read, for logging or comparing against the config.
+    """
+
+    __slots__ = ("_counts", "_total")
+
+    def __init__(self, counts: dict = None):
+        self._counts: dict = {pack_device_id(d): c for d, c in (counts or {}).items()}
+        self._total: int = sum(self._counts.values())
+
+    @classmethod
+    def _from_packed(cls, counts: dict, total: int) -> "DeviceSnapshot":
+        """ Wrap a {packed ID: count} dict without copying it """
+        _snapshot = cls.__new__(cls)
+        _snapshot._counts = counts
+        _snapshot._total = total
+        return _snapshot
+
+    def copy(self) -> "DeviceSnapshot":
+        return DeviceSnapshot._from_packed(dict(self._counts), self._total)
+
+    __copy__ = copy
+
+    @property
+    def total(self) -> int:
+        """ Total number of attached devices, including duplicates """
+        return self._total
+
+    def get(self, device: str, default=None):
+        return self._counts.get(pack_device_id(device), default)
+
+    def items(self):
+        return [(format_device_id(d), c) for d, c in self._counts.items()]
+
+    def keys(self):
+        return [format_device_id(d) for d in self._counts]
+
+    def values(self):
+        return self._counts.values()
+
+    def as_dict(self) -> dict:
+        """ Return a mutable copy of the device counts """
+        return dict(self.items())
+
+    def __getitem__(self, device: str) -> int:
+        return self._counts[pack_device_id(device)]
+
+    def __contains__(self, device: str) -> bool:
+        return pack_device_id(device) in self._counts
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, DeviceSnapshot):
+            return self._counts == other._counts
+        return self.as_dict() == other
+
+    def __repr__(self) -> str:
+        return repr(self.as_dict())
+
+
+class USBDevice(object):
+    """A physical USB device. Identified by the port it's attached to, "<bus>-<port>.<port>...",
+    only one device can be attached to a port at a time. The serial number, when it has one, and
+    the "xxxx:xxxx" ID are attributes, identical devices share an ID.
+    """
+
+    __slots__ = (
+        "device_id",
+        "packed_id",
+        "vid",
+        "pid",
+        "location",
+        "serial",
+        "handle",
+        "mark",
+    )
+
+    def __init__(self, device_id: str, location: str, serial=None, handle=None):
+        self.device_id: str = device_id
+        self.packed_id: int = pack_device_id(device_id)
+        self.vid: int = self.packed_id >> 16
+        self.pid: int = self.packed_id & 0xFFFF
+        self.location: str = location
+        self.serial = serial
+        # (bus, address). The host assigns a new address each time a device is enumerated
+        # so a re-plug gets a new handle. None until the bus has been scanned.
+        self.handle = handle
+        # Set by each scan that sees the device, see USBTools.scan().
+        self.mark: bool = False
+
+    def __repr__(self) -> str:
+        if self.serial:
+            return f"{self.device_id}@{self.location}#{self.serial}"
+        return f"{self.device_id}@{self.location}"
+
+
+class DeviceRegistry(object):
+    """The attached USBDevices, indexed by location, by ID and by handle. Updated a device at
+    a time as devices come and go so nothing is rebuilt per poll.
+    """
+
+    def __init__(self):
+        self._by_location: dict = {}
+        # {"xxxx:xxxx": {location: USBDevice}}
+        self._by_id: dict = {}
+        # {bus: {address: USBDevice}}, nested so lookups don't build a key.
+        self.by_bus: dict = {}
+
+    def add(self, device: USBDevice) -> [USBDevice, None]:
+        """ Add a device, returns the device it replaced at the same location, if any """
+        _replaced = self.remove(device.location)
+        self._by_location[device.location] = device
+        self._by_id.setdefault(device.device_id, {})[device.location] = device
+        if device.handle is not None:
+            self.set_handle(device, device.handle)
+        return _replaced
+
+    def remove(self, location: str) -> [USBDevice, None]:
+        """ Remove the device at a location, returns it """
+        _device = self._by_location.pop(location, None)
+        if _device is not None:
+            _same_id = self._by_id.get(_device.device_id)
+            _same_id.pop(location, None)
+            if not _same_id:
+                del self._by_id[_device.device_id]
+            if _device.handle is not None:
+                _bus, _address = _device.handle
+                _addresses = self.by_bus.get(_bus, {})
+                if _addresses.get(_address) is _device:
+                    del _addresses[_address]
+        return _device
+
+    def set_handle(self, device: USBDevice, handle: tuple) -> None:
+        device.handle = handle
+        _bus, _address = handle
+        self.by_bus.setdefault(_bus, {})[_address] = device
+
+    def at(self, location: str) -> [USBDevice, None]:
+        return self._by_location.get(location)
+
+    def by_id(self, device_id: str) -> list:
+        return list(self._by_id.get(device_id, {}).values())
+
+    def by_handle(self, bus: int, address: int) -> [USBDevice, None]:
+        return self.by_bus.get(bus, {}).get(address)
+
+    def locations(self):
+        return self._by_location.keys()
+
+    def __iter__(self):
+        return iter(list(self._by_location.values()))
+
+    def __len__(self) -> int:
+        return len(self._by_location)
 
 
 class USBTools(object):
-    def _enumerate_devices(self) -> dict:
-        """ Return human formatted USB devices ids in a dict including quantity """
-        _devices_l: list = []
-        _devices: dict = {}
-        _ds = usb.core.find(find_all=True)
-        for d in _ds:
-            _device = self.pyusb_to_human(d)
-            _devices_l.append(_device)
-            _devices = helpers.aggregate_list_dupes(_devices_l)
-        return _devices
-
-    def friendly_device_desc(self, device):
-        """ Returns a friendly description of the _d """
+    def __init__(self):
+        # Reused between scans so an idle poll doesn't allocate, see scan().
+        self._counts: dict = {}
+        self._mark: bool = False
+        self.attached: DeviceSnapshot = DeviceSnapshot._from_packed(self._counts, 0)
+        # Friendly device descriptions, {(location, "xxxx:xxxx"): "manufacturer : product"}
+        self._descriptor_cache: dict = {}
+        # The attached devices as of the last scan or event.
+        self.registry: DeviceRegistry = DeviceRegistry()
+
+    def _enumerate_devices(self) -> DeviceSnapshot:
+        """ Return a snapshot of human formatted USB devices ids including quantity """
+        self.scan()
+        # Our own copy, the attached snapshot is overwritten by the next scan.
+        return self.attached.copy()
+
+    def scan(self) -> tuple:
+        """Enumerate the bus and bring the registry up to date. Returns (DeviceSnapshot,
+        [USBDevices added], [USBDevices removed]) relative to the last scan or event.
+
+        The snapshot is self.attached, it's reused and changes with the next scan. Devices that
+        were already attached are recognised by bus, address, vendor and product, values pyusb
+        has already read, and are counted under their stored packed ID. On an idle bus nothing
+        is formatted and no keys are built. Strings are only formatted for new devices.
+        """
+        _counts = self._counts
+        _by_bus = self.registry.by_bus
+        self._mark = _mark = not self._mark
+        for _packed in _counts:
+            _counts[_packed] = 0
+        _total = 0
+        _added: list = []
+        _removed: list = []
+        for d in usb.core.find(find_all=True):
+            _total += 1
+            _addresses = _by_bus.get(d.bus)
+            _known = _addresses.get(d.address) if _addresses is not None else None
+            if _known is None or _known.vid != d.idVendor or _known.pid != d.idProduct:
+                _known = self._scan_new_device(d, _added, _removed)
+            _known.mark = _mark
+            _counts[_known.packed_id] = _counts.get(_known.packed_id, 0) + 1
+        if _added or _removed or _total != len(self.registry):
+            # Anything we didn't see this time is gone.
+            for _device in self.registry:
+                if _device.mark is not _mark:
+                    _removed.append(self.registry.remove(_device.location))
+            for _packed in [p for p, c in _counts.items() if not c]:
+                del _counts[_packed]
+        self.attached._total = _total
+        return self.attached, _added, _removed
+
+    def _scan_new_device(self, d, added: list, removed: list) -> USBDevice:
+        """ A device we don't know by its handle, work out where it is and what it is """
+        _registry = self.registry
+        _handle = (d.bus, d.address)
+        _location = self.pyusb_location(d)
+        _device = format_device_id((d.idVendor << 16) | d.idProduct)
+        _known = _registry.at(_location)
+        if _known is not None and _known.device_id == _device and _known.handle is None:
+            # Added by an event driven source, now we know its handle.
+            _registry.set_handle(_known, _handle)
+            return _known
+        _other = _registry.by_handle(d.bus, d.address)
+        if _other is not None:
+            removed.append(_registry.remove(_other.location))
+        _new = USBDevice(
+            device_id=_device,
+            location=_location,
+            serial=self.sysfs_serial(_location),
+            handle=_handle,
+        )
+        _replaced = _registry.add(_new)
+        if _replaced is not None:
+            removed.append(_replaced)
+        added.append(_new)
+        return _new
+
+    def track(self, event_type: str, device: str, location=None) -> None:
+        """ Update the registry from an event delivered by an event driven source """
+        if location is None:
+            return
+        _known = self.registry.at(location)
+        if event_type == "ADDED":
+            if _known is None or _known.device_id != device:
+                self.registry.add(
+                    USBDevice(
+                        device_id=device,
+                        location=location,
+                        serial=self.sysfs_serial(location),
+                    )
+                )
+        elif event_type == "REMOVED":
+            if _known is not None and _known.device_id == device:
+                self.registry.remove(location)
+
+    @staticmethod
+    def sysfs_serial(location: str) -> [str, None]:
+        """The serial number the Linux kernel read when the device was enumerated. Reading it
+        from the device means a control transfer, something we don't want to do while polling.
+        """
+        try:
+            with open(f"/sys/bus/usb/devices/{location}/serial", "r") as f:
+                return f.read().strip() or None
+        except (OSError, ValueError):
+            return None
+
+    def friendly_device_desc(self, device, location=None):
+        """ Returns a friendly description of the device, cached until the device is removed """
         _device = device
-        _vid, _pid = self.human_to_pyusb(_device)
-        _dev = usb.core.find(idVendor=_vid, idProduct=_pid)
-        _manufacturer = usb.util.get_string(_dev, _dev.iManufacturer)
-        _product = usb.util.get_string(_dev, _dev.iProduct)
+        _key = (location, _device)
+        _name = self._descriptor_cache.get(_key)
+        if _name is not None:
+            return _name
+        _dev = self._find_device(_device, location)
+        if _dev is None:
+            # The device went away before we could read its strings, don't cache this.
+            return "<unknown>"
+        try:
+            _manufacturer = usb.util.get_string(_dev, _dev.iManufacturer)
+            _product = usb.util.get_string(_dev, _dev.iProduct)
+            # We're reading strings anyway, fill in the serial if sysfs didn't have it.
+            _known = self.registry.at(location) if location else None
+            if _known is not None and _known.serial is None and _dev.iSerialNumber:
+                _known.serial = usb.util.get_string(_dev, _dev.iSerialNumber)
+        except (usb.core.USBError, ValueError, NotImplementedError) as e:
+            logger.debug("Unable to read the string descriptors for %s: %s", _device, e)
+            _manufacturer = None
+            _product = None
         if not _manufacturer:
             _manufacturer = "<none>"
         if not _product:
             _product = "<none>"
         _name = _manufacturer + " : " + _product
+        self._descriptor_cache[_key] = _name
         return _name
 
-    def unbind(self, device):
+    def forget_device(self, device, location=None):
+        """ Evict a removed device from the descriptor cache """
+        self._descriptor_cache.pop((location, device), None)
+
+    def _find_device(self, device, location=None):
+        """ Find a pyusb device by ID, and by bus/port location if we know it """
+        _vid, _pid = self.human_to_pyusb(device)
+        if location is None:
+            return usb.core.find(idVendor=_vid, idProduct=_pid)
+        return usb.core.find(
+            idVendor=_vid,
+            idProduct=_pid,
+            custom_match=lambda d: self.pyusb_location(d) == location,
+        )
+
+    def unbind(self, device, location=None):
+        """ Detach the kernel driver from a device, the one at `location` if we know it """
         _device = device
         _vid, _pid = self.human_to_pyusb(_device)
-        dev = usb.core.find(idVendor=_vid, idProduct=_pid)
+        dev = self._find_device(_device, location)
+        if dev is None:
+            logger.warning("Unable to unbind %s at %s, it's gone.", _device, location)
+            return False
         dev.detach_kernel_driver(0)
-        logger.debug("Unbound _d: idVendor: %s, idProduct: %s", _vid, _pid)
+        logger.debug(
+            "Unbound _d: idVendor: %s, idProduct: %s, location: %s", _vid, _pid, location
+        )
         return True
 
     @staticmethod
@@ -59,6 +365,49 @@ class USBTools(object):
         device_id: str = _vid + ":" + _pid
         return device_id
 
+    @staticmethod
+    def pyusb_location(device) -> str:
+        """Return the "<bus>-<port>.<port>..." location of a pyusb device. Root hubs are
+        "usb<bus>", the name Linux uses. Backends that can't report ports get "<bus>.<address>".
+        """
+        try:
+            _ports = device.port_numbers
+        except NotImplementedError:
+            return f"{device.bus}.{device.address}"
+        if not _ports:
+            return f"usb{device.bus}"
+        return f"{device.bus}-" + ".".join(str(p) for p in _ports)
+
     @property
-    def devices(self):
+    def devices(self) -> DeviceSnapshot:
         return self._enumerate_devices()
+
+
+class DeviceNameResolver(object):
+    """Resolve friendly device names on a background thread.
+
+    Reading string descriptors is a control transfer per string, slow on a good day and a hang
+    on a misbehaving device. Names are resolved here so they never delay the actions for an event.
+    """
+
+    def __init__(self, usb_tools: USBTools):
+        self._usb = usb_tools
+        self._queue: queue.Queue = queue.Queue()
+        # A daemon thread so a hung device can't stop us from exiting.
+        self._thread = threading.Thread(
+            target=self._run, name="device-names", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, device: str, location, callback) -> None:
+        """ Resolve the name of the device then call callback(device, location, name) """
+        self._queue.put((device, location, callback))
+
+    def _run(self):
+        while True:
+            _device, _location, _callback = self._queue.get()
+            try:
+                _name = self._usb.friendly_device_desc(_device, _location)
+                _callback(_device, _location, _name)
+            except Exception as e:
+                logger.debug("Unable to resolve the name of %s: %s", _device, e)
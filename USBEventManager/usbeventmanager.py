@@ -2,8 +2,10 @@ import click
 import logging
 
 from core import USBEventManager
-from helpers import Helpers
-helpers = Helpers()
+from context import runtime
+from log_queue import setup_logging
+from journal import RECORD_KINDS, parse_time
+helpers = runtime.helpers
 logger = logging.getLogger(__name__)
 
 
@@ -16,6 +18,17 @@ class Config(object):
 pass_config = click.make_pass_decorator(Config, ensure=True)
 
 
+def time_option(ctx, param, value):
+    """ Convert a --since or --until value to seconds since the epoch """
+    try:
+        return parse_time(value)
+    except ValueError:
+        raise click.BadParameter(
+            f'"{value}" isn\'t a time. Use seconds since the epoch, e.g. 1612098000, or an '
+            'ISO 8601 date/time in local time, e.g. "2021-01-31" or "2021-01-31 13:00".'
+        )
+
+
 @click.group()
 @click.option(
     "--loglevel",
@@ -35,14 +48,12 @@ def cli(config, loglevel, no_actions):
     config.loglevel = loglevel
     config.no_actions = no_actions
 
-    # Logging
+    # Logging, written to the console by a listener thread. See log_queue.py.
     numeric_logging_level = getattr(logging, config.loglevel, None)
-    root_logger = logging.getLogger()
-    root_logger.setLevel(numeric_logging_level)
     formatter = logging.Formatter("%(message)s")
     console = logging.StreamHandler()
     console.setFormatter(formatter)
-    root_logger.addHandler(console)
+    setup_logging(level=numeric_logging_level, handlers=[console])
 
     config.uev = USBEventManager(no_actions=no_actions)
 
@@ -84,6 +95,60 @@ def list_devices(config):
     uev.list_devices()
 
 
+@cli.command(help="Print the event journal, oldest first.")
+@click.option(
+    "--since",
+    callback=time_option,
+    help="Only records after this time, epoch seconds or ISO 8601.",
+)
+@click.option(
+    "--until",
+    callback=time_option,
+    help="Only records before this time, epoch seconds or ISO 8601.",
+)
+@click.option("--device", help='Only records for this device, "xxxx:xxxx".')
+@pass_config
+def replay(config, since, until, device):
+    """ Print the event journal """
+    uev = config.uev
+    uev.replay_journal(since=since, until=until, device=device)
+
+
+@cli.command(help="Query the event journal, matching records are printed as JSON lines.")
+@click.option(
+    "--since",
+    callback=time_option,
+    help="Only records after this time, epoch seconds or ISO 8601.",
+)
+@click.option(
+    "--until",
+    callback=time_option,
+    help="Only records before this time, epoch seconds or ISO 8601.",
+)
+@click.option("--device", help='Only records for this device, "xxxx:xxxx".')
+@click.option(
+    "--event", "event_type", type=click.Choice(["ADDED", "REMOVED"]), help="Only this event type."
+)
+@click.option(
+    "--kind",
+    type=click.Choice(RECORD_KINDS),
+    help="Only this kind of record.",
+)
+@click.option("--count", is_flag=True, default=False, help="Print the number of matching records.")
+@pass_config
+def query(config, since, until, device, event_type, kind, count):
+    """ Query the event journal """
+    uev = config.uev
+    uev.query_journal(
+        since=since,
+        until=until,
+        device=device,
+        event_type=event_type,
+        kind=kind,
+        count=count,
+    )
+
+
 @cli.command(help="Learn new USB devices.")
 @pass_config
 def learn(config):
@@ -0,0 +1,101 @@
+# Allocation benchmark for the polling monitor loop.
+# Runs the per poll work of the poll event source, enumerate, count and compare, against a fake
+# idle bus and uses tracemalloc to measure the memory allocated while a poll runs. Compares the
+# packed, reused snapshot against the previous implementation, which formatted every ID as a
+# string and built then copied a new dict per poll. Fails if the current loop holds on to more
+# memory the longer it runs.
+#
+#   python benchmarks/bench_allocations.py
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(
+    0, str(Path(__file__).resolve().parent.parent.joinpath("USBEventManager"))
+)
+
+import usb.core  # noqa: E402
+from usb_helpers import USBTools  # noqa: E402
+from bench_enumeration import fake_bus  # noqa: E402
+
+DEVICE_COUNTS = [10, 40, 160]
+POLLS = 2000
+# Bytes the loop may grow by over POLLS polls.
+LEAK_BUDGET = 4096
+
+
+class PreviousPoll(object):
+    """ The poll loop before the packed snapshot, strings and fresh dicts for every poll """
+
+    def __init__(self):
+        self._old: dict = {}
+
+    def poll(self) -> bool:
+        _counter: dict = {}
+        for d in usb.core.find(find_all=True):
+            _device = f"{d.idVendor:04x}:{d.idProduct:04x}"
+            _counter[_device] = _counter.get(_device, 0) + 1
+        _current = dict(_counter)
+        _changed = sum(_current.values()) != sum(self._old.values())
+        self._old = dict(_current)
+        return _changed
+
+
+class CurrentPoll(object):
+    def __init__(self):
+        self._usb = USBTools()
+
+    def poll(self) -> bool:
+        _attached, _added, _removed = self._usb.scan()
+        return bool(_added or _removed)
+
+
+def measure(loop) -> tuple:
+    """(peak bytes allocated during one poll, bytes the loop grew by between the first and
+    the last POLLS polls)
+    """
+    # Warm up, the first poll registers every device.
+    for _ in range(10):
+        loop.poll()
+    tracemalloc.start()
+    _peak = 0
+    _held: list = []
+    for _ in range(2):
+        for _ in range(POLLS):
+            tracemalloc.reset_peak()
+            _before, _ = tracemalloc.get_traced_memory()
+            loop.poll()
+            _, _poll_peak = tracemalloc.get_traced_memory()
+            _peak = max(_peak, _poll_peak - _before)
+        # Memory allocated before tracemalloc started isn't traced, compare two points
+        # after it has been running a while.
+        _held.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+    return _peak, _held[1] - _held[0]
+
+
+def main() -> int:
+    _failed = False
+    print(
+        f"{'devices':>8} {'previous peak (B)':>18} {'current peak (B)':>17} "
+        f"{'previous growth (B)':>20} {'current growth (B)':>19}"
+    )
+    for device_cnt in DEVICE_COUNTS:
+        bus = fake_bus(device_cnt)
+        usb.core.find = lambda find_all=False, **kwargs: iter(bus)
+        previous_peak, previous_held = measure(PreviousPoll())
+        current_peak, current_held = measure(CurrentPoll())
+        print(
+            f"{device_cnt:>8} {previous_peak:>18} {current_peak:>17} "
+            f"{previous_held:>20} {current_held:>19}"
+        )
+        if current_held > LEAK_BUDGET:
+            _failed = True
+    if _failed:
+        print(f"FAIL: the poll loop grew by more than {LEAK_BUDGET} bytes over {POLLS} polls.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
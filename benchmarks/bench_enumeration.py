@@ -0,0 +1,82 @@
+# Micro-benchmark for USBTools._enumerate_devices.
+# Compares the single pass enumeration against the previous implementation, which re-aggregated
+# the whole list for every device found, across a range of bus sizes.
+#
+#   python benchmarks/bench_enumeration.py
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(
+    0, str(Path(__file__).resolve().parent.parent.joinpath("USBEventManager"))
+)
+
+import usb.core  # noqa: E402
+from helpers import Helpers  # noqa: E402
+from usb_helpers import USBTools  # noqa: E402
+
+DEVICE_COUNTS = [5, 10, 20, 40, 80, 160]
+REPEAT = 5
+NUMBER = 200
+
+
+class FakeDevice(object):
+    """ Just enough of a pyusb Device for enumeration """
+
+    __slots__ = ("idVendor", "idProduct", "bus", "address", "port_numbers")
+
+    def __init__(self, vid: int, pid: int, bus: int, address: int):
+        self.idVendor = vid
+        self.idProduct = pid
+        self.bus = bus
+        self.address = address
+        self.port_numbers = (address,)
+
+
+def fake_bus(device_cnt: int) -> list:
+    """ A bus where roughly a quarter of the devices share an ID, like hubs on a dock """
+    return [
+        FakeDevice(0x1D6B, 0x0002 + (i % 4), i // 100 + 1, i % 100 + 1)
+        if i % 4 == 0
+        else FakeDevice(0x046D, i, i // 100 + 1, i % 100 + 1)
+        for i in range(device_cnt)
+    ]
+
+
+def previous_enumerate(devices: list) -> dict:
+    """ The enumeration loop before the single pass rewrite """
+    _devices_l: list = []
+    _devices: dict = {}
+    for d in devices:
+        _devices_l.append(USBTools.pyusb_to_human(d))
+        _devices = Helpers.aggregate_list_dupes(_devices_l)
+    return _devices
+
+
+def main():
+    usb_tools = USBTools()
+    print(
+        f"{'devices':>8} {'previous (us)':>14} {'single pass (us)':>17} {'speedup':>8}"
+    )
+    for device_cnt in DEVICE_COUNTS:
+        bus = fake_bus(device_cnt)
+        usb.core.find = lambda find_all=False, **kwargs: iter(bus)
+        assert usb_tools._enumerate_devices() == previous_enumerate(bus)
+        previous = min(
+            timeit.repeat(
+                lambda: previous_enumerate(bus), repeat=REPEAT, number=NUMBER
+            )
+        )
+        current = min(
+            timeit.repeat(usb_tools._enumerate_devices, repeat=REPEAT, number=NUMBER)
+        )
+        previous_us = previous / NUMBER * 1e6
+        current_us = current / NUMBER * 1e6
+        print(
+            f"{device_cnt:>8} {previous_us:>14.1f} {current_us:>17.1f} "
+            f"{previous_us / current_us:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
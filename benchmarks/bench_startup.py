@@ -0,0 +1,62 @@
+# Import time budget check.
+# Imports every module, then builds a USBEventManager the way the CLI does, and fails if the
+# config file is parsed more than once or if startup takes longer than the budget. Run it
+# twice, the second run should use the compiled config cache and parse nothing.
+#
+#   python benchmarks/bench_startup.py [budget in seconds]
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(
+    0, str(Path(__file__).resolve().parent.parent.joinpath("USBEventManager"))
+)
+
+DEFAULT_BUDGET = 0.5
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUDGET
+    start = time.perf_counter()
+
+    import helpers
+
+    loads: list = []
+    load_yaml_file = helpers.Helpers._load_yaml_file
+
+    def counting_load_yaml_file(self, path):
+        loads.append(path)
+        return load_yaml_file(self, path)
+
+    helpers.Helpers._load_yaml_file = counting_load_yaml_file
+
+    import core
+    import actions  # noqa: F401
+    import event_sources  # noqa: F401
+    import automatic_start  # noqa: F401
+    import usbeventmanager  # noqa: F401
+
+    imported = time.perf_counter()
+    core.USBEventManager(no_actions=True)
+    ready = time.perf_counter()
+
+    print(f"imports:           {(imported - start) * 1000:8.1f} ms")
+    print(f"config + __init__: {(ready - imported) * 1000:8.1f} ms")
+    print(
+        f"total:             {(ready - start) * 1000:8.1f} ms "
+        f"(budget {budget * 1000:.0f} ms)"
+    )
+    print(f"config parses:     {len(loads):8d}")
+
+    failed = False
+    if len(loads) > 1:
+        print("FAIL: the config file should be parsed at most once.")
+        failed = True
+    if ready - start > budget:
+        print("FAIL: over budget.")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
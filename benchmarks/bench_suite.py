@@ -0,0 +1,224 @@
+# Benchmark suite, run against the simulated bus in simulated_bus.py so it needs no hardware
+# or root.
+#   * poll_cpu_us_<N>          - CPU time for one enumeration of an idle bus of N devices.
+#   * detection_p50_ms / p95   - Time from a device being attached or removed to the poll event
+#                                source reporting it, with the default check intervals.
+#   * matcher_matches_per_sec  - DeviceMatcher lookups against a 200 entry config.
+#   * secure_delete_mb_per_sec - SecureDeleter throughput, one pass plus zeros.
+# Results are compared with baseline.json, a result more than --tolerance times worse than its
+# baseline is a regression and the suite fails. Baselines depend on the machine, record new
+# ones with --save on the machine you compare on.
+#
+#   python benchmarks/bench_suite.py [--save] [--tolerance 1.5] [--fleet 40] [--rate 5]
+#                                    [--events 40] [--dir /path/on/the/disk/to/test]
+import sys
+import json
+import time
+import random
+import timeit
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(
+    0, str(Path(__file__).resolve().parent.parent.joinpath("USBEventManager"))
+)
+
+from context import runtime  # noqa: E402
+from helpers import DeviceMatcher  # noqa: E402
+from usb_helpers import USBTools  # noqa: E402
+from secure_delete import SecureDeleter  # noqa: E402
+from event_sources import PollingEventSource  # noqa: E402
+from simulated_bus import SimulatedBus  # noqa: E402
+
+BASELINE = Path(__file__).resolve().parent.joinpath("baseline.json")
+FLEET_SIZES = [10, 40, 160]
+POLLS = 2000
+# Timings are the best of this many runs, the rest are noise from other processes.
+REPEAT = 5
+# The defaults from the config file.
+CHECK_INTERVAL = 0.25
+CHECK_INTERVAL_MIN = 0.05
+MATCHES = 1000000
+SECURE_DELETE_FILES = 8
+SECURE_DELETE_FILE_MB = 4
+
+
+def _cpu_time(function, number: int) -> float:
+    """ CPU seconds for `number` calls """
+    _start = time.process_time()
+    for _ in range(number):
+        function()
+    return time.process_time() - _start
+
+
+def bench_poll_cpu(results: dict) -> None:
+    for _fleet in FLEET_SIZES:
+        with SimulatedBus(fleet_size=_fleet):
+            _usb = USBTools()
+            _usb.scan()
+            _cpu = min(
+                _cpu_time(_usb.scan, POLLS // REPEAT) for _ in range(REPEAT)
+            )
+        results[f"poll_cpu_us_{_fleet}"] = (_cpu / (POLLS // REPEAT) * 1e6, "us", False)
+
+
+def bench_detection(results: dict, fleet: int, rate: float, events: int) -> None:
+    _usb = runtime.usb
+    with SimulatedBus(fleet_size=fleet, seed=1) as bus:
+        _usb.scan()
+        _source = PollingEventSource(interval=CHECK_INTERVAL, min_interval=CHECK_INTERVAL_MIN)
+        bus.play(bus.churn(rate=rate, count=events))
+        _latencies: list = []
+        _matched: set = set()
+        _quiet_since = None
+        while True:
+            _events = _source.poll(timeout=CHECK_INTERVAL)
+            _now = time.monotonic()
+            for _event in _events:
+                for _index, _change in enumerate(bus.changes):
+                    if _index not in _matched and (
+                        _change.event_type,
+                        _change.device,
+                        _change.location,
+                    ) == tuple(_event):
+                        _matched.add(_index)
+                        _latencies.append(_now - _change.time)
+                        break
+            if _events or bus.playing:
+                _quiet_since = None
+            elif _quiet_since is None:
+                _quiet_since = _now
+            elif _now - _quiet_since > CHECK_INTERVAL * 2:
+                break
+        bus.wait()
+        _changes = len(bus.changes)
+    _latencies.sort()
+    if not _latencies:
+        print("FAIL: no changes were detected.")
+        sys.exit(1)
+    _p50 = _latencies[len(_latencies) // 2]
+    _p95 = _latencies[min(int(len(_latencies) * 0.95), len(_latencies) - 1)]
+    results["detection_p50_ms"] = (_p50 * 1000, "ms", False)
+    results["detection_p95_ms"] = (_p95 * 1000, "ms", False)
+    # A device attached and removed between two polls is never seen, that's expected.
+    print(f"detected {len(_latencies)} of {_changes} changes")
+
+
+def bench_matcher(results: dict) -> None:
+    _random = random.Random(0)
+    _config: dict = {}
+    for _i in range(150):
+        _config[f"{_random.randrange(0x10000):04x}:{_random.randrange(0x10000):04x}"] = 1
+    for _i in range(40):
+        _config[f"{_random.randrange(0x10000):04x}:*"] = 1
+    for _i in range(10):
+        _config[f"*:{_random.randrange(0x10000):04x}"] = 1
+    _listed = list(_config)
+    # Half of the lookups are for devices in the config.
+    _devices = [
+        _random.choice(_listed).replace("*", "0000")
+        if _i % 2
+        else f"{_random.randrange(0x10000):04x}:{_random.randrange(0x10000):04x}"
+        for _i in range(1000)
+    ]
+    _matcher = DeviceMatcher(_config)
+    _match = _matcher.match
+
+    def _match_all():
+        for _device in _devices:
+            _match(_device)
+
+    _rounds = MATCHES // REPEAT // len(_devices)
+    _elapsed = min(
+        timeit.timeit(_match_all, number=_rounds) for _ in range(REPEAT)
+    )
+    results["matcher_matches_per_sec"] = (
+        _rounds * len(_devices) / _elapsed,
+        "/s",
+        True,
+    )
+
+
+def bench_secure_delete(results: dict, directory=None) -> None:
+    _dir = Path(tempfile.mkdtemp(prefix="usbeventmanager-bench-", dir=directory))
+    try:
+        _chunk = bytes(1024 * 1024)
+        for _i in range(SECURE_DELETE_FILES):
+            with open(_dir.joinpath(f"file{_i}"), "wb") as f:
+                for _ in range(SECURE_DELETE_FILE_MB):
+                    f.write(_chunk)
+        _stats = SecureDeleter(passes=1).delete(paths=[str(_dir) + "/"])
+    finally:
+        shutil.rmtree(_dir, ignore_errors=True)
+    results["secure_delete_mb_per_sec"] = (_stats["mb_per_sec"], "MB/s", True)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """ Print the results next to the baseline, returns the names of regressions """
+    _regressions: list = []
+    print(f"{'benchmark':<28} {'result':>14} {'baseline':>14} {'change':>8}")
+    for _name, (_value, _unit, _higher_is_better) in results.items():
+        _base = baseline.get(_name, {}).get("value")
+        if not _base:
+            print(f"{_name:<28} {_value:>11.2f} {_unit:<2} {'-':>14}")
+            continue
+        # > 1 is worse, whichever direction is better.
+        _ratio = _base / _value if _higher_is_better else _value / _base
+        _flag = ""
+        if _ratio > tolerance:
+            _regressions.append(_name)
+            _flag = " REGRESSION"
+        print(
+            f"{_name:<28} {_value:>11.2f} {_unit:<2} {_base:>11.2f} {_unit:<2} "
+            f"{_ratio:>7.2f}x{_flag}"
+        )
+    return _regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="USBEventManager benchmark suite")
+    parser.add_argument("--save", action="store_true", help="Save the results as the baseline.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.5,
+        help="Fail if a result is this many times worse than its baseline.",
+    )
+    parser.add_argument("--fleet", type=int, default=40, help="Devices attached.")
+    parser.add_argument(
+        "--rate", type=float, default=5, help="Adds and removes per second."
+    )
+    parser.add_argument("--events", type=int, default=40, help="Adds and removes.")
+    parser.add_argument("--dir", default=None, help="Where to write secure delete files.")
+    args = parser.parse_args()
+
+    results: dict = {}
+    bench_poll_cpu(results)
+    bench_detection(results, fleet=args.fleet, rate=args.rate, events=args.events)
+    bench_matcher(results)
+    bench_secure_delete(results, directory=args.dir)
+
+    if args.save:
+        BASELINE.write_text(
+            json.dumps(
+                {
+                    _name: {"value": round(_value, 3), "unit": _unit}
+                    for _name, (_value, _unit, _) in results.items()
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+        print(f"Saved the baseline to {BASELINE}.")
+    _baseline: dict = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    _regressions = compare(results, _baseline, args.tolerance)
+    if _regressions:
+        print(f"FAIL: {', '.join(_regressions)} regressed by more than {args.tolerance}x.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+# Check which device removals trigger actions, against the simulated bus in simulated_bus.py.
+# No actions are run, dispatches are only recorded.
+#   * A whitelisted device       - no actions.
+#   * A removal_blacklist device - actions.
+#   * Any other device           - actions.
+#
+#   python benchmarks/check_removal.py
+import sys
+from pathlib import Path
+
+sys.path.insert(
+    0, str(Path(__file__).resolve().parent.parent.joinpath("USBEventManager"))
+)
+
+from context import runtime  # noqa: E402
+from config_cache import compile_config  # noqa: E402
+from event_sources import USBEvent  # noqa: E402
+from simulated_bus import SimulatedBus  # noqa: E402
+
+helpers = runtime.helpers
+
+WHITELISTED = (0x1111, 0x0001)
+BLACKLISTED = (0x2222, 0x0002)
+UNLISTED = (0x3333, 0x0003)
+# device ID: should removing it trigger actions
+EXPECTED = {
+    f"{WHITELISTED[0]:04x}:{WHITELISTED[1]:04x}": False,
+    f"{BLACKLISTED[0]:04x}:{BLACKLISTED[1]:04x}": True,
+    f"{UNLISTED[0]:04x}:{UNLISTED[1]:04x}": True,
+}
+
+
+def main() -> int:
+    _config = dict(helpers.config)
+    _config["whitelist"] = [f"{WHITELISTED[0]:04x}:{WHITELISTED[1]:04x}"]
+    _config["removal_blacklist"] = [f"{BLACKLISTED[0]:04x}:{BLACKLISTED[1]:04x}"]
+    _config["device_specific"] = {}
+    _config["journal"] = False
+    helpers._compiled = compile_config(config=_config, platform=helpers.platform)
+    helpers.app_config = helpers._compiled["config"]
+
+    from core import USBEventManager
+
+    _failed: list = []
+    with SimulatedBus(fleet_size=0) as bus:
+        _uev = USBEventManager(no_actions=True)
+        _uev._setup_monitor_mode()
+        _dispatched: list = []
+        _uev._actions.dispatch = lambda device, event_type=None, location=None: (
+            _dispatched.append((device, event_type))
+        )
+        try:
+            for _vid, _pid in (WHITELISTED, BLACKLISTED, UNLISTED):
+                _device = bus.attach(_vid, _pid)
+                _uev._handle_events([USBEvent("ADDED", _device.device_id, _device.location)])
+                _dispatched.clear()
+                bus.detach(_device)
+                _uev._handle_events(
+                    [USBEvent("REMOVED", _device.device_id, _device.location)]
+                )
+                _triggered = (_device.device_id, "REMOVED") in _dispatched
+                _expected = EXPECTED[_device.device_id]
+                print(
+                    f"{_device.device_id} removed: "
+                    f"{'actions' if _triggered else 'no actions'}, "
+                    f"expected {'actions' if _expected else 'no actions'}"
+                )
+                if _triggered != _expected:
+                    _failed.append(_device.device_id)
+        finally:
+            _uev._actions.stop()
+    if _failed:
+        print(f"FAIL: {', '.join(_failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+# A simulated USB bus for benchmarks, no hardware or root required.
+#
+# SimulatedBus replaces usb.core.find() while it's installed so USBTools, the poll event source
+# and everything above them see the simulated devices. Devices can be attached and detached
+# directly, or by a script played on a background thread -
+#
+#   with SimulatedBus(fleet_size=40) as bus:
+#       bus.play(bus.churn(rate=5, count=100))
+#       ...
+#       bus.wait()
+#
+# Every change is recorded in bus.changes with the time.monotonic() it happened so the time
+# taken to detect it can be measured.
+import random
+import threading
+import time
+from collections import namedtuple
+
+import usb.core
+
+# A change to the bus. event_type == "ADDED" | "REMOVED", device == "xxxx:xxxx"
+BusChange = namedtuple("BusChange", ["time", "event_type", "device", "location"])
+# A scripted step, `delay` seconds after the previous one. action == "add" | "remove"
+ScriptStep = namedtuple("ScriptStep", ["delay", "action", "vid", "pid"])
+
+# Ports per simulated hub, devices are spread over the root hub ports then over hubs.
+PORTS_PER_HUB = 4
+
+
+class SimulatedDevice(object):
+    """ Just enough of a pyusb Device for USBTools """
+
+    __slots__ = (
+        "idVendor",
+        "idProduct",
+        "bus",
+        "address",
+        "port_numbers",
+        "iManufacturer",
+        "iProduct",
+        "iSerialNumber",
+    )
+
+    def __init__(self, vid: int, pid: int, bus: int, address: int, port_numbers: tuple):
+        self.idVendor = vid
+        self.idProduct = pid
+        self.bus = bus
+        self.address = address
+        self.port_numbers = port_numbers
+        # No string descriptors.
+        self.iManufacturer = 0
+        self.iProduct = 0
+        self.iSerialNumber = 0
+
+    @property
+    def device_id(self) -> str:
+        return f"{self.idVendor:04x}:{self.idProduct:04x}"
+
+    @property
+    def location(self) -> str:
+        if not self.port_numbers:
+            return f"usb{self.bus}"
+        return f"{self.bus}-" + ".".join(str(p) for p in self.port_numbers)
+
+
+class SimulatedBus(object):
+    """A set of buses with a root hub each and `fleet_size` devices attached. Roughly a
+    quarter of the devices share an ID, like hubs on a dock.
+    """
+
+    def __init__(self, fleet_size: int = 10, buses: int = 2, seed: int = 0):
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._devices: list = []
+        # Next address per bus, the kernel hands them out in order and wraps at 127.
+        self._next_address: dict = {}
+        self._free_ports: dict = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._installed = None
+        self.changes: list = []
+        for _bus in range(1, buses + 1):
+            self._next_address[_bus] = 1
+            self._free_ports[_bus] = [(p,) for p in range(PORTS_PER_HUB, 0, -1)]
+            self._add(0x1D6B, 0x0002, _bus, port_numbers=())
+        for _i in range(fleet_size):
+            self._add(*self._fleet_id(_i))
+
+    def _fleet_id(self, index: int) -> tuple:
+        if index % 4 == 0:
+            return 0x05E3, 0x0610 + index % 3
+        return 0x046D, 0xC000 + index
+
+    # pyusb
+    def find(self, find_all=False, backend=None, custom_match=None, **kwargs):
+        """ usb.core.find() for the simulated devices """
+        with self._lock:
+            _devices = list(self._devices)
+        if not kwargs and custom_match is None:
+            _matches = _devices
+        else:
+            _matches = [
+                d
+                for d in _devices
+                if all(getattr(d, k) == v for k, v in kwargs.items())
+                and (custom_match is None or custom_match(d))
+            ]
+        if find_all:
+            return iter(_matches)
+        return _matches[0] if _matches else None
+
+    def install(self) -> None:
+        if self._installed is None:
+            self._installed = usb.core.find
+            usb.core.find = self.find
+
+    def uninstall(self) -> None:
+        if self._installed is not None:
+            usb.core.find = self._installed
+            self._installed = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        self.uninstall()
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    # Changes
+    def _add(self, vid: int, pid: int, bus: int = None, port_numbers: tuple = None):
+        if bus is None:
+            # The bus with the fewest devices.
+            _attached = {b: 0 for b in self._free_ports}
+            for _device in self._devices:
+                _attached[_device.bus] += 1
+            bus = min(_attached, key=_attached.get)
+        if port_numbers is None:
+            _free = self._free_ports[bus]
+            if not _free:
+                raise RuntimeError("No free ports on the simulated bus.")
+            port_numbers = _free.pop()
+            # Every port can take a hub, its ports are handed out after the root hub's.
+            _free[:0] = [port_numbers + (p,) for p in range(PORTS_PER_HUB, 0, -1)]
+        _used = {d.address for d in self._devices if d.bus == bus}
+        if len(_used) >= 127:
+            raise RuntimeError("No free addresses on the simulated bus.")
+        _address = self._next_address[bus]
+        while _address in _used:
+            _address = _address % 127 + 1
+        self._next_address[bus] = _address % 127 + 1
+        _device = SimulatedDevice(vid, pid, bus, _address, port_numbers)
+        self._devices.append(_device)
+        return _device
+
+    def attach(self, vid: int = None, pid: int = None) -> SimulatedDevice:
+        """ Attach a device, a random ID if one isn't given """
+        if vid is None or pid is None:
+            vid, pid = 0x1234, self._random.randrange(0x10000)
+        with self._lock:
+            _device = self._add(vid, pid)
+            self.changes.append(
+                BusChange(time.monotonic(), "ADDED", _device.device_id, _device.location)
+            )
+        return _device
+
+    def detach(self, device: SimulatedDevice = None) -> [SimulatedDevice, None]:
+        """ Detach a device, a random one that isn't a root hub if one isn't given """
+        with self._lock:
+            if device is None:
+                _candidates = [d for d in self._devices if d.port_numbers]
+                if not _candidates:
+                    return None
+                device = self._random.choice(_candidates)
+            self._devices.remove(device)
+            self._free_ports[device.bus].append(device.port_numbers)
+            self.changes.append(
+                BusChange(time.monotonic(), "REMOVED", device.device_id, device.location)
+            )
+        return device
+
+    # Scripts
+    def churn(self, rate: float, count: int, add_share: float = 0.5) -> list:
+        """A script of `count` random adds and removes arriving at, on average, `rate` per
+        second, e.g. a flapping hub or devices coming and going in a lab.
+        """
+        _script: list = []
+        for _ in range(count):
+            _action = "add" if self._random.random() < add_share else "remove"
+            _script.append(ScriptStep(self._random.expovariate(rate), _action, None, None))
+        return _script
+
+    def play(self, script: list) -> None:
+        """ Play a script on a background thread """
+        self.stop()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._play, args=(script, self._stop), name="simulated-bus", daemon=True
+        )
+        self._thread.start()
+
+    def _play(self, script: list, stop: threading.Event) -> None:
+        for _step in script:
+            if stop.wait(_step.delay):
+                return
+            if _step.action == "add":
+                self.attach(_step.vid, _step.pid)
+            else:
+                self.detach()
+
+    @property
+    def playing(self) -> bool:
+        """ True while a script is being played """
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self, timeout: float = None) -> None:
+        """ Wait for the script to finish """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
@@ -3,4 +3,6 @@ $Env:Path
 $Env:USBEVENTMANAGER_PLATFORM
 $Env:USBEVENTMANAGER_DEVICE_ID
 $Env:USBEVENTMANAGER_EVENT_TYPE
+$Env:USBEVENTMANAGER_DEVICE_LOCATION
+$Env:USBEVENTMANAGER_DEVICE_SERIAL
 exit 0
\ No newline at end of file
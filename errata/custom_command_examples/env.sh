@@ -4,4 +4,6 @@ echo "PATH:" "$PATH"
 echo "USBEVENTMANAGER_PLATFORM: " "$USBEVENTMANAGER_PLATFORM"
 echo "USBEVENTMANAGER_DEVICE_ID: " "$USBEVENTMANAGER_DEVICE_ID"
 echo "USBEVENTMANAGER_EVENT_TYPE: " "$USBEVENTMANAGER_EVENT_TYPE"
+echo "USBEVENTMANAGER_DEVICE_LOCATION: " "$USBEVENTMANAGER_DEVICE_LOCATION"
+echo "USBEVENTMANAGER_DEVICE_SERIAL: " "$USBEVENTMANAGER_DEVICE_SERIAL"
 exit 0
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# Example persistent handler. Started once by USBEventManager, it reads one JSON event per
+# line from stdin and replies with one JSON object per line on stdout.
+# Configure it under "persistent_handlers" then add "handler:<name>" to "custom_commands".
+import sys
+import json
+
+for line in sys.stdin:
+    event = json.loads(line)
+    output = (
+        f"{event['USBEVENTMANAGER_EVENT_TYPE']} "
+        f"{event['USBEVENTMANAGER_DEVICE_ID']} "
+        f"on {event['USBEVENTMANAGER_PLATFORM']}"
+    )
+    # Reply with a status, 0 == success, and any output. Flush so the reply isn't buffered.
+    print(json.dumps({"status": 0, "output": output}), flush=True)